@@ -1,20 +1,56 @@
+import io
+import gzip
 import os
 import sys
+import gc
+import signal
 import uuid
-import subprocess
 import pika
 import json
 import torch
+import numpy as np
+import threading
 import time
+import struct
+import subprocess
 import tempfile
+import functools
+import copy
+import hashlib
+import contextlib
+import multiprocessing
+from collections import OrderedDict, deque
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from demucs.apply import BagOfModels, apply_model
+from demucs.audio import prevent_clip
+import julius
+from demucs.pretrained import get_model
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 import logging
 
+# Метрики Prometheus подключаются опционально: без пакета воркер работает, эндпоинт /metrics не поднимается
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Whisper нужен только в совмещённом режиме FUSED_TRANSCRIPTION; в образе может быть установлен один из движков
+try:
+    import faster_whisper # faster-whisper (CTranslate2)
+except ImportError:
+    faster_whisper = None
+try:
+    import whisper # openai-whisper
+except ImportError:
+    whisper = None
+
 # --- Конфигурация логирования ---
 logging.basicConfig(
     level=os.getenv('LOG_LEVEL', 'INFO').upper(),
-    format='%(asctime)s - %(levelname)s - %(process)d - %(module)s - %(funcName)s - %(message)s'
+    format='%(asctime)s - %(levelname)s - %(process)d - %(threadName)s - %(module)s - %(funcName)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
@@ -51,12 +87,223 @@ MINIO_DEFAULT_BUCKET = os.getenv('MINIO_BUCKET_NAME', 'audio-bucket')
 
 DEMUCS_MODEL = os.getenv('DEMUCS_MODEL', "htdemucs")
 DEMUCS_SHIFTS = int(os.getenv('DEMUCS_SHIFTS', 0))
-DEMUCS_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+DEMUCS_DEVICE = os.getenv('DEMUCS_DEVICE') or ("cuda" if torch.cuda.is_available() else "cpu")
+DEMUCS_OVERLAP = float(os.getenv('DEMUCS_OVERLAP', 0.25))
+# --- Инференс на CPU ---
+# 'eager' - модель demucs как есть; 'torchscript' - замороженные графы из export_model.py (только CPU)
+DEMUCS_BACKEND = os.getenv("DEMUCS_BACKEND", "eager").lower()
+# Каталог с результатом export_model.py: model_<i>.pt для каждой подмодели и export.json
+DEMUCS_EXPORT_DIR = os.getenv("DEMUCS_EXPORT_DIR", os.path.join("/models/demucs", DEMUCS_MODEL))
+# Динамическое квантование линейных слоёв и LSTM в int8 при загрузке eager-модели (для torchscript задаётся при экспорте)
+DEMUCS_QUANTIZE = os.getenv("DEMUCS_QUANTIZE", "False").lower() == "true"
+# Потоки torch: внутри операции (intra-op) и между операциями (inter-op); 0 = по умолчанию torch
+DEMUCS_CPU_THREADS = int(os.getenv("DEMUCS_CPU_THREADS", 0))
+DEMUCS_INTEROP_THREADS = int(os.getenv("DEMUCS_INTEROP_THREADS", 0))
+SUPPORTED_DEMUCS_BACKENDS = ("eager", "torchscript")
+# --- Потоковое разделение длинных записей: пиковая память зависит от окна, а не от длины трека ---
+# Записи от DEMUCS_STREAMING_MIN_SECONDS секунд (длительность по ffprobe) разделяются окнами; 0 = всегда целиком
+DEMUCS_STREAMING_MIN_SECONDS = float(os.getenv("DEMUCS_STREAMING_MIN_SECONDS", 0))
+DEMUCS_STREAM_WINDOW_SECONDS = float(os.getenv("DEMUCS_STREAM_WINDOW_SECONDS", 60))
+DEMUCS_STREAM_OVERLAP_SECONDS = float(os.getenv("DEMUCS_STREAM_OVERLAP_SECONDS", 5))
+# Процессов для разделения окон: 1 = в процессе воркера под INFERENCE_SLOTS, больше - пул, где каждый процесс держит свою модель
+DEMUCS_STREAM_WORKERS = max(int(os.getenv("DEMUCS_STREAM_WORKERS", 1)), 1)
+
+# --- Адаптивное качество: при большой очереди задачи разделяются более дешёвой конфигурацией ---
+# Уровень 'high' - DEMUCS_MODEL и DEMUCS_SHIFTS, уровень 'fast' - DEMUCS_FAST_MODEL и DEMUCS_FAST_SHIFTS.
+# Уровень записывается в результат (quality_tier), задача с quality_tier в сообщении выполняется на этом уровне
+ADAPTIVE_QUALITY = os.getenv("ADAPTIVE_QUALITY", "False").lower() == "true"
+DEMUCS_FAST_MODEL = os.getenv("DEMUCS_FAST_MODEL", "htdemucs")
+DEMUCS_FAST_SHIFTS = int(os.getenv("DEMUCS_FAST_SHIFTS", 0))
+# Оценка очереди в секундах: сообщения × среднее время задачи на уровне high / (потребители × WORKER_CONCURRENCY).
+# Выше DEGRADE воркер переходит на 'fast', обратно - только ниже RESTORE (гистерезис)
+ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS", 3600))
+ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS", 600))
+# Период опроса очереди (пассивный queue_declare) и минимальное время на уровне до следующего переключения
+ADAPTIVE_QUALITY_CHECK_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_CHECK_SECONDS", 30))
+ADAPTIVE_QUALITY_MIN_HOLD_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_MIN_HOLD_SECONDS", 300))
+# Время задачи на уровне high, пока не измерено ни одной
+ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS", 300))
+QUALITY_TIERS = {
+    "high": {"name": "high", "model": DEMUCS_MODEL, "shifts": DEMUCS_SHIFTS},
+    "fast": {"name": "fast", "model": DEMUCS_FAST_MODEL, "shifts": DEMUCS_FAST_SHIFTS},
+}
+if ADAPTIVE_QUALITY and ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS >= ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:
+    logger.critical("ОШИБКА: ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS должен быть меньше ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS")
+    sys.exit(1)
+
+# --- Совмещённый режим: вокал сразу распознаётся Whisper в этом же процессе ---
+# Результат транскрипции публикуется с ключом результатов Whisper, и SoundService не ставит отдельную задачу в whisper_worker
+FUSED_TRANSCRIPTION = os.getenv("FUSED_TRANSCRIPTION", "False").lower() == "true"
+WHISPER_RESULT_ROUTING_KEY = os.getenv("RABBITMQ_WHISPER_RESULT_ROUTING_KEY")
+# Значения по умолчанию те же, что у whisper_worker: совмещённый и отдельный режимы дают одинаковый результат
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "openai").lower() # 'openai' или 'faster_whisper'
+WHISPER_MODEL_NAME = os.getenv("WHISPER_MODEL_NAME", "base")
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE") or DEMUCS_DEVICE
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", 5))
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", 0))
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", 1))
+WHISPER_CACHE_DIR = os.getenv("WHISPER_CACHE_DIR", "/app/.cache/whisper")
+# На выделенном вокале VAD быстро отбрасывает инструментальные участки (только faster_whisper)
+WHISPER_VAD_FILTER = os.getenv("WHISPER_VAD_FILTER", "True").lower() == "true"
+WHISPER_LANGUAGE = "ru"
+WHISPER_SAMPLE_RATE = 16000
+# Папка для transcription_detailed.json, как у whisper_worker без output_minio_folder в задаче
+WHISPER_OUTPUT_FOLDER = os.getenv("WHISPER_OUTPUT_FOLDER", "whisper_output").strip('/')
+# Формат сообщения с результатом транскрипции - те же настройки, что у whisper_worker
+RESULT_PAYLOAD_MODE = os.getenv("RESULT_PAYLOAD_MODE", "inline").lower()
+RESULT_INLINE_MAX_BYTES = int(os.getenv("RESULT_INLINE_MAX_BYTES", 64 * 1024))
+TRANSCRIPTION_JSON_COMPRESSION = os.getenv("TRANSCRIPTION_JSON_COMPRESSION", "none").lower()
+if FUSED_TRANSCRIPTION and not WHISPER_RESULT_ROUTING_KEY:
+    logger.critical("ОШИБКА: Для FUSED_TRANSCRIPTION нужна переменная окружения RABBITMQ_WHISPER_RESULT_ROUTING_KEY")
+    sys.exit(1)
+if RESULT_PAYLOAD_MODE not in ("inline", "reference", "auto"):
+    logger.critical(f"ОШИБКА: Неизвестный RESULT_PAYLOAD_MODE '{RESULT_PAYLOAD_MODE}'. Допустимые значения: inline, reference, auto")
+    sys.exit(1)
+if TRANSCRIPTION_JSON_COMPRESSION not in ("none", "gzip"):
+    logger.critical(f"ОШИБКА: Неизвестный TRANSCRIPTION_JSON_COMPRESSION '{TRANSCRIPTION_JSON_COMPRESSION}'. Допустимые значения: none, gzip")
+    sys.exit(1)
+
+# --- Метрики Prometheus ---
+# Порт HTTP-эндпоинта /metrics; 0 = не запускать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_SERVICE = "demucs"
+METRICS_STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# --- Кэш результатов по содержимому входного файла ---
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "True").lower() == "true"
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "cache").strip('/')
+# Предельный размер кэша одного сервиса в MinIO; при превышении удаляются самые старые записи
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+# Переполнение проверяется раз в RESULT_CACHE_EVICT_EVERY сохранений (первая проверка - при первом сохранении):
+# каждая проверка - полный LIST префикса сервиса. Между проверками кэш может превысить лимит на столько же записей
+RESULT_CACHE_EVICT_EVERY = max(int(os.getenv("RESULT_CACHE_EVICT_EVERY", 20)), 1)
+CACHE_STORES_SINCE_EVICT = {}
+CACHE_EVICT_LOCK = threading.Lock()
+
+# --- Общий декодированный звук: ffmpeg декодирует исходник один раз для всех этапов ---
+DECODED_AUDIO_ENABLED = os.getenv("DECODED_AUDIO_ENABLED", "True").lower() == "true"
+# Каталог общего тома: массивы .npy отображаются в память без копирования. Без него общий звук выключен:
+# копирование массива через MinIO во временный файл обошлось бы дороже повторного запуска ffmpeg
+DECODED_AUDIO_DIR = os.getenv("DECODED_AUDIO_DIR", "")
+# Предельный суммарный размер декодированного звука; при превышении удаляются самые старые массивы
+DECODED_AUDIO_MAX_BYTES = int(os.getenv("DECODED_AUDIO_MAX_BYTES", 20 * 1024 ** 3))
+if DECODED_AUDIO_ENABLED and not DECODED_AUDIO_DIR:
+    logger.warning("DECODED_AUDIO_DIR не задан: общий декодированный звук выключен, каждый этап декодирует исходник сам")
+
+# --- Потоковый обмен с MinIO: входной файл и результат не пишутся на диск ---
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 1024 * 1024))
+# Размер части multipart-выгрузки результата (не меньше минимальных для S3 5 МиБ)
+UPLOAD_PART_SIZE = max(int(os.getenv("UPLOAD_PART_SIZE", 16 * 1024 * 1024)), 5 * 1024 * 1024)
+# Сколько отсчётов за раз кодируется при выгрузке результата
+ENCODE_BLOCK_FRAMES = 1 << 18
+
+# --- Формат файла результата ---
+# 'flac' - без потерь (по умолчанию), 'opus' - компактный формат для потокового прослушивания, 'wav' - PCM 16 бит
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "flac").lower()
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "96k")
+OUTPUT_FORMATS = {
+    "wav": {"extension": ".wav", "content_type": "audio/wav", "ffmpeg_args": None},
+    "flac": {"extension": ".flac", "content_type": "audio/flac",
+             "ffmpeg_args": ["-c:a", "flac", "-sample_fmt", "s16", "-compression_level", "5", "-f", "flac"]},
+    # libopus работает с 48 кГц; Ogg/Opus проигрывается браузерами напрямую
+    "opus": {"extension": ".opus", "content_type": "audio/ogg",
+             "ffmpeg_args": ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-ar", "48000", "-f", "ogg"]},
+}
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    logger.critical(f"ОШИБКА: Неизвестный OUTPUT_FORMAT '{OUTPUT_FORMAT}'. Допустимые значения: {', '.join(OUTPUT_FORMATS)}")
+    sys.exit(1)
 
 RECONNECT_DELAY_SECONDS = int(os.getenv("RECONNECT_DELAY_SECONDS", 5))
 
+# --- Конкурентная обработка ---
+# Сколько задач обрабатывается одновременно (скачивание/выгрузка идут параллельно с инференсом)
+WORKER_CONCURRENCY = max(int(os.getenv("WORKER_CONCURRENCY", 1)), 1)
+# Сколько инференсов модели может выполняться одновременно
+INFERENCE_CONCURRENCY = max(int(os.getenv("INFERENCE_CONCURRENCY", 1)), 1)
+# Сколько неподтверждённых сообщений брокер выдаёт воркеру (по умолчанию = WORKER_CONCURRENCY)
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", 0)) or WORKER_CONCURRENCY
+# Интервал heartbeat: инференс идёт вне потока соединения, поэтому длинный интервал не нужен
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 30))
+# Тайм-аут брокера на подтверждение доставки (x-consumer-timeout, мс); 0 = настройка сервера
+RABBITMQ_CONSUMER_TIMEOUT_MS = int(os.getenv("RABBITMQ_CONSUMER_TIMEOUT_MS", 0))
+# Сколько завершённых, но не подтверждённых из-за обрыва соединения задач помнить до повторной доставки
+COMPLETED_TASKS_MAX = int(os.getenv("COMPLETED_TASKS_MAX", 256))
+
+# --- Pre-fork: несколько процессов-потребителей с общими весами модели ---
+# Родитель загружает модель один раз и порождает WORKER_PROCESSES дочерних процессов через fork: у каждого своё
+# соединение RabbitMQ и WORKER_CONCURRENCY слотов, а страницы весов общие (copy-on-write). 1 = без супервизора
+WORKER_PROCESSES = max(int(os.getenv("WORKER_PROCESSES", 1)), 1)
+# Пауза перед перезапуском упавшего процесса; при падениях чаще PREFORK_STABLE_SECONDS удваивается до максимума
+PREFORK_RESTART_DELAY_SECONDS = float(os.getenv("PREFORK_RESTART_DELAY_SECONDS", 1))
+PREFORK_RESTART_MAX_DELAY_SECONDS = float(os.getenv("PREFORK_RESTART_MAX_DELAY_SECONDS", 60))
+PREFORK_STABLE_SECONDS = float(os.getenv("PREFORK_STABLE_SECONDS", 60))
+
+# --- Полосы задач: короткие записи не ждут в очереди за часовыми ---
+# Полосы, которые разбирает воркер, и их доли слотов, например "fast:3,bulk:1"; пусто = одна общая очередь.
+# Задача полосы lane приходит в очередь <RABBITMQ_CONSUME_QUEUE>.<lane> с ключом <RABBITMQ_CONSUME_ROUTING_KEY>.<lane>
+SUPPORTED_TASK_LANES = ("fast", "bulk")
+TASK_LANES = {}
+for _lane_spec in filter(None, (item.strip() for item in os.getenv("TASK_LANES", "").split(","))):
+    _lane_name, _, _lane_weight = _lane_spec.partition(":")
+    if _lane_name not in SUPPORTED_TASK_LANES:
+        logger.critical(f"ОШИБКА: Неизвестная полоса '{_lane_name}' в TASK_LANES. Допустимые значения: {', '.join(SUPPORTED_TASK_LANES)}")
+        sys.exit(1)
+    TASK_LANES[_lane_name] = max(int(_lane_weight or 1), 1)
+if TASK_LANES and WORKER_CONCURRENCY < len(TASK_LANES):
+    logger.critical(f"ОШИБКА: WORKER_CONCURRENCY={WORKER_CONCURRENCY} меньше числа полос в TASK_LANES ({len(TASK_LANES)}): "
+                    f"слоты полос делят WORKER_CONCURRENCY, и каждой нужен хотя бы один")
+    sys.exit(1)
+# Разбирать ли общую очередь, распределяя её задачи по полосам (достаточно одного такого воркера на сервис)
+TASK_LANE_ROUTER = os.getenv("TASK_LANE_ROUTER", "True").lower() == "true"
+# Граница полос по длительности записи (ffprobe по presigned URL) и, если длительность не узнать, по размеру файла
+LANE_FAST_MAX_SECONDS = float(os.getenv("LANE_FAST_MAX_SECONDS", 600))
+LANE_FAST_MAX_BYTES = int(os.getenv("LANE_FAST_MAX_BYTES", 32 * 1024 * 1024))
+LANE_PROBE_DURATION = os.getenv("LANE_PROBE_DURATION", "True").lower() == "true"
+LANE_PROBE_TIMEOUT_SECONDS = float(os.getenv("LANE_PROBE_TIMEOUT_SECONDS", 10))
+# Сколько задач общей очереди классифицируется одновременно (stat_object и ffprobe идут вне потока соединения)
+LANE_ROUTER_WORKERS = max(int(os.getenv("LANE_ROUTER_WORKERS", 4)), 1)
+# Через сколько секунд задача, которую брокер не принял в полосу, возвращается в общую очередь
+LANE_ROUTE_RETRY_SECONDS = float(os.getenv("LANE_ROUTE_RETRY_SECONDS", 5))
+
 MINIO_CLIENT = None
 
+# Модели Demucs загружаются один раз на процесс и остаются на DEMUCS_DEVICE: имя модели -> модель
+DEMUCS_MODELS = {}
+DEMUCS_MODEL_LOCK = threading.Lock()
+
+# Модель Whisper для совмещённого режима, загружается один раз на процесс
+WHISPER_MODEL_INSTANCE = None
+WHISPER_MODEL_LOCK = threading.Lock()
+
+# Пул процессов для потокового разделения (DEMUCS_STREAM_WORKERS > 1), создаётся при первой длинной записи
+STREAM_EXECUTOR = None
+
+# Этапы: queue_wait, download (чтение из сети), decode (декодирование вместе с потоковым чтением),
+# inference, encode, upload (выгрузка без учёта ожидания кодировщика)
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram("audio_worker_stage_seconds", "Длительность этапов обработки задачи",
+                                                ["service", "stage"], buckets=METRICS_STAGE_BUCKETS)
+    TASKS_TOTAL = prometheus_client.Counter("audio_worker_tasks_total", "Опубликованные результаты задач по статусу",
+                                            ["service", "status"])
+    AUDIO_SECONDS_TOTAL = prometheus_client.Counter("audio_worker_audio_seconds_total", "Суммарная длительность обработанного аудио",
+                                                    ["service", "model"])
+    REALTIME_FACTOR = prometheus_client.Gauge("audio_worker_realtime_factor", "Секунды обработки на секунду аудио (последняя задача)",
+                                              ["service", "model"])
+    BACKLOG_SECONDS = prometheus_client.Gauge("audio_worker_backlog_seconds", "Оценка времени разбора очереди задач",
+                                              ["service"])
+    QUALITY_DEGRADED = prometheus_client.Gauge("audio_worker_quality_degraded", "1, если задачи выполняются на уровне качества fast",
+                                               ["service"])
+
+TASK_EXECUTOR = None
+ROUTER_EXECUTOR = None
+INFERENCE_SLOTS = threading.BoundedSemaphore(INFERENCE_CONCURRENCY)
+
+# Задачи в работе и завершённые задачи, чей результат не удалось отправить: ключ задачи -> доставка / операции
+INFLIGHT_TASKS = {}
+COMPLETED_TASKS = OrderedDict()
+DELIVERY_LOCK = threading.RLock()
+
 # --- Функции ---
 
 def get_minio_client():
@@ -78,17 +325,17 @@ def get_minio_client():
     return MINIO_CLIENT
 
 # ИСПРАВЛЕНО: функция публикации стала универсальной
-def publish_processing_result(channel, task_id, status, result_data):
+def publish_processing_result(channel, task_id, status, result_data, service="demucs", routing_key=PUBLISH_ROUTING_KEY):
     message_payload = {
         "task_id": task_id,
-        "service": "demucs",
+        "service": service,
         "status": status,
         **result_data
     }
     try:
         channel.basic_publish(
             exchange=PUBLISH_EXCHANGE,
-            routing_key=PUBLISH_ROUTING_KEY,
+            routing_key=routing_key,
             body=json.dumps(message_payload),
             properties=pika.BasicProperties(
                 delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
@@ -96,108 +343,1116 @@ def publish_processing_result(channel, task_id, status, result_data):
                 correlation_id=task_id
             )
         )
-        logger.info(f"Результат для task_id {task_id} опубликован в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
+        count_task(status, service)
+        logger.info(f"Результат для task_id {task_id} опубликован в '{PUBLISH_EXCHANGE}' с ключом '{routing_key}'")
     except Exception as e:
         logger.error(f"Не удалось опубликовать результат для task_id {task_id}: {e}")
 
-# Функции run_demucs_process и process_single_task остаются без изменений
-def run_demucs_process(task_id, input_audio_path, base_output_dir):
-    # ... (код без изменений)
-    demucs_output_subpath = os.path.join(DEMUCS_MODEL, os.path.splitext(os.path.basename(input_audio_path))[0])
-    expected_vocals_file = os.path.join(base_output_dir, demucs_output_subpath, "vocals.wav")
-
-    cmd = [
-        "python3", "-m", "demucs",
-        "-d", DEMUCS_DEVICE,
-        "-n", DEMUCS_MODEL,
-        "--two-stems", "vocals",
-        "--shifts", str(DEMUCS_SHIFTS),
-        "--out", base_output_dir,
-        input_audio_path
-    ]
-    logger.info(f"Задача {task_id}: Выполнение Demucs: {' '.join(cmd)}")
+def observe_stage(stage, seconds):
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(METRICS_SERVICE, stage).observe(seconds)
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    started = time.monotonic()
     try:
-        process = subprocess.run(cmd, capture_output=True, text=True, check=False)
-        logger.debug(f"Задача {task_id}: Demucs stdout:\n{process.stdout}")
-        if process.stderr:
-            logger.warning(f"Задача {task_id}: Demucs stderr:\n{process.stderr}")
-
-        if process.returncode != 0:
-            return None, {
-                "error_message": "Ошибка обработки Demucs",
-                "details": {"stdout": process.stdout, "stderr": process.stderr, "returncode": process.returncode}
-            }
-
-        if not os.path.exists(expected_vocals_file):
-            logger.warning(f"Задача {task_id}: Ожидаемый файл с вокалом не найден по пути {expected_vocals_file}. Поиск...")
-            found_vocals = []
-            for root, _, files in os.walk(base_output_dir):
-                for f_name in files:
-                    if "vocals.wav" in f_name.lower():
-                        found_vocals.append(os.path.join(root, f_name))
-            if found_vocals:
-                logger.info(f"Задача {task_id}: Найден файл с вокалом: {found_vocals[0]}. Используется этот файл.")
-                return found_vocals[0], None
-            return None, {
-                "error_message": f"Выходной файл Demucs vocals.wav не найден. Ожидаемый путь: {expected_vocals_file}",
-                "details": { "search_path": base_output_dir, "demucs_stdout": process.stdout }
-            }
-
-        logger.info(f"Задача {task_id}: Обработка Demucs успешна. Вокал по пути {expected_vocals_file}")
-        return expected_vocals_file, None
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started)
+
+def count_task(status, service=METRICS_SERVICE):
+    if prometheus_client is not None:
+        TASKS_TOTAL.labels(service, status).inc()
+
+def observe_realtime_factor(model, processing_seconds, audio_seconds):
+    """Фактор реального времени задачи: секунды обработки (без ожидания в очереди) на секунду аудио."""
+    if prometheus_client is not None and audio_seconds > 0:
+        REALTIME_FACTOR.labels(METRICS_SERVICE, model).set(processing_seconds / audio_seconds)
+        AUDIO_SECONDS_TOTAL.labels(METRICS_SERVICE, model).inc(audio_seconds)
+
+def observe_queue_wait(properties):
+    """Ожидание в очереди от публикации задачи (заголовок x-published-at-ms или timestamp AMQP) до начала обработки."""
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get("x-published-at-ms"):
+        published_at = int(headers["x-published-at-ms"]) / 1000
+    elif getattr(properties, "timestamp", None):
+        published_at = properties.timestamp
+    else:
+        return
+    observe_stage("queue_wait", max(time.time() - published_at, 0.0))
+
+def start_metrics_server():
+    if prometheus_client is None:
+        logger.warning("Пакет prometheus_client не установлен: эндпоинт /metrics не запущен")
+    elif METRICS_PORT > 0:
+        prometheus_client.start_http_server(METRICS_PORT)
+        logger.info(f"Метрики Prometheus доступны на порту {METRICS_PORT} (/metrics)")
+
+def make_cache_key(content_id, params):
+    payload = json.dumps({"content": content_id, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
+def get_etag_cache_key(minio_client, bucket_name, object_name, params, task_id="N/A"):
+    """Ключ кэша по ETag и размеру объекта: вычисляется без скачивания файла."""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        stat = minio_client.stat_object(bucket_name, object_name)
+        etag = stat.etag.strip('"')
+        return make_cache_key(f"etag:{etag}:{stat.size}", params)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для кэша: {e}")
+        return None
+
+def get_content_cache_key(sha256_hex, params):
+    """Ключ кэша по SHA-256 содержимого: совпадает для одинаковых файлов, загруженных разными способами."""
+    if not RESULT_CACHE_ENABLED or not sha256_hex:
+        return None
+    return make_cache_key(f"sha256:{sha256_hex}", params)
+
+def get_cache_object_name(service, cache_key, suffix):
+    return f"{RESULT_CACHE_PREFIX}/{service}/{cache_key}{suffix}"
+
+def lookup_cached_result(minio_client, bucket_name, service, cache_key, task_id="N/A"):
+    """Возвращает манифест закэшированного результата или None."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return None
+    manifest_object = get_cache_object_name(service, cache_key, ".json")
+    try:
+        response = minio_client.get_object(bucket_name, manifest_object)
+        try:
+            manifest = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    except S3Error as e:
+        if e.code != "NoSuchKey":
+            logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
+    logger.info(f"Задача {task_id}: Найден результат в кэше: s3://{bucket_name}/{manifest_object}")
+    return manifest
+
+def restore_cached_artifact(minio_client, bucket_name, manifest, output_object_name, task_id="N/A"):
+    """Копирует закэшированный файл результата на место выходного объекта задачи (на стороне MinIO)."""
+    try:
+        minio_client.copy_object(bucket_name, output_object_name, CopySource(bucket_name, manifest["artifact_object"]))
+        return True
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось восстановить результат из кэша {manifest.get('artifact_object')}: {e}")
+        return False
+
+def store_cached_result(minio_client, bucket_name, service, cache_keys, result, artifact_object=None, artifact_suffix="", task_id="N/A"):
+    """Сохраняет результат в кэш под всеми переданными ключами. Ошибки кэша не влияют на задачу."""
+    cache_keys = list(dict.fromkeys(key for key in cache_keys if key))
+    if not RESULT_CACHE_ENABLED or not cache_keys:
+        return
+    try:
+        cached_artifact = None
+        if artifact_object:
+            cached_artifact = get_cache_object_name(service, cache_keys[-1], artifact_suffix)
+            minio_client.copy_object(bucket_name, cached_artifact, CopySource(bucket_name, artifact_object))
+        manifest = {"service": service, "created_at": time.time(), "artifact_object": cached_artifact, "result": result}
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        for cache_key in cache_keys:
+            minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                    io.BytesIO(data), len(data), content_type='application/json')
+        logger.info(f"Задача {task_id}: Результат сохранён в кэш {RESULT_CACHE_PREFIX}/{service}/ (ключей: {len(cache_keys)})")
+        if should_evict_cache(service):
+            evict_cache_overflow(minio_client, bucket_name, service)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось сохранить результат в кэш: {e}")
+
+def link_cached_result(minio_client, bucket_name, service, manifest, cache_key, task_id="N/A"):
+    """Регистрирует уже закэшированный результат под ещё одним ключом (например, ETag нового объекта с тем же содержимым)."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return
+    try:
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                io.BytesIO(data), len(data), content_type='application/json')
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось добавить ключ кэша {cache_key}: {e}")
+
+def should_evict_cache(service):
+    """True раз в RESULT_CACHE_EVICT_EVERY сохранений сервиса, начиная с первого."""
+    with CACHE_EVICT_LOCK:
+        count = CACHE_STORES_SINCE_EVICT.get(service, RESULT_CACHE_EVICT_EVERY - 1) + 1
+        CACHE_STORES_SINCE_EVICT[service] = 0 if count >= RESULT_CACHE_EVICT_EVERY else count
+        return count >= RESULT_CACHE_EVICT_EVERY
+
+def evict_cache_overflow(minio_client, bucket_name, service, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Удаляет самые старые объекты кэша сервиса, пока его размер превышает max_bytes."""
+    cached_objects = list(minio_client.list_objects(bucket_name, prefix=f"{RESULT_CACHE_PREFIX}/{service}/", recursive=True))
+    total_size = sum(obj.size for obj in cached_objects)
+    for obj in sorted(cached_objects, key=lambda o: o.last_modified):
+        if total_size <= max_bytes:
+            break
+        minio_client.remove_object(bucket_name, obj.object_name)
+        total_size -= obj.size
+        logger.info(f"Объект кэша {obj.object_name} удалён (превышен лимит {max_bytes} байт)")
+
+def _start_ffmpeg_decoder(source, sample_rate, channels, feed=None):
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-threads", "0", "-i", source,
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_chunks = []
+    threads = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+    if feed:
+        threads.append(threading.Thread(target=feed, args=(process.stdin,), daemon=True))
+    for thread in threads:
+        thread.start()
+    return process, threads, stderr_chunks
+
+def _finish_ffmpeg_decoder(process, threads, stderr_chunks):
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if process.returncode != 0:
+        stderr = b"".join(stderr_chunks).decode(errors='replace').strip()
+        raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {stderr[-500:]}")
+
+def _run_ffmpeg_decoder(source, sample_rate, channels, feed=None):
+    process, threads, stderr_chunks = _start_ffmpeg_decoder(source, sample_rate, channels, feed)
+    pcm = bytearray()
+    for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b''):
+        pcm += chunk
+    _finish_ffmpeg_decoder(process, threads, stderr_chunks)
+    return np.frombuffer(pcm, dtype=np.float32).reshape(-1, channels).T
+
+def _make_object_feed(minio_client, bucket_name, object_name, digest, feed_errors, network_seconds):
+    """Функция для потока, который пишет тело get_object в stdin ffmpeg и попутно считает SHA-256."""
+    def feed(stdin):
+        response = None
+        try:
+            read_started = time.monotonic()
+            response = minio_client.get_object(bucket_name, object_name)
+            for chunk in response.stream(STREAM_CHUNK_SIZE):
+                network_seconds[0] += time.monotonic() - read_started
+                digest.update(chunk)
+                stdin.write(chunk)
+                read_started = time.monotonic()
+        except BrokenPipeError:
+            pass # ffmpeg завершился раньше; причину покажет его код возврата
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+            if response is not None:
+                response.close()
+                response.release_conn()
+    return feed
+
+def decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
+    """
+    Декодирует объект MinIO в float32 [channels, samples] без временных файлов: тело get_object
+    по частям подаётся в stdin ffmpeg, попутно считается SHA-256 для ключа кэша.
+    Возвращает (audio, sha256_hex); для контейнеров, которые нельзя читать из потока
+    (например, MP4 с индексом в конце), ffmpeg читает объект по presigned URL, и хеш не считается.
+    """
+    decode_started = time.monotonic()
+    digest = hashlib.sha256()
+    feed_errors = []
+    network_seconds = [0.0]
+    feed = _make_object_feed(minio_client, bucket_name, object_name, digest, feed_errors, network_seconds)
+
+    try:
+        audio = _run_ffmpeg_decoder("pipe:0", sample_rate, channels, feed)
+    except RuntimeError as e:
+        if feed_errors:
+            raise feed_errors[0]
+        logger.warning(f"Задача {task_id}: Не удалось декодировать s3://{bucket_name}/{object_name} из потока ({e}), чтение по presigned URL")
+        url = minio_client.presigned_get_object(bucket_name, object_name, expires=timedelta(hours=1))
+        audio = _run_ffmpeg_decoder(url, sample_rate, channels)
+        observe_stage("decode", time.monotonic() - decode_started)
+        return audio, None
+    if feed_errors:
+        raise feed_errors[0]
+    observe_stage("download", network_seconds[0])
+    observe_stage("decode", time.monotonic() - decode_started)
+    return audio, digest.hexdigest()
+
+class ObjectAudioStream:
+    """
+    Потоковый вариант decode_object_audio: объект MinIO декодируется в блоки float32 [channels, frames]
+    по block_frames, и в памяти не бывает больше одного блока. После исчерпания итератора frames
+    содержит длину записи, а sha256 - хеш объекта (None, если пришлось читать по presigned URL).
+    """
+
+    def __init__(self, minio_client, bucket_name, object_name, sample_rate, channels, block_frames, task_id="N/A"):
+        self.minio_client = minio_client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_frames = block_frames
+        self.task_id = task_id
+        self.frames = 0
+        self.sha256 = None
+
+    def __iter__(self):
+        digest = hashlib.sha256()
+        feed_errors = []
+        feed = _make_object_feed(self.minio_client, self.bucket_name, self.object_name, digest, feed_errors, [0.0])
+        try:
+            yield from self._decode("pipe:0", feed)
+        except RuntimeError as e:
+            if feed_errors:
+                raise feed_errors[0]
+            if self.frames:
+                raise
+            logger.warning(f"Задача {self.task_id}: Не удалось декодировать s3://{self.bucket_name}/{self.object_name} из потока ({e}), чтение по presigned URL")
+            url = self.minio_client.presigned_get_object(self.bucket_name, self.object_name, expires=timedelta(hours=6))
+            yield from self._decode(url)
+            return
+        if feed_errors:
+            raise feed_errors[0]
+        self.sha256 = digest.hexdigest()
+
+    def _decode(self, source, feed=None):
+        process, threads, stderr_chunks = _start_ffmpeg_decoder(source, self.sample_rate, self.channels, feed)
+        block_bytes = self.block_frames * self.channels * 4
+        try:
+            for data in iter(lambda: process.stdout.read(block_bytes), b''):
+                block = np.frombuffer(data, dtype=np.float32).reshape(-1, self.channels).T
+                self.frames += block.shape[1]
+                yield block
+            _finish_ffmpeg_decoder(process, threads, stderr_chunks)
+        finally:
+            # Итерацию прервали (ошибка разделения или выгрузки): ffmpeg больше не нужен
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+def get_decoded_audio_key(minio_client, bucket_name, object_name):
+    """Ключ декодированного звука по ETag и размеру: одинаковые файлы под разными именами декодируются один раз."""
+    stat = minio_client.stat_object(bucket_name, object_name)
+    etag = stat.etag.strip('"')
+    return make_cache_key(f"etag:{etag}:{stat.size}", {"decoded_audio": 1})
+
+def get_decoded_audio_name(key, sample_rate, channels):
+    return f"{key}.{sample_rate}x{channels}"
+
+def read_object_bytes(minio_client, bucket_name, object_name):
+    response = minio_client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+def load_decoded_audio(key, sample_rate, channels, task_id="N/A"):
+    """
+    Ищет звук, уже декодированный другим этапом: в нужном формате, а для моно - также стерео
+    той же частоты (сводится в моно). Возвращает (audio, sha256_hex) или None.
+    """
+    for stored_channels in dict.fromkeys((channels, 2)):
+        name = get_decoded_audio_name(key, sample_rate, stored_channels)
+        try:
+            # Описание пишется последним: если его нет, массив ещё не сохранён целиком
+            with open(os.path.join(DECODED_AUDIO_DIR, f"{name}.json"), encoding='utf-8') as f:
+                meta = json.load(f)
+            # copy-on-write: страницы читаются с общего тома по мере обращения, изменения не попадают в файл
+            audio = np.load(os.path.join(DECODED_AUDIO_DIR, f"{name}.npy"), mmap_mode='c')
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"Задача {task_id}: Ошибка чтения декодированного звука {name}: {e}")
+            continue
+        if stored_channels != channels:
+            audio = audio.mean(axis=0, keepdims=True, dtype=np.float32)
+        logger.info(f"Задача {task_id}: Использован декодированный звук {name} ({audio.shape[-1] / sample_rate:.1f} с), ffmpeg не запускался")
+        return audio, meta.get("sha256")
+    return None
+
+def evict_decoded_audio_dir():
+    """Удаляет самые старые файлы из DECODED_AUDIO_DIR, пока их размер превышает DECODED_AUDIO_MAX_BYTES."""
+    entries = []
+    for entry in os.scandir(DECODED_AUDIO_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= DECODED_AUDIO_MAX_BYTES:
+            break
+        # Уже отображённый в память файл остаётся доступен процессу, который его открыл
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
+
+def store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id="N/A"):
+    """Сохраняет декодированный звук [channels, samples] для следующих этапов. Ошибки не влияют на задачу."""
+    name = get_decoded_audio_name(key, sample_rate, audio.shape[0])
+    meta = json.dumps({"sha256": sha256_hex, "sample_rate": sample_rate, "channels": audio.shape[0],
+                       "frames": audio.shape[-1], "created_at": time.time()}).encode('utf-8')
+    try:
+        os.makedirs(DECODED_AUDIO_DIR, exist_ok=True)
+        # Через временный файл и переименование: другой процесс не увидит недописанный массив
+        # np.save пишет заголовок и audio.data в файл напрямую; массив после ffmpeg уже float32 и сохраняется
+        # как есть (транспонированный - с fortran_order), без промежуточной копии в памяти
+        for suffix, write in ((".npy", lambda f: np.save(f, audio if audio.dtype == np.float32 else audio.astype(np.float32))),
+                              (".json", lambda f: f.write(meta))):
+            temp_path = os.path.join(DECODED_AUDIO_DIR, f".{name}.{uuid.uuid4().hex}{suffix}")
+            with open(temp_path, 'wb') as f:
+                write(f)
+            os.replace(temp_path, os.path.join(DECODED_AUDIO_DIR, f"{name}{suffix}"))
+        evict_decoded_audio_dir()
+        logger.info(f"Задача {task_id}: Декодированный звук сохранён для следующих этапов: {name}")
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось сохранить декодированный звук {name}: {e}")
+
+def decode_object_audio_shared(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
+    """
+    decode_object_audio с общим декодированным звуком: если файл уже декодировал другой этап, массив
+    берётся готовым, иначе файл декодируется, а результат сохраняется для следующих этапов. Сохранение
+    синхронное: массив не переживает задачу в фоновом потоке, а число одновременных записей ограничено числом задач.
+    Возвращает (audio, sha256_hex).
+    """
+    if not DECODED_AUDIO_ENABLED or not DECODED_AUDIO_DIR:
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    try:
+        key = get_decoded_audio_key(minio_client, bucket_name, object_name)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для декодированного звука: {e}")
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+
+    load_started = time.monotonic()
+    found = load_decoded_audio(key, sample_rate, channels, task_id)
+    if found is not None:
+        observe_stage("load_decoded", time.monotonic() - load_started)
+        return found
+
+    audio, sha256_hex = decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    with measure_stage("store_decoded"):
+        store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id)
+        # Demucs - первый этап конвейера, поэтому сразу готовит и формат Whisper (16 кГц моно)
+        if channels == 2:
+            mono = julius.resample_frac(torch.from_numpy(audio.mean(0, dtype=np.float32)), sample_rate, WHISPER_SAMPLE_RATE)
+            store_decoded_audio(key, mono.numpy()[None], WHISPER_SAMPLE_RATE, sha256_hex, task_id)
+            del mono
+    return audio, sha256_hex
+
+def make_wav_header(channels, frames, sample_rate):
+    data_size = frames * channels * 2
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
+                       sample_rate, sample_rate * channels * 2, channels * 2, 16, b'data', data_size)
+
+class WavStreamReader:
+    """
+    Файлоподобный источник для put_object: кодирует float32 [channels, samples] в WAV (PCM 16 бит)
+    блоками по мере чтения, поэтому полный файл результата не собирается ни на диске, ни в памяти.
+    """
+
+    def __init__(self, audio, sample_rate):
+        self.audio = audio
+        channels, self.frames = audio.shape
+        header = make_wav_header(channels, self.frames, sample_rate)
+        self.length = len(header) + self.frames * channels * 2
+        self._buffer = bytearray(header)
+        self._position = 0
+        self.encode_seconds = 0.0
+
+    def read(self, size=-1):
+        encode_started = time.monotonic()
+        while (size < 0 or len(self._buffer) < size) and self._position < self.frames:
+            block = self.audio[:, self._position:self._position + ENCODE_BLOCK_FRAMES]
+            self._position += block.shape[1]
+            self._buffer += (np.clip(block, -1.0, 1.0) * 32767).astype('<i2').T.tobytes()
+        self.encode_seconds += time.monotonic() - encode_started
+        size = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+class SpooledWavReader:
+    """
+    Файлоподобный источник для put_object из потока блоков float32 [channels, frames]. Размеры в заголовке WAV
+    должны быть известны до первого байта, поэтому PCM 16 бит сначала пишется во временный файл,
+    а выгружается после исчерпания потока: заголовок с точными размерами, затем данные из файла.
+    """
+
+    def __init__(self, blocks, sample_rate, channels):
+        self._file = tempfile.TemporaryFile()
+        frames = 0
+        encode_started = time.monotonic()
+        try:
+            for block in blocks:
+                self._file.write((np.clip(block, -1.0, 1.0) * 32767).astype('<i2').T.tobytes())
+                frames += block.shape[1]
+        except BaseException:
+            self._file.close()
+            raise
+        self.encode_seconds = time.monotonic() - encode_started
+        self._file.seek(0)
+        self._header = make_wav_header(channels, frames, sample_rate)
+        self.length = len(self._header) + frames * channels * 2
+
+    def read(self, size=-1):
+        data = self._header if size < 0 else self._header[:size]
+        self._header = self._header[len(data):]
+        if size < 0:
+            return data + self._file.read()
+        return data + self._file.read(size - len(data)) if len(data) < size else data
+
+    def close(self):
+        self._file.close()
+
+class EncodedAudioReader:
+    """
+    Файлоподобный источник для put_object: float32 [channels, samples] блоками подаётся в stdin ffmpeg,
+    а закодированный поток читается из его stdout. Размер результата заранее неизвестен.
+    Вместо массива можно передать итератор блоков [channels, frames] (тогда нужен channels):
+    он вычисляется в потоке подачи по мере того, как ffmpeg принимает данные.
+    """
+
+    def __init__(self, audio, sample_rate, ffmpeg_args, channels=None):
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "f32le", "-ar", str(sample_rate),
+               "-ac", str(channels or audio.shape[0]), "-i", "pipe:0", *ffmpeg_args, "pipe:1"]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.length = 0
+        self.encode_seconds = 0.0
+        self._stderr_chunks = []
+        self._feed_errors = []
+        self._threads = [threading.Thread(target=self._feed, args=(audio,), daemon=True),
+                         threading.Thread(target=lambda: self._stderr_chunks.append(self.process.stderr.read()), daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _feed(self, audio):
+        if isinstance(audio, np.ndarray):
+            blocks = (audio[:, position:position + ENCODE_BLOCK_FRAMES] for position in range(0, audio.shape[1], ENCODE_BLOCK_FRAMES))
+        else:
+            blocks = audio
+        try:
+            for block in blocks:
+                block = np.clip(block, -1.0, 1.0)
+                self.process.stdin.write(np.ascontiguousarray(block.T, dtype='<f4').tobytes())
+        except BrokenPipeError:
+            pass # ffmpeg завершился раньше; причину покажет его код возврата
+        except Exception as e:
+            # Источник блоков упал (декодирование или разделение): обрезанный файл не должен сойти за результат
+            self._feed_errors.append(e)
+            self.process.kill()
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        # Ожидание вывода ffmpeg - это время кодирования, которое не перекрылось с выгрузкой
+        encode_started = time.monotonic()
+        data = self.process.stdout.read(size)
+        self.encode_seconds += time.monotonic() - encode_started
+        self.length += len(data)
+        return data
+
+    def close(self):
+        """Дожидается завершения ffmpeg и бросает исключение, если кодирование не удалось."""
+        self.process.wait()
+        for thread in self._threads:
+            thread.join()
+        if self._feed_errors:
+            raise self._feed_errors[0]
+        if self.process.returncode != 0:
+            stderr = b"".join(self._stderr_chunks).decode(errors='replace').strip()
+            raise RuntimeError(f"ffmpeg завершился с кодом {self.process.returncode}: {stderr[-500:]}")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+def get_output_format():
+    """Описание формата результата: расширение файла, Content-Type и параметры кодирования."""
+    return OUTPUT_FORMATS[OUTPUT_FORMAT]
+
+def upload_audio_to_minio(minio_client, bucket_name, object_name, audio, sample_rate, channels=None):
+    """
+    Кодирует массив [channels, samples] в OUTPUT_FORMAT и выгружает multipart-загрузкой частями
+    по UPLOAD_PART_SIZE. Вместо массива можно передать итератор блоков с числом каналов channels:
+    тогда блоки вычисляются, кодируются и выгружаются конвейером. Возвращает размер файла в байтах.
+    """
+    upload_started = time.monotonic()
+    output_format = get_output_format()
+    streaming = not isinstance(audio, np.ndarray)
+    if output_format["ffmpeg_args"] is None and not streaming:
+        reader = WavStreamReader(audio, sample_rate)
+        minio_client.put_object(bucket_name, object_name, reader, reader.length,
+                                content_type=output_format["content_type"], part_size=UPLOAD_PART_SIZE)
+    elif output_format["ffmpeg_args"] is None:
+        # Поток блоков в WAV: выгрузка начинается только после разделения, когда известна длина записи
+        reader = SpooledWavReader(audio, sample_rate, channels)
+        try:
+            minio_client.put_object(bucket_name, object_name, reader, reader.length,
+                                    content_type=output_format["content_type"], part_size=UPLOAD_PART_SIZE)
+        finally:
+            reader.close()
+    else:
+        reader = EncodedAudioReader(audio, sample_rate, output_format["ffmpeg_args"], channels)
+        try:
+            minio_client.put_object(bucket_name, object_name, reader, -1,
+                                    content_type=output_format["content_type"], part_size=UPLOAD_PART_SIZE)
+        except Exception:
+            reader.abort()
+            raise
+        try:
+            reader.close()
+        except Exception:
+            # Объект уже выгружен, но поток мог оборваться: не оставляем битый файл
+            minio_client.remove_object(bucket_name, object_name)
+            raise
+    # В конвейере ожидание вывода ffmpeg включает разделение, поэтому этапы encode/upload не разделить
+    if not streaming:
+        observe_stage("encode", reader.encode_seconds)
+        observe_stage("upload", time.monotonic() - upload_started - reader.encode_seconds)
+    return reader.length
+
+def configure_torch_threads():
+    """Размеры пулов потоков torch; inter-op задаётся только до первой параллельной операции в процессе."""
+    if DEMUCS_CPU_THREADS > 0:
+        torch.set_num_threads(DEMUCS_CPU_THREADS)
+    if DEMUCS_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(DEMUCS_INTEROP_THREADS)
+        except RuntimeError as e:
+            logger.warning(f"Не удалось задать число inter-op потоков torch: {e}")
+
+def get_sub_models(model):
+    """Подмодели, которые apply_model вызывает по отдельности: у htdemucs_ft их несколько, у htdemucs одна."""
+    return list(model.models) if isinstance(model, BagOfModels) else [model]
+
+def get_export_dir(model_name):
+    """Экспорт основной модели лежит в DEMUCS_EXPORT_DIR, других (DEMUCS_FAST_MODEL) - рядом, в каталоге с именем модели."""
+    if model_name == DEMUCS_MODEL:
+        return DEMUCS_EXPORT_DIR
+    return os.path.join(os.path.dirname(os.path.normpath(DEMUCS_EXPORT_DIR)), model_name)
+
+def load_exported_demucs(model, model_name):
+    """
+    Подменяет forward подмоделей графами TorchScript из каталога экспорта. Объект модели остаётся
+    моделью demucs (источники, частота, сегмент), поэтому apply_model и его разбиение на сегменты не меняются.
+    """
+    export_dir = get_export_dir(model_name)
+    with open(os.path.join(export_dir, "export.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    sub_models = get_sub_models(model)
+    if meta["model"] != model_name or meta["sub_models"] != len(sub_models):
+        raise ValueError(f"Экспорт в {export_dir} сделан для {meta['model']} ({meta['sub_models']} подмоделей), "
+                         f"а загружена {model_name} ({len(sub_models)})")
+    for index, sub_model in enumerate(sub_models):
+        traced = torch.jit.load(os.path.join(export_dir, f"model_{index}.pt"), map_location="cpu")
+        sub_model.exported = traced
+        sub_model.forward = traced.forward
+    return meta
+
+def get_demucs_model(model_name=DEMUCS_MODEL):
+    """Возвращает модель Demucs, загружая её при первом обращении (для htdemucs_ft — весь ансамбль)."""
+    with DEMUCS_MODEL_LOCK:
+        if model_name not in DEMUCS_MODELS:
+            if DEMUCS_BACKEND not in SUPPORTED_DEMUCS_BACKENDS:
+                raise ValueError(f"Неизвестный DEMUCS_BACKEND '{DEMUCS_BACKEND}'. Допустимые значения: {', '.join(SUPPORTED_DEMUCS_BACKENDS)}")
+            if DEMUCS_BACKEND == "torchscript" and DEMUCS_DEVICE != "cpu":
+                raise ValueError("DEMUCS_BACKEND=torchscript рассчитан на CPU: укажите DEMUCS_DEVICE=cpu")
+            logger.info(f"Загрузка модели Demucs {model_name} ({DEMUCS_BACKEND}) на устройство {DEMUCS_DEVICE}...")
+            load_started = time.monotonic()
+            model = get_model(model_name)
+            model.to(DEMUCS_DEVICE)
+            model.eval()
+            if "vocals" not in model.sources:
+                raise ValueError(f"Модель {model_name} не выделяет дорожку vocals (источники: {model.sources})")
+            if DEMUCS_BACKEND == "torchscript":
+                meta = load_exported_demucs(model, model_name)
+                logger.info(f"Графы TorchScript загружены из {get_export_dir(model_name)} (квантование int8: {meta.get('quantized', False)})")
+            elif DEMUCS_QUANTIZE:
+                for sub_model in get_sub_models(model):
+                    torch.ao.quantization.quantize_dynamic(sub_model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True)
+            DEMUCS_MODELS[model_name] = model
+            logger.info(f"Модель Demucs {model_name} загружена за {time.monotonic() - load_started:.2f} с. Источники: {model.sources}, "
+                        f"потоков torch: {torch.get_num_threads()}")
+    return DEMUCS_MODELS[model_name]
+
+def separate_vocals(task_id, wav, tier, ref_stats=None):
+    """
+    Разделяет трек [channels, samples] моделью уровня качества tier, загруженной в процессе,
+    и возвращает только дорожку вокала в виде тензора [channels, samples].
+    ref_stats - (среднее, стандартное отклонение) моно-сигнала для нормализации; по умолчанию считаются по wav.
+    """
+    model = get_demucs_model(tier["model"])
+    # Нормализация как в demucs.separate: по среднему и стандартному отклонению моно-сигнала
+    if ref_stats is None:
+        ref = wav.mean(0)
+        ref_mean, ref_std = ref.mean(), ref.std() + 1e-8
+    else:
+        ref_mean, ref_std = ref_stats
+    wav = (wav - ref_mean) / ref_std
+
+    with INFERENCE_SLOTS, torch.no_grad(), measure_stage("inference"):
+        sources = apply_model(model, wav[None], device=DEMUCS_DEVICE, shifts=tier["shifts"],
+                              split=True, overlap=DEMUCS_OVERLAP, progress=False)[0]
+    vocals = sources[model.sources.index("vocals")] * ref_std + ref_mean
+    del sources
+    return vocals.cpu()
+
+def run_demucs_separation(task_id, wav, minio_client, output_bucket, output_object_name, tier):
+    """
+    Выполняет разделение в процессе воркера и выгружает вокал в MinIO потоком, минуя диск.
+    Возвращает (vocals, error): тензор вокала остаётся в памяти для совмещённой транскрипции.
+    """
+    samplerate = get_demucs_model(tier["model"]).samplerate
+    logger.info(f"Задача {task_id}: Разделение Demucs ({tier['model']}, shifts={tier['shifts']}, уровень {tier['name']}, "
+                f"устройство={DEMUCS_DEVICE}), {wav.shape[-1] / samplerate:.1f} с аудио")
+    try:
+        separation_started = time.monotonic()
+        # Как save_audio(clip='rescale'): масштабируем вниз, если вокал выходит за [-1, 1]
+        vocals = prevent_clip(separate_vocals(task_id, wav, tier), mode='rescale')
+        logger.info(f"Задача {task_id}: Обработка Demucs успешна за {time.monotonic() - separation_started:.2f} с.")
     except Exception as e:
         logger.exception(f"Задача {task_id}: Исключение во время выполнения Demucs: {e}")
         return None, {"error_message": f"Исключение при выполнении Demucs: {str(e)}"}
 
-def process_single_task(task_id, input_bucket, input_object_name, output_file_basename):
-    # ... (код без изменений)
-    with tempfile.TemporaryDirectory(prefix="demucs_worker_") as temp_dir:
-        local_input_dir = os.path.join(temp_dir, "input")
-        local_output_base_dir = os.path.join(temp_dir, "output")
-        os.makedirs(local_input_dir, exist_ok=True)
-        os.makedirs(local_output_base_dir, exist_ok=True)
-
-        _, file_extension = os.path.splitext(input_object_name)
-        local_input_filename = f"{task_id}{file_extension}"
-        local_input_path = os.path.join(local_input_dir, local_input_filename)
-
-        # 1. Скачать файл из MinIO
-        logger.info(f"Задача {task_id}: Загрузка s3://{input_bucket}/{input_object_name} в {local_input_path}")
-        minio_client_instance = get_minio_client()
+    logger.info(f"Задача {task_id}: Выгрузка вокала в s3://{output_bucket}/{output_object_name}")
+    try:
+        uploaded_bytes = upload_audio_to_minio(minio_client, output_bucket, output_object_name,
+                                               vocals.numpy(), samplerate)
+        logger.info(f"Задача {task_id}: Результат успешно загружен в MinIO ({uploaded_bytes} байт).")
+    except S3Error as e:
+        logger.error(f"Задача {task_id}: Ошибка выгрузки в MinIO: {e}")
+        return None, {"error_message": f"Ошибка выгрузки в MinIO: {str(e)}", "details": {"bucket": output_bucket, "object": output_object_name}}
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: Исключение во время выгрузки в MinIO: {e}")
+        return None, {"error_message": f"Исключение при выгрузке в MinIO: {str(e)}"}
+    return vocals, None
+
+def _stream_worker_init(cpu_threads):
+    # Выполняется в дочернем процессе пула: делим ядра между процессами и загружаем модель заранее
+    torch.set_num_threads(cpu_threads)
+    get_demucs_model()
+
+def _separate_window(task_id, tier, window, ref_stats):
+    # np.array: блоки декодера доступны только для чтения, torch.from_numpy их не принимает
+    return separate_vocals(task_id, torch.from_numpy(np.array(window)), tier, ref_stats).numpy()
+
+def _run_inline(function, *args):
+    future = Future()
+    future.set_result(function(*args))
+    return future
+
+def get_stream_executor():
+    global STREAM_EXECUTOR
+    if STREAM_EXECUTOR is None:
+        # spawn: форк процесса с уже загруженным torch и его пулами потоков небезопасен
+        cpu_threads = DEMUCS_CPU_THREADS or max((os.cpu_count() or 1) // DEMUCS_STREAM_WORKERS, 1)
+        STREAM_EXECUTOR = ProcessPoolExecutor(max_workers=DEMUCS_STREAM_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=_stream_worker_init, initargs=(cpu_threads,))
+        logger.info(f"Пул для потокового разделения: процессов {DEMUCS_STREAM_WORKERS}, потоков torch на процесс {cpu_threads}")
+    return STREAM_EXECUTOR
+
+class RunningLevel:
+    """
+    Среднее и стандартное отклонение моно-сигнала по всем блокам, прочитанным до сих пор. Окна нормализуются
+    по этой оценке, а не каждое по своей: уровень не скачет между окнами и сходится к статистике всего трека.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+
+    def track(self, blocks):
+        for block in blocks:
+            mono = block.mean(0, dtype=np.float64)
+            self.count += mono.size
+            self.total += float(mono.sum())
+            self.total_squares += float(np.dot(mono, mono))
+            yield block
+
+    def stats(self):
+        mean = self.total / max(self.count, 1)
+        variance = max(self.total_squares / max(self.count, 1) - mean * mean, 0.0)
+        return mean, variance ** 0.5 + 1e-8
+
+def iter_windows(blocks, window_frames, hop_frames):
+    """Собирает поток блоков [channels, frames] в окна по window_frames с шагом hop_frames. Отдаёт (окно, последнее ли)."""
+    buffer = None
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate([buffer, block], axis=1)
+        # Строго больше окна: после него точно есть данные, и следующее окно длиннее перекрытия
+        while buffer.shape[1] > window_frames:
+            yield buffer[:, :window_frames], False
+            buffer = buffer[:, hop_frames:]
+    if buffer is not None and buffer.shape[1]:
+        yield buffer, True
+
+def iter_separated_vocals(task_id, blocks, samplerate, tier):
+    """
+    Разделяет поток блоков окнами DEMUCS_STREAM_WINDOW_SECONDS с перекрытием DEMUCS_STREAM_OVERLAP_SECONDS
+    и сшивает вокал линейным кроссфейдом на перекрытиях. Готовый вокал отдаётся блоками; в работе
+    не больше DEMUCS_STREAM_WORKERS окон. Окна нормализуются по накопленной статистике уровня (RunningLevel),
+    а вместо масштабирования всего трека (prevent_clip) отсчёты за пределами [-1, 1] обрезаются при кодировании.
+    """
+    window_frames = max(int(DEMUCS_STREAM_WINDOW_SECONDS * samplerate), 1)
+    overlap_frames = min(int(DEMUCS_STREAM_OVERLAP_SECONDS * samplerate), window_frames // 2)
+    if DEMUCS_STREAM_WORKERS > 1:
+        submit = functools.partial(get_stream_executor().submit, _separate_window, task_id, tier)
+    else:
+        submit = functools.partial(_run_inline, _separate_window, task_id, tier)
+
+    pending = deque()
+    tail = None
+    level = RunningLevel()
+    windows = iter_windows(level.track(blocks), window_frames, window_frames - overlap_frames)
+    while True:
+        window = next(windows, None)
+        if window is not None:
+            # К этому моменту прочитано всё окно, так что оценка уровня включает его целиком
+            pending.append((submit(window[0], level.stats()), window[1]))
+            if len(pending) < DEMUCS_STREAM_WORKERS:
+                continue
+        if not pending:
+            break
+        future, is_last = pending.popleft()
+        vocals = future.result()
+        if tail is not None:
+            ramp = ((np.arange(tail.shape[1], dtype=np.float32) + 0.5) / tail.shape[1])
+            vocals[:, :tail.shape[1]] = tail * (1.0 - ramp) + vocals[:, :tail.shape[1]] * ramp
+        if is_last or not overlap_frames:
+            tail = None
+            yield vocals
+        else:
+            # Конец окна ждёт кроссфейда со следующим окном
+            tail = vocals[:, -overlap_frames:].copy()
+            yield vocals[:, :-overlap_frames]
+
+def use_streaming_separation(minio_client, bucket_name, object_name, task_id="N/A"):
+    """Разделять ли запись окнами: решение принимается до скачивания, по длительности из ffprobe."""
+    if DEMUCS_STREAMING_MIN_SECONDS <= 0:
+        return False
+    duration = probe_object_duration(minio_client, bucket_name, object_name)
+    if duration is None:
+        logger.warning(f"Задача {task_id}: Не удалось определить длительность s3://{bucket_name}/{object_name}, разделение целиком")
+        return False
+    return duration >= DEMUCS_STREAMING_MIN_SECONDS
+
+def run_demucs_streaming_separation(task_id, minio_client, input_bucket, input_object_name, output_object_name, tier):
+    """
+    Потоковое разделение: чтение из MinIO, декодирование, разделение окнами, кодирование и multipart-выгрузка
+    идут конвейером. Возвращает (stream, error): после выгрузки у stream известны длина записи и SHA-256 входа.
+    """
+    model = get_demucs_model(tier["model"])
+    stream = ObjectAudioStream(minio_client, input_bucket, input_object_name, model.samplerate, model.audio_channels,
+                               ENCODE_BLOCK_FRAMES, task_id)
+    logger.info(f"Задача {task_id}: Потоковое разделение Demucs ({tier['model']}, уровень {tier['name']}, окно {DEMUCS_STREAM_WINDOW_SECONDS:.0f} с, "
+                f"перекрытие {DEMUCS_STREAM_OVERLAP_SECONDS:.0f} с, исполнителей: {DEMUCS_STREAM_WORKERS}) "
+                f"с выгрузкой в s3://{input_bucket}/{output_object_name}")
+    try:
+        separation_started = time.monotonic()
+        uploaded_bytes = upload_audio_to_minio(minio_client, input_bucket, output_object_name,
+                                               iter_separated_vocals(task_id, stream, model.samplerate, tier),
+                                               model.samplerate, channels=model.audio_channels)
+        logger.info(f"Задача {task_id}: Потоковое разделение {stream.frames / model.samplerate:.1f} с аудио завершено "
+                    f"за {time.monotonic() - separation_started:.2f} с, выгружено {uploaded_bytes} байт.")
+    except S3Error as e:
+        logger.error(f"Задача {task_id}: Ошибка MinIO при потоковом разделении: {e}")
+        return None, {"error_message": f"Ошибка MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: Исключение во время потокового разделения Demucs: {e}")
+        return None, {"error_message": f"Исключение при выполнении Demucs: {str(e)}"}
+    return stream, None
+
+def get_whisper_model():
+    """Возвращает модель Whisper для совмещённого режима, загружая её при первом обращении."""
+    global WHISPER_MODEL_INSTANCE
+    with WHISPER_MODEL_LOCK:
+        if WHISPER_MODEL_INSTANCE is None:
+            logger.info(f"Загрузка модели Whisper {WHISPER_MODEL_NAME} ({WHISPER_BACKEND}) на устройство {WHISPER_DEVICE}...")
+            load_started = time.monotonic()
+            if WHISPER_BACKEND == "faster_whisper":
+                if faster_whisper is None:
+                    raise RuntimeError("Пакет faster-whisper не установлен")
+                WHISPER_MODEL_INSTANCE = faster_whisper.WhisperModel(WHISPER_MODEL_NAME, device=WHISPER_DEVICE,
+                                                                     compute_type=WHISPER_COMPUTE_TYPE,
+                                                                     cpu_threads=WHISPER_CPU_THREADS,
+                                                                     num_workers=max(WHISPER_NUM_WORKERS, 1),
+                                                                     download_root=WHISPER_CACHE_DIR)
+            elif WHISPER_BACKEND == "openai":
+                if whisper is None:
+                    raise RuntimeError("Пакет openai-whisper не установлен")
+                WHISPER_MODEL_INSTANCE = whisper.load_model(WHISPER_MODEL_NAME, device=WHISPER_DEVICE, download_root=WHISPER_CACHE_DIR)
+            else:
+                raise ValueError(f"Неизвестный WHISPER_BACKEND '{WHISPER_BACKEND}'")
+            logger.info(f"Модель Whisper {WHISPER_MODEL_NAME} загружена за {time.monotonic() - load_started:.2f} с.")
+    return WHISPER_MODEL_INSTANCE
+
+def transcribe_vocals(task_id, vocals, samplerate):
+    """
+    Распознаёт вокал [channels, samples] прямо из памяти: сводит в моно и передискретизирует в 16 кГц.
+    Возвращает транскрипцию в формате результата whisper_worker или None при ошибке.
+    """
+    try:
+        transcription_started = time.monotonic()
+        audio = julius.resample_frac(vocals.mean(0), samplerate, WHISPER_SAMPLE_RATE).numpy().astype(np.float32)
+        model = get_whisper_model()
+        with INFERENCE_SLOTS, measure_stage("transcription"):
+            if WHISPER_BACKEND == "faster_whisper":
+                segments_iter, info = model.transcribe(audio, language=WHISPER_LANGUAGE, beam_size=WHISPER_BEAM_SIZE,
+                                                       vad_filter=WHISPER_VAD_FILTER)
+                # Сегменты декодируются лениво: итерация должна пройти внутри слота инференса
+                segments = [{"start": segment.start, "end": segment.end, "text": segment.text} for segment in segments_iter]
+                language = info.language
+            else:
+                result = model.transcribe(audio, language=WHISPER_LANGUAGE, fp16=WHISPER_DEVICE == "cuda")
+                segments = [{"start": segment["start"], "end": segment["end"], "text": segment["text"]} for segment in result["segments"]]
+                language = result.get("language")
+        logger.info(f"Задача {task_id}: Вокал распознан за {time.monotonic() - transcription_started:.2f} с "
+                    f"({len(audio) / WHISPER_SAMPLE_RATE:.1f} с аудио, сегментов: {len(segments)})")
+        return {"full_text": "".join(segment["text"] for segment in segments), "segments": segments, "language": language}
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: Не удалось распознать вокал в совмещённом режиме: {e}")
+        return None
+
+@functools.lru_cache(maxsize=None)
+def get_backend_cache_id(model_name):
+    """Экспорт и квантование меняют результат на уровне шума: такие результаты кэшируются отдельно от eager-модели."""
+    if DEMUCS_BACKEND == "torchscript":
+        with open(os.path.join(get_export_dir(model_name), "export.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        return {"name": "torchscript", "quantized": meta.get("quantized", False), "exported_at": meta.get("exported_at")}
+    return {"name": "eager", "quantized": DEMUCS_QUANTIZE} if DEMUCS_QUANTIZE else None
+
+def get_cache_params(tier):
+    """Параметры, от которых зависит результат разделения: входят в ключ кэша."""
+    return {"service": "demucs", "model": tier["model"], "backend": get_backend_cache_id(tier["model"]), "shifts": tier["shifts"],
+            "overlap": DEMUCS_OVERLAP, "stem": "vocals",
+            "format": OUTPUT_FORMAT, "opus_bitrate": OPUS_BITRATE if OUTPUT_FORMAT == "opus" else None,
+            "transcription": {"backend": WHISPER_BACKEND, "model": WHISPER_MODEL_NAME, "language": WHISPER_LANGUAGE,
+                              "beam_size": WHISPER_BEAM_SIZE, "vad_filter": WHISPER_VAD_FILTER} if FUSED_TRANSCRIPTION else None}
+
+class QualityGovernor:
+    """
+    Выбирает уровень качества по оценке очереди: переходит на 'fast', когда очередь разбиралась бы дольше
+    ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS, и возвращается на 'high' только ниже
+    ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS, не раньше чем через ADAPTIVE_QUALITY_MIN_HOLD_SECONDS.
+    Очередь оценивается в секундах работы на уровне high, поэтому ускорение на 'fast' само по себе не возвращает 'high'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tier = "high"
+        self.changed_at = time.monotonic()
+        self.task_seconds = ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS
+        self.task_samples = 0
+        self.backlog_seconds = 0.0
+
+    def observe_task(self, tier_name, seconds):
+        """Среднее время задачи (скользящее) по задачам уровня high, выполненным без кэша."""
+        if tier_name != "high":
+            return
+        with self.lock:
+            self.task_samples += 1
+            weight = max(0.2, 1.0 / self.task_samples)
+            self.task_seconds += weight * (seconds - self.task_seconds)
+
+    def update(self, queue_stats):
+        """queue_stats - пары (сообщений в очереди, потребителей очереди) по всем очередям задач воркера."""
+        with self.lock:
+            backlog = sum(messages * self.task_seconds / (max(consumers, 1) * WORKER_CONCURRENCY) for messages, consumers in queue_stats)
+            self.backlog_seconds = backlog
+            previous = self.tier
+            if time.monotonic() - self.changed_at >= ADAPTIVE_QUALITY_MIN_HOLD_SECONDS:
+                if previous == "high" and backlog >= ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:
+                    self.tier = "fast"
+                elif previous == "fast" and backlog <= ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS:
+                    self.tier = "high"
+            if self.tier != previous:
+                self.changed_at = time.monotonic()
+                logger.warning(f"Уровень качества: {previous} -> {self.tier} (очередь ~{backlog:.0f} с, "
+                               f"сообщений: {sum(messages for messages, _ in queue_stats)}, задача ~{self.task_seconds:.0f} с)")
+            if prometheus_client is not None:
+                BACKLOG_SECONDS.labels(METRICS_SERVICE).set(backlog)
+                QUALITY_DEGRADED.labels(METRICS_SERVICE).set(1 if self.tier != "high" else 0)
+
+QUALITY_GOVERNOR = QualityGovernor()
+
+def resolve_quality_tier(requested, task_id="N/A"):
+    """Уровень задачи: явно запрошенный в сообщении (повторный прогон в высоком качестве) или выбранный по очереди."""
+    if requested in QUALITY_TIERS:
+        return QUALITY_TIERS[requested]
+    if requested:
+        logger.warning(f"Задача {task_id}: Неизвестный quality_tier '{requested}', уровень выбирается по очереди")
+    return QUALITY_TIERS[QUALITY_GOVERNOR.tier] if ADAPTIVE_QUALITY else QUALITY_TIERS["high"]
+
+def schedule_backlog_checks(connection):
+    """
+    Раз в ADAPTIVE_QUALITY_CHECK_SECONDS опрашивает глубину очередей задач пассивным queue_declare.
+    Опрос идёт в потоке соединения на отдельном канале: ошибка 404 закрывает только его.
+    """
+    queues = [CONSUME_QUEUE] + [get_lane_queue(lane) for lane in TASK_LANES]
+    state = {"channel": None}
+
+    def check():
         try:
-            minio_client_instance.fget_object(input_bucket, input_object_name, local_input_path)
-        except S3Error as e:
-            logger.error(f"Задача {task_id}: Ошибка загрузки из MinIO: {e}")
-            return {"error_message": f"Ошибка загрузки из MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
+            if state["channel"] is None or not state["channel"].is_open:
+                state["channel"] = connection.channel()
+            queue_stats = []
+            for queue in queues:
+                frame = state["channel"].queue_declare(queue=queue, passive=True)
+                queue_stats.append((frame.method.message_count, frame.method.consumer_count))
+            QUALITY_GOVERNOR.update(queue_stats)
+        except pika.exceptions.ChannelClosed as e:
+            logger.warning(f"Не удалось получить глубину очередей {queues}: {e}")
+            state["channel"] = None
+        connection.call_later(ADAPTIVE_QUALITY_CHECK_SECONDS, check)
+
+    connection.call_later(0, check)
+
+def process_single_task(task_id, input_bucket, input_object_name, output_file_basename, tier=QUALITY_TIERS["high"]):
+    task_started = time.monotonic()
+    minio_client_instance = get_minio_client()
+    output_format = get_output_format()
+    minio_output_object_name = f"results/demucs/{output_file_basename}{output_format['extension']}"
+    success_result = {
+        "output_bucket_name": input_bucket,
+        "output_object_name": minio_output_object_name,
+        "output_format": OUTPUT_FORMAT,
+        "content_type": output_format["content_type"],
+        # Задачи уровня fast SoundService может позже повторить с quality_tier=high
+        "quality_tier": tier["name"],
+        "model_used": tier["model"],
+        "message": "Обработка Demucs успешно завершена."
+    }
+
+    # 0. Проверить кэш по ETag: при попадании файл даже не скачивается
+    cache_params = get_cache_params(tier)
+    etag_cache_key = get_etag_cache_key(minio_client_instance, input_bucket, input_object_name, cache_params, task_id)
+    manifest = lookup_cached_result(minio_client_instance, input_bucket, "demucs", etag_cache_key, task_id)
+    if manifest and restore_cached_artifact(minio_client_instance, input_bucket, manifest, minio_output_object_name, task_id):
+        return {**success_result, "cache_hit": True, "transcription": manifest["result"].get("transcription")}
 
-        # 2. Запустить Demucs
-        vocals_file_path, demucs_error = run_demucs_process(task_id, local_input_path, local_output_base_dir)
+    model = get_demucs_model(tier["model"])
+    # 0.1. Длинная запись: разделение окнами, не загружая трек в память целиком.
+    # Вокал целиком тоже не собирается, поэтому совмещённой транскрипции нет - её выполнит whisper_worker
+    if use_streaming_separation(minio_client_instance, input_bucket, input_object_name, task_id):
+        stream, demucs_error = run_demucs_streaming_separation(task_id, minio_client_instance, input_bucket,
+                                                               input_object_name, minio_output_object_name, tier)
         if demucs_error:
-            return demucs_error # Возвращаем словарь с ошибкой
+            return demucs_error
+        observe_realtime_factor(tier["model"], time.monotonic() - task_started, stream.frames / model.samplerate)
+        store_cached_result(minio_client_instance, input_bucket, "demucs",
+                            [etag_cache_key, get_content_cache_key(stream.sha256, cache_params)],
+                            {"message": success_result["message"]}, artifact_object=minio_output_object_name,
+                            artifact_suffix=output_format["extension"], task_id=task_id)
+        return {**success_result, "streamed": True, "transcription": None}
 
-        # 3. Загрузить результат в MinIO
-        minio_output_object_name = f"results/demucs/{output_file_basename}.wav"
-        logger.info(f"Задача {task_id}: Загрузка {vocals_file_path} в s3://{input_bucket}/{minio_output_object_name}")
-        try:
-            minio_client_instance.fput_object(
-                input_bucket,
-                minio_output_object_name,
-                vocals_file_path,
-                content_type='audio/wav'
-            )
-            logger.info(f"Задача {task_id}: Результат успешно загружен в MinIO.")
-            return {
-                "output_bucket_name": input_bucket,
-                "output_object_name": minio_output_object_name,
-                "message": "Обработка Demucs успешно завершена."
-            }
-        except S3Error as e:
-            logger.error(f"Задача {task_id}: Ошибка выгрузки в MinIO: {e}")
-            return {"error_message": f"Ошибка выгрузки в MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": minio_output_object_name}}
-        except Exception as e:
-            logger.exception(f"Задача {task_id}: Исключение во время выгрузки в MinIO: {e}")
-            return {"error_message": f"Исключение при выгрузке в MinIO: {str(e)}"}
+    # 1. Декодировать файл прямо из потока MinIO (без временного файла)
+    logger.info(f"Задача {task_id}: Чтение s3://{input_bucket}/{input_object_name}")
+    try:
+        wav, content_sha256 = decode_object_audio_shared(minio_client_instance, input_bucket, input_object_name,
+                                                  model.samplerate, model.audio_channels, task_id)
+    except S3Error as e:
+        logger.error(f"Задача {task_id}: Ошибка загрузки из MinIO: {e}")
+        return {"error_message": f"Ошибка загрузки из MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: Не удалось декодировать входной файл: {e}")
+        return {"error_message": f"Не удалось декодировать входной файл: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
+
+    # 1.1. Проверить кэш по содержимому: тот же файл мог быть загружен под другим именем
+    content_cache_key = get_content_cache_key(content_sha256, cache_params)
+    manifest = lookup_cached_result(minio_client_instance, input_bucket, "demucs", content_cache_key, task_id)
+    if manifest and restore_cached_artifact(minio_client_instance, input_bucket, manifest, minio_output_object_name, task_id):
+        link_cached_result(minio_client_instance, input_bucket, "demucs", manifest, etag_cache_key, task_id)
+        return {**success_result, "cache_hit": True, "transcription": manifest["result"].get("transcription")}
+
+    # 2-3. Запустить Demucs и выгрузить вокал в MinIO
+    audio_seconds = wav.shape[-1] / model.samplerate
+    vocals, demucs_error = run_demucs_separation(task_id, torch.from_numpy(wav), minio_client_instance, input_bucket,
+                                                 minio_output_object_name, tier)
+    del wav
+    if demucs_error:
+        return demucs_error # Возвращаем словарь с ошибкой
+
+    # 4. Совмещённый режим: распознать вокал из памяти, без повторного скачивания и отдельной задачи
+    transcription = transcribe_vocals(task_id, vocals, model.samplerate) if FUSED_TRANSCRIPTION else None
+    del vocals
+    observe_realtime_factor(tier["model"], time.monotonic() - task_started, audio_seconds)
+
+    cached_result = {"message": success_result["message"]}
+    if transcription:
+        cached_result["transcription"] = transcription
+    # Без транскрипции в совмещённом режиме кэшировать нельзя: повторная задача должна попробовать распознать снова
+    if transcription or not FUSED_TRANSCRIPTION:
+        store_cached_result(minio_client_instance, input_bucket, "demucs", [etag_cache_key, content_cache_key],
+                            cached_result, artifact_object=minio_output_object_name,
+                            artifact_suffix=get_output_format()["extension"], task_id=task_id)
+    return {**success_result, "transcription": transcription}
+
+def serialize_transcription_json(transcription):
+    """Байты transcription_detailed.json с учётом TRANSCRIPTION_JSON_COMPRESSION: (данные, суффикс имени, Content-Encoding)."""
+    detailed = {"full_text": transcription["full_text"], "segments": transcription["segments"]}
+    if TRANSCRIPTION_JSON_COMPRESSION == "gzip":
+        data = json.dumps(detailed, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+        return gzip.compress(data, compresslevel=6, mtime=0), ".gz", "gzip"
+    return json.dumps(detailed, ensure_ascii=False, indent=2).encode('utf-8'), "", None
+
+def upload_transcription_json(minio_client, bucket_name, file_stem, transcription, task_id):
+    """Выгружает транскрипцию вокала так же, как whisper_worker. Возвращает описание объекта: имя, sha256, размер, кодировку, выгружен ли он."""
+    data, suffix, content_encoding = serialize_transcription_json(transcription)
+    object_name = f"{WHISPER_OUTPUT_FOLDER}/{file_stem}_transcription_detailed.json{suffix}"
+    artifact = {"object_name": object_name, "sha256": hashlib.sha256(data).hexdigest(),
+                "size_bytes": len(data), "content_encoding": content_encoding, "uploaded": False}
+    try:
+        minio_client.put_object(bucket_name, object_name, io.BytesIO(data), len(data), content_type='application/json',
+                                metadata={"Content-Encoding": content_encoding} if content_encoding else None)
+        artifact["uploaded"] = True
+        logger.info(f"Задача {task_id}: Транскрипция вокала загружена в s3://{bucket_name}/{object_name}")
+    except Exception as e:
+        logger.error(f"Задача {task_id}: Не удалось загрузить транскрипцию {object_name} в MinIO: {e}")
+    return artifact
+
+def should_inline_transcription(transcription, artifact, task_id):
+    """Класть ли текст и сегменты в сообщение (см. RESULT_PAYLOAD_MODE). Без выгруженного JSON ссылаться не на что."""
+    if RESULT_PAYLOAD_MODE == "inline":
+        return True
+    if not artifact["uploaded"]:
+        logger.warning(f"Задача {task_id}: JSON транскрипции не выгружен, текст передаётся прямо в сообщении")
+        return True
+    if RESULT_PAYLOAD_MODE == "reference":
+        return False
+    size = len(json.dumps({"full_text": transcription["full_text"], "segments": transcription["segments"]},
+                          ensure_ascii=False, separators=(",", ":")).encode('utf-8'))
+    return size <= RESULT_INLINE_MAX_BYTES
+
+def publish_transcription_result(channel, task_id, input_bucket, original_input_object, demucs_result, transcription):
+    """
+    Публикует транскрипцию вокала с ключом результатов whisper_worker и в его формате: окончательный результат
+    (result_kind=final, revision=1), ссылка на transcription_detailed.json с контрольной суммой и текст по RESULT_PAYLOAD_MODE.
+    """
+    file_stem = os.path.splitext(os.path.basename(demucs_result["output_object_name"]))[0]
+    with measure_stage("upload"):
+        artifact = upload_transcription_json(get_minio_client(), input_bucket, file_stem, transcription, task_id)
+    whisper_result = {
+        "input_bucket": input_bucket, "input_object": original_input_object,
+        "processed_object": demucs_result["output_object_name"], "result_kind": "final", "revision": 1,
+        "tool_version": getattr(faster_whisper if WHISPER_BACKEND == "faster_whisper" else whisper, "__version__", "unknown"),
+        "backend": WHISPER_BACKEND, "model_used": WHISPER_MODEL_NAME,
+        "cache_hit": demucs_result.get("cache_hit", False), "fused_with": "demucs", "quality_tier": demucs_result.get("quality_tier"),
+        "transcription_detailed_json_object_path": f"s3://{input_bucket}/{artifact['object_name']}",
+        "transcription_sha256": artifact["sha256"], "transcription_size_bytes": artifact["size_bytes"],
+        "transcription_content_encoding": artifact["content_encoding"],
+        "segments_count": len(transcription["segments"]), "full_text_length": len(transcription["full_text"]),
+        "language_requested": WHISPER_LANGUAGE, "language_detected_by_model": transcription.get("language"),
+    }
+    if should_inline_transcription(transcription, artifact, task_id):
+        whisper_result.update(result_payload="inline", full_text=transcription["full_text"], segments=transcription["segments"])
+    else:
+        whisper_result["result_payload"] = "reference"
+    publish_processing_result(channel, task_id, "success", whisper_result, service="whisper", routing_key=WHISPER_RESULT_ROUTING_KEY)
 
 # Код on_message_callback остается почти без изменений
 def on_message_callback(channel, method_frame, properties, body):
@@ -227,10 +1482,19 @@ def on_message_callback(channel, method_frame, properties, body):
         logger.info(f"Задача {task_id_from_msg}: Обработка s3://{input_bucket}/{input_object}")
         logger.info(f"Устройство для Demucs: {DEMUCS_DEVICE}. Версия PyTorch: {torch.__version__}. CUDA доступно: {torch.cuda.is_available()}")
 
-        result_payload = process_single_task(task_id_from_msg, input_bucket, input_object, output_basename)
+        tier = resolve_quality_tier(task_data.get("quality_tier"), task_id_from_msg)
+        task_started = time.monotonic()
+        result_payload = process_single_task(task_id_from_msg, input_bucket, input_object, output_basename, tier)
+        if "error_message" not in result_payload and not result_payload.get("cache_hit"):
+            QUALITY_GOVERNOR.observe_task(tier["name"], time.monotonic() - task_started)
 
         if "error_message" not in result_payload:
             result_payload["original_input_object"] = original_input_path
+            transcription = result_payload.pop("transcription", None)
+            if transcription:
+                publish_transcription_result(channel, task_id_from_msg, input_bucket, original_input_path, result_payload, transcription)
+            # SoundService ставит задачу в whisper_worker, только если транскрипции нет в этом результате
+            result_payload["transcription_included"] = bool(transcription)
 
         if "error_message" in result_payload:
             publish_processing_result(channel, task_id_from_msg, "error", result_payload)
@@ -255,29 +1519,362 @@ def on_message_callback(channel, method_frame, properties, body):
             logger.error(f"Не удалось опубликовать критическое сообщение об ошибке для задачи {task_id_from_msg}: {pub_e}")
         channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
 
-# ИСПРАВЛЕНО: main() теперь проще и надежнее, как в whisper_worker
-def main():
-    logger.info(f"Demucs Worker запускается... Устройство: {DEMUCS_DEVICE}")
-    logger.info(f"Слушает очередь '{CONSUME_QUEUE}'")
-    logger.info(f"Публикует результаты в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
+class TaskDelivery:
+    """
+    Доставка задачи, которую обрабатывает рабочий поток. Канал BlockingConnection нельзя
+    трогать вне потока соединения, поэтому publish/ack/nack копятся и по завершении задачи
+    одним пакетом передаются в поток соединения через add_callback_threadsafe.
+
+    Если соединение оборвалось во время инференса, брокер доставит сообщение повторно
+    (redelivered=True): доставка перепривязывается к новому каналу и результат уходит
+    уже по нему, а задача не выполняется второй раз.
+    """
+
+    def __init__(self, task_key, connection, channel, delivery_tag):
+        self.task_key = task_key
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+        self._operations = []
+
+    @property
+    def is_open(self):
+        # Операции копятся и отправляются по актуальной привязке, поэтому доставка всегда их принимает
+        return True
+
+    def rebind(self, connection, channel, delivery_tag):
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+
+    def basic_publish(self, **kwargs):
+        self._operations.append(("basic_publish", kwargs))
+
+    def basic_ack(self, **kwargs):
+        self._operations.append(("basic_ack", kwargs))
+        self._flush()
+
+    def basic_nack(self, **kwargs):
+        self._operations.append(("basic_nack", kwargs))
+        self._flush()
+
+    def _flush(self):
+        operations, self._operations = self._operations, []
+        with DELIVERY_LOCK:
+            INFLIGHT_TASKS.pop(self.task_key, None)
+            # Результат запоминается до передачи в поток соединения: если соединение оборвётся раньше,
+            # чем callback выполнится, он будет отброшен, а повторная доставка должна найти готовый результат
+            remember_completed_task(self.task_key, operations)
+            try:
+                if not self._connection.is_open:
+                    raise ConnectionError("соединение закрыто")
+                self._connection.add_callback_threadsafe(
+                    functools.partial(replay_operations, self.task_key, self._channel, self._delivery_tag, operations))
+            except Exception as e:
+                logger.warning(f"Задача {self.task_key}: результат сохранён до повторной доставки сообщения ({e}).")
 
+def remember_completed_task(task_key, operations):
+    COMPLETED_TASKS[task_key] = operations
+    while len(COMPLETED_TASKS) > COMPLETED_TASKS_MAX:
+        COMPLETED_TASKS.popitem(last=False)
+
+def replay_operations(task_key, channel, delivery_tag, operations):
+    """
+    Выполняется в потоке соединения: публикует результаты задачи и подтверждает доставку.
+    Сохранённый результат удаляется из COMPLETED_TASKS только после успешного подтверждения,
+    до этого его найдёт повторная доставка.
+    """
     try:
-        get_minio_client()
+        for method_name, kwargs in operations:
+            if method_name != "basic_publish":
+                kwargs = {**kwargs, "delivery_tag": delivery_tag}
+            getattr(channel, method_name)(**kwargs)
     except Exception as e:
-        logger.critical(f"Критическая ошибка: Не удалось подключиться к MinIO при старте: {e}. Воркер не будет запущен.")
+        logger.warning(f"Задача {task_key}: не удалось отправить результат ({e}), он будет отправлен при повторной доставке.")
         return
+    with DELIVERY_LOCK:
+        if COMPLETED_TASKS.get(task_key) is operations:
+            del COMPLETED_TASKS[task_key]
+
+def get_task_key(properties, body):
+    return (properties and properties.message_id) or hashlib.sha256(body).hexdigest()
+
+def get_consumer_arguments():
+    # Подтверждение приходит только после выгрузки результата, поэтому для часовых записей
+    # тайм-аут брокера на ack (по умолчанию 30 минут) может понадобиться увеличить
+    return {"x-consumer-timeout": RABBITMQ_CONSUMER_TIMEOUT_MS} if RABBITMQ_CONSUMER_TIMEOUT_MS > 0 else None
+
+def get_task_executor():
+    global TASK_EXECUTOR
+    if TASK_EXECUTOR is None:
+        # В режиме полос каждая получает свои слоты, чтобы короткая задача не ждала в пуле за длинными
+        max_workers = sum(get_lane_slots().values()) if TASK_LANES else WORKER_CONCURRENCY
+        TASK_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+    return TASK_EXECUTOR
+
+def get_router_executor():
+    global ROUTER_EXECUTOR
+    if ROUTER_EXECUTOR is None:
+        # Отдельный пул: классификация не ждёт в пуле задач за инференсом
+        ROUTER_EXECUTOR = ThreadPoolExecutor(max_workers=LANE_ROUTER_WORKERS, thread_name_prefix="router")
+    return ROUTER_EXECUTOR
+
+def get_lane_slots():
+    """
+    Слоты полос (prefetch их каналов): WORKER_CONCURRENCY делится по весам так, что в сумме слотов ровно
+    WORKER_CONCURRENCY и у каждой полосы хотя бы один слот (число полос проверяется при старте).
+    """
+    total_weight = sum(TASK_LANES.values())
+    spare = WORKER_CONCURRENCY - len(TASK_LANES)
+    shares = {lane: spare * weight / total_weight for lane, weight in TASK_LANES.items()}
+    slots = {lane: 1 + int(share) for lane, share in shares.items()}
+    # Оставшиеся слоты - полосам с наибольшей дробной частью доли
+    by_remainder = sorted(shares, key=lambda lane: shares[lane] - int(shares[lane]), reverse=True)
+    for lane in by_remainder[:WORKER_CONCURRENCY - sum(slots.values())]:
+        slots[lane] += 1
+    return slots
+
+def get_lane_queue(lane):
+    return f"{CONSUME_QUEUE}.{lane}"
+
+def get_lane_routing_key(lane):
+    return f"{CONSUME_ROUTING_KEY}.{lane}"
+
+def probe_object_duration(minio_client, bucket_name, object_name):
+    """Длительность записи по заголовку файла: ffprobe читает по presigned URL только начало объекта."""
+    url = minio_client.presigned_get_object(bucket_name, object_name, expires=timedelta(minutes=10))
+    try:
+        completed = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", url],
+                                   capture_output=True, text=True, timeout=LANE_PROBE_TIMEOUT_SECONDS, check=True)
+        return float(completed.stdout.strip())
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+def classify_task_lane(task_data):
+    """Полоса задачи по длительности записи, а если её не узнать - по размеру объекта. Возвращает (полоса, причина)."""
+    input_bucket = task_data.get("input_bucket_name") or MINIO_DEFAULT_BUCKET
+    input_object = task_data.get("input_object_name") or task_data.get("MinioFilePath")
+    minio_client_instance = get_minio_client()
+    object_size = minio_client_instance.stat_object(input_bucket, input_object).size
+    if LANE_PROBE_DURATION:
+        duration = probe_object_duration(minio_client_instance, input_bucket, input_object)
+        if duration is not None:
+            return ("fast" if duration <= LANE_FAST_MAX_SECONDS else "bulk"), f"длительность {duration:.0f} с"
+    return ("fast" if object_size <= LANE_FAST_MAX_BYTES else "bulk"), f"размер {object_size} байт"
+
+def route_message(channel, method_frame, properties, body, connection):
+    """
+    Выполняется в потоке соединения: задача из общей очереди перекладывается в очередь своей полосы.
+    stat_object и ffprobe могут занять до LANE_PROBE_TIMEOUT_SECONDS, поэтому классификация идёт
+    в отдельном пуле, а в поток соединения возвращаются только публикация и подтверждение.
+    """
+    get_router_executor().submit(_classify_in_pool, connection, channel, method_frame, properties, body)
+
+def _classify_in_pool(connection, channel, method_frame, properties, body):
+    task_id = properties.correlation_id or properties.message_id or "unknown_task"
+    try:
+        task_data = json.loads(body.decode('utf-8'))
+        task_id = task_data.get("task_id") or task_data.get("TaskId") or task_id
+        lane, reason = classify_task_lane(task_data)
+    except Exception as e:
+        # Битое сообщение или отсутствующий файл: ошибку быстрее сообщит воркер быстрой полосы
+        lane, reason = "fast", f"полоса не определена: {e}"
+    try:
+        connection.add_callback_threadsafe(functools.partial(publish_to_lane, connection, channel, method_frame.delivery_tag,
+                                                             properties, body, task_id, lane, reason))
+    except Exception as e:
+        # Соединение закрыто: неподтверждённое сообщение брокер доставит повторно
+        logger.warning(f"Задача {task_id}: не удалось направить в полосу '{lane}' ({e}), задача будет доставлена повторно")
+
+def publish_to_lane(connection, channel, delivery_tag, properties, body, task_id, lane, reason):
+    """
+    Выполняется в потоке соединения. Канал работает с подтверждениями публикации, поэтому исходное сообщение
+    подтверждается только после того, как брокер принял копию. Непринятая задача возвращается в общую очередь
+    через LANE_ROUTE_RETRY_SECONDS, а не сразу, чтобы не крутиться в цикле повторных доставок.
+    """
+    if not channel.is_open:
+        return
+    lane_properties = copy.copy(properties)
+    lane_properties.headers = {**(properties.headers or {}), "x-task-lane": lane}
+    try:
+        channel.basic_publish(exchange=CONSUME_EXCHANGE, routing_key=get_lane_routing_key(lane), body=body,
+                              properties=lane_properties, mandatory=True)
+    except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+        logger.error(f"Задача {task_id}: брокер не принял задачу в полосу '{lane}' ({e}), "
+                     f"она вернётся в общую очередь через {LANE_ROUTE_RETRY_SECONDS:.0f} с")
+
+        def requeue():
+            # Если канал успел закрыться, брокер уже вернул сообщение в очередь сам
+            if channel.is_open:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+        connection.call_later(LANE_ROUTE_RETRY_SECONDS, requeue)
+        return
+    channel.basic_ack(delivery_tag=delivery_tag)
+    logger.info(f"Задача {task_id}: направлена в полосу '{lane}' ({reason})")
+
+def consume_task_lanes(connection, channel):
+    """
+    Объявляет очереди всех полос и подписывается на свои. У каждой полосы отдельный канал с prefetch,
+    равным числу её слотов: длинные записи занимают только слоты bulk, и для короткой задачи
+    всегда остаётся свободный слот. Общую очередь при TASK_LANE_ROUTER разбирает route_message.
+    """
+    for lane in SUPPORTED_TASK_LANES:
+        channel.queue_declare(queue=get_lane_queue(lane), durable=True)
+        channel.queue_bind(exchange=CONSUME_EXCHANGE, queue=get_lane_queue(lane), routing_key=get_lane_routing_key(lane))
+
+    lane_channels = []
+    for lane, slots in get_lane_slots().items():
+        lane_channel = connection.channel()
+        lane_channels.append(lane_channel)
+        lane_channel.basic_qos(prefetch_count=slots)
+        lane_channel.basic_consume(
+            queue=get_lane_queue(lane),
+            on_message_callback=functools.partial(dispatch_message, connection=connection),
+            arguments=get_consumer_arguments()
+        )
+        logger.info(f"[*] Полоса '{lane}': очередь '{get_lane_queue(lane)}', слотов: {slots}")
+
+    if TASK_LANE_ROUTER:
+        channel.confirm_delivery()
+        channel.basic_qos(prefetch_count=LANE_ROUTER_WORKERS)
+        channel.basic_consume(queue=CONSUME_QUEUE, on_message_callback=functools.partial(route_message, connection=connection))
+        logger.info(f"[*] Задачи из общей очереди '{CONSUME_QUEUE}' распределяются по полосам "
+                    f"(fast: до {LANE_FAST_MAX_SECONDS:.0f} с или до {LANE_FAST_MAX_BYTES} байт)")
+    return lane_channels + [channel]
+
+def _run_task_in_pool(delivery, method_frame, properties, body):
+    observe_queue_wait(properties)
+    try:
+        on_message_callback(delivery, method_frame, properties, body)
+    except Exception as e:
+        logger.exception(f"Необработанное исключение в рабочем потоке (delivery_tag={method_frame.delivery_tag}): {e}")
+        delivery.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
+
+def dispatch_message(channel, method_frame, properties, body, connection):
+    """Выполняется в потоке соединения: передаёт задачу в пул, не блокируя ввод-вывод и heartbeat RabbitMQ."""
+    task_key = get_task_key(properties, body)
+    with DELIVERY_LOCK:
+        if method_frame.redelivered:
+            # Не извлекается: replay_operations удалит результат сам, когда подтверждение пройдёт
+            completed_operations = COMPLETED_TASKS.get(task_key)
+            if completed_operations is not None:
+                logger.info(f"Задача {task_key}: повторная доставка уже обработанной задачи, отправляется сохранённый результат.")
+                replay_operations(task_key, channel, method_frame.delivery_tag, completed_operations)
+                return
+            inflight = INFLIGHT_TASKS.get(task_key)
+            if inflight is not None:
+                logger.info(f"Задача {task_key}: повторная доставка задачи, которая ещё выполняется. Результат будет отправлен по новой доставке.")
+                inflight.rebind(connection, channel, method_frame.delivery_tag)
+                return
+        if task_key in INFLIGHT_TASKS:
+            task_key = f"{task_key}:{uuid.uuid4()}"
+        delivery = TaskDelivery(task_key, connection, channel, method_frame.delivery_tag)
+        INFLIGHT_TASKS[task_key] = delivery
+    get_task_executor().submit(_run_task_in_pool, delivery, method_frame, properties, body)
 
+# ИСПРАВЛЕНО: main() теперь проще и надежнее, как в whisper_worker
+def init_forked_child(slot):
+    """Выполняется в дочернем процессе сразу после fork: всё, что нельзя делить с родителем, создаётся заново."""
+    global MINIO_CLIENT, METRICS_PORT
+    # Обработчики супервизора не наследуются: SIGTERM завершает процесс, CTRL+C даёт KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Пул HTTP-соединений urllib3 не должен быть общим с другими процессами
+    MINIO_CLIENT = None
+    # У каждого процесса свой реестр метрик: процесс слота N отдаёт /metrics на METRICS_PORT + N
+    if METRICS_PORT > 0:
+        METRICS_PORT += slot
+    start_metrics_server()
+    if FUSED_TRANSCRIPTION and WHISPER_BACKEND == "faster_whisper":
+        # Пул потоков CTranslate2 не переживает fork: модель загружается в каждом процессе отдельно
+        get_whisper_model()
+
+def describe_exit_status(status):
+    if os.WIFSIGNALED(status):
+        return f"по сигналу {signal.Signals(os.WTERMSIG(status)).name}"
+    return f"с кодом {os.WEXITSTATUS(status)}"
+
+def run_prefork_supervisor():
+    """
+    Порождает WORKER_PROCESSES потребителей через fork и перезапускает упавшие.
+    Модель к этому моменту загружена в родителе, инференс в нём не запускался (пулы потоков torch
+    не созданы), поэтому дочерние процессы делят страницы весов copy-on-write, пока не пишут в них.
+    """
+    children = {} # pid -> (слот, время запуска)
+    restart_delays = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info(f"Получен сигнал {signal.Signals(signum).name}: остановка {len(children)} дочерних процессов...")
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                init_forked_child(slot)
+                run_consumer()
+            except BaseException as e:
+                logger.exception(f"Дочерний процесс слота {slot} завершился с ошибкой: {e}")
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+        children[pid] = (slot, time.monotonic())
+        logger.info(f"Запущен дочерний процесс {pid} (слот {slot})")
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # Объекты родителя переносятся в постоянное поколение: сборщик мусора в дочерних процессах
+    # не обходит их и не копирует страницы, записывая счётчики поколений
+    gc.collect()
+    gc.freeze()
+    for slot in range(WORKER_PROCESSES):
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot, started = children.pop(pid, (None, None))
+        if slot is None or stopping:
+            continue
+        uptime = time.monotonic() - started
+        delay = PREFORK_RESTART_DELAY_SECONDS
+        if uptime < PREFORK_STABLE_SECONDS:
+            delay = min(restart_delays.get(slot, PREFORK_RESTART_DELAY_SECONDS / 2) * 2, PREFORK_RESTART_MAX_DELAY_SECONDS)
+        restart_delays[slot] = delay
+        logger.error(f"Дочерний процесс {pid} (слот {slot}) завершился {describe_exit_status(status)} через {uptime:.0f} с, "
+                     f"перезапуск через {delay:.0f} с")
+        time.sleep(delay)
+        if not stopping:
+            spawn(slot)
+
+def run_consumer():
     connection = None
+    channel = None
+    consuming_channels = []
     while True:
         try:
             logger.info(f"Попытка подключения к RabbitMQ: {RABBITMQ_HOST}:{RABBITMQ_PORT}...")
             credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
             parameters = pika.ConnectionParameters(
                 RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_VHOST, credentials,
-                heartbeat=600, blocked_connection_timeout=300
+                heartbeat=RABBITMQ_HEARTBEAT, blocked_connection_timeout=300
             )
             connection = pika.BlockingConnection(parameters)
             channel = connection.channel()
+            consuming_channels = [channel]
             logger.info("Успешное подключение к RabbitMQ.")
 
             # ИЗМЕНЕНО: Тип обменника на topic
@@ -286,9 +1883,24 @@ def main():
 
             channel.queue_declare(queue=CONSUME_QUEUE, durable=True)
             channel.queue_bind(exchange=CONSUME_EXCHANGE, queue=CONSUME_QUEUE, routing_key=CONSUME_ROUTING_KEY)
+            if ADAPTIVE_QUALITY:
+                schedule_backlog_checks(connection)
+
+            if TASK_LANES:
+                consuming_channels = consume_task_lanes(connection, channel)
+                logger.info("[*] Ожидание задач в полосах. Для выхода нажмите CTRL+C")
+                # Каналы полос обслуживаются одним циклом соединения; как и start_consuming, цикл
+                # работает, пока у каналов есть подписки, а после их отмены соединение переоткрывается
+                while any(ch.is_open and ch.consumer_tags for ch in consuming_channels):
+                    connection.process_data_events(time_limit=None)
+                continue
 
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=CONSUME_QUEUE, on_message_callback=on_message_callback)
+            channel.basic_qos(prefetch_count=WORKER_PREFETCH)
+            channel.basic_consume(
+                queue=CONSUME_QUEUE,
+                on_message_callback=functools.partial(dispatch_message, connection=connection),
+                arguments=get_consumer_arguments()
+            )
 
             logger.info(f"[*] Ожидание задач в очереди '{CONSUME_QUEUE}'. Для выхода нажмите CTRL+C")
             channel.start_consuming()
@@ -297,8 +1909,9 @@ def main():
             logger.warning(f"Потеряно соединение с RabbitMQ: {e}")
         except KeyboardInterrupt:
             logger.info("Получен сигнал KeyboardInterrupt. Завершение работы...")
-            if channel and channel.is_open:
-                channel.stop_consuming()
+            for consuming_channel in consuming_channels:
+                if consuming_channel and consuming_channel.is_open:
+                    consuming_channel.stop_consuming()
             break
         except Exception as e:
             logger.error(f"Произошла непредвиденная ошибка в главном цикле: {e}")
@@ -308,6 +1921,53 @@ def main():
             logger.info(f"Повторная попытка через {RECONNECT_DELAY_SECONDS} секунд...")
             time.sleep(RECONNECT_DELAY_SECONDS)
 
+def main():
+    logger.info(f"Demucs Worker запускается... Устройство: {DEMUCS_DEVICE}")
+    logger.info(f"Слушает очередь '{CONSUME_QUEUE}' (задач одновременно: {WORKER_CONCURRENCY}, инференсов: {INFERENCE_CONCURRENCY}, prefetch: {WORKER_PREFETCH})")
+    if TASK_LANES:
+        logger.info(f"Полосы задач: {', '.join(f'{lane} (вес {weight})' for lane, weight in TASK_LANES.items())}")
+    logger.info(f"Публикует результаты в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
+
+    try:
+        get_minio_client()
+    except Exception as e:
+        logger.critical(f"Критическая ошибка: Не удалось подключиться к MinIO при старте: {e}. Воркер не будет запущен.")
+        return
+
+    if WORKER_PROCESSES > 1:
+        if DEMUCS_DEVICE != "cpu" or (FUSED_TRANSCRIPTION and WHISPER_DEVICE != "cpu"):
+            # CUDA-контекст нельзя унаследовать через fork
+            logger.critical(f"Критическая ошибка: WORKER_PROCESSES={WORKER_PROCESSES} поддерживается только на CPU. Воркер не будет запущен.")
+            return
+        logger.info(f"Режим pre-fork: {WORKER_PROCESSES} дочерних процессов с общими весами модели")
+    else:
+        start_metrics_server()
+    configure_torch_threads()
+
+    try:
+        get_demucs_model()
+        if ADAPTIVE_QUALITY:
+            get_demucs_model(DEMUCS_FAST_MODEL)
+            logger.info(f"Адаптивное качество: при очереди от {ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:.0f} с - {DEMUCS_FAST_MODEL} "
+                        f"(shifts={DEMUCS_FAST_SHIFTS}), возврат к {DEMUCS_MODEL} ниже {ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS:.0f} с")
+    except Exception as e:
+        logger.critical(f"Критическая ошибка: Не удалось загрузить модель Demucs при старте: {e}. Воркер не будет запущен.")
+        return
+
+    if FUSED_TRANSCRIPTION:
+        try:
+            if WORKER_PROCESSES == 1 or WHISPER_BACKEND != "faster_whisper":
+                get_whisper_model()
+            logger.info(f"Совмещённый режим: вокал распознаётся Whisper, результат публикуется с ключом '{WHISPER_RESULT_ROUTING_KEY}'")
+        except Exception as e:
+            logger.critical(f"Критическая ошибка: Не удалось загрузить модель Whisper {WHISPER_MODEL_NAME} для совмещённого режима: {e}. Воркер не будет запущен.")
+            return
+
+    if WORKER_PROCESSES > 1:
+        run_prefork_supervisor()
+    else:
+        run_consumer()
+
     logger.info("Demucs Worker остановлен.")
 
 if __name__ == '__main__':
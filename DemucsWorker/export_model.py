@@ -0,0 +1,147 @@
+"""
+Экспорт модели Demucs в TorchScript для инференса на CPU (DEMUCS_BACKEND=torchscript в app.py).
+
+Каждая подмодель (у htdemucs_ft их четыре, у htdemucs одна) трассируется на входе той длины, которую
+apply_model подаёт при split=True (сегмент обучения), затем граф замораживается и оптимизируется
+torch.jit.optimize_for_inference. С --quantize линейные слои и LSTM предварительно квантуются в int8.
+С --check результат экспортированной модели сравнивается с eager-моделью через apply_model на одном
+и том же сигнале; при SNR ниже --min-snr-db код возврата 1.
+
+Пример (в контейнере воркера):
+    python export_model.py --model htdemucs_ft --output /models/demucs/htdemucs_ft --check
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import torch
+from demucs.apply import BagOfModels, apply_model
+from demucs.audio import AudioFile
+from demucs.pretrained import get_model
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("demucs_export")
+
+
+def get_sub_models(model):
+    return list(model.models) if isinstance(model, BagOfModels) else [model]
+
+
+def get_segment_length(sub_model):
+    # Столько отсчётов apply_model подаёт в HTDemucs при split=True (см. valid_length)
+    return int(float(sub_model.segment) * sub_model.samplerate)
+
+
+def export_sub_model(sub_model, quantize):
+    sub_model = sub_model.cpu().eval()
+    if quantize:
+        sub_model = torch.ao.quantization.quantize_dynamic(sub_model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+    example = torch.randn(1, sub_model.audio_channels, get_segment_length(sub_model))
+    with torch.no_grad():
+        traced = torch.jit.trace(sub_model, example, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    # Квантованные графы optimize_for_inference не поддерживает: они только замораживаются
+    return traced if quantize else torch.jit.optimize_for_inference(traced)
+
+
+def export_model(model_name, output_dir, quantize):
+    model = get_model(model_name)
+    model.eval()
+    os.makedirs(output_dir, exist_ok=True)
+    sub_models = get_sub_models(model)
+    for index, sub_model in enumerate(sub_models):
+        started = time.monotonic()
+        traced = export_sub_model(sub_model, quantize)
+        path = os.path.join(output_dir, f"model_{index}.pt")
+        torch.jit.save(traced, path)
+        logger.info(f"Подмодель {index + 1}/{len(sub_models)} экспортирована в {path} за {time.monotonic() - started:.1f} с "
+                    f"(вход [1, {sub_model.audio_channels}, {get_segment_length(sub_model)}])")
+    meta = {"model": model_name, "sub_models": len(sub_models), "quantized": quantize, "sources": list(model.sources),
+            "samplerate": model.samplerate, "torch_version": torch.__version__,
+            "exported_at": datetime.now(timezone.utc).isoformat()}
+    # export.json пишется последним: по нему воркер считает экспорт завершённым
+    with open(os.path.join(output_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_check_signal(model, path, seconds):
+    if path:
+        wav = AudioFile(path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+        return wav[:, :int(seconds * model.samplerate)]
+    generator = torch.Generator().manual_seed(0)
+    return 0.1 * torch.randn(model.audio_channels, int(seconds * model.samplerate), generator=generator)
+
+
+def snr_db(reference, estimate):
+    noise = (reference - estimate).pow(2).sum()
+    return float(10 * torch.log10(reference.pow(2).sum() / noise.clamp_min(1e-20)))
+
+
+def check_parity(model_name, output_dir, path, seconds):
+    """SNR (дБ) каждого источника экспортированной модели относительно eager-модели на одном сигнале."""
+    eager = get_model(model_name).eval()
+    exported = get_model(model_name).eval()
+    for index, sub_model in enumerate(get_sub_models(exported)):
+        traced = torch.jit.load(os.path.join(output_dir, f"model_{index}.pt"), map_location="cpu")
+        sub_model.exported = traced
+        sub_model.forward = traced.forward
+
+    wav = load_check_signal(eager, path, seconds)
+    outputs, timings = {}, {}
+    with torch.no_grad():
+        for name, model in (("eager", eager), ("exported", exported)):
+            started = time.monotonic()
+            outputs[name] = apply_model(model, wav[None], device="cpu", shifts=0, split=True, overlap=0.25, progress=False)[0]
+            timings[name] = time.monotonic() - started
+    results = {source: snr_db(outputs["eager"][index], outputs["exported"][index]) for index, source in enumerate(eager.sources)}
+    logger.info(f"Время на {wav.shape[-1] / eager.samplerate:.1f} с аудио: eager {timings['eager']:.2f} с, "
+                f"экспорт {timings['exported']:.2f} с (x{timings['eager'] / max(timings['exported'], 1e-9):.2f})")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Экспорт модели Demucs в TorchScript для CPU")
+    parser.add_argument("--model", default=os.getenv("DEMUCS_MODEL", "htdemucs"), help="Имя модели demucs (htdemucs, htdemucs_ft)")
+    parser.add_argument("--output", help="Каталог для model_<i>.pt и export.json (по умолчанию /models/demucs/<модель>)")
+    parser.add_argument("--quantize", action="store_true", help="Динамическое квантование Linear/LSTM в int8")
+    parser.add_argument("--threads", type=int, default=0, help="Потоков torch (0 - по умолчанию)")
+    parser.add_argument("--skip-export", action="store_true", help="Только проверить уже экспортированную модель")
+    parser.add_argument("--check", action="store_true", help="Сравнить экспортированную модель с eager-моделью")
+    parser.add_argument("--check-input", help="Аудиофайл для проверки (по умолчанию шум)")
+    parser.add_argument("--check-seconds", type=float, default=20.0, help="Длительность сигнала для проверки")
+    parser.add_argument("--min-snr-db", type=float, help="Минимальный SNR относительно eager (по умолчанию 60 дБ, с --quantize 20 дБ)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output_dir = args.output or os.path.join("/models/demucs", args.model)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    if not args.skip_export:
+        meta = export_model(args.model, output_dir, args.quantize)
+        logger.info(f"Экспорт {args.model} завершён: {output_dir} ({meta['sub_models']} подмоделей, int8: {meta['quantized']})")
+
+    if args.check or args.skip_export:
+        with open(os.path.join(output_dir, "export.json"), encoding="utf-8") as f:
+            quantized = json.load(f).get("quantized", False)
+        min_snr_db = args.min_snr_db if args.min_snr_db is not None else (20.0 if quantized else 60.0)
+        results = check_parity(args.model, output_dir, args.check_input, args.check_seconds)
+        failed = [source for source, value in results.items() if value < min_snr_db]
+        for source, value in results.items():
+            logger.info(f"SNR {source}: {value:.1f} дБ{' (ниже порога)' if source in failed else ''}")
+        if failed:
+            logger.error(f"Экспортированная модель расходится с eager сильнее {min_snr_db:.0f} дБ: {', '.join(failed)}")
+            return 1
+        logger.info(f"Паритет с eager-моделью подтверждён (порог {min_snr_db:.0f} дБ)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,37 @@
+import io
 import os
+import sys
 import uuid
-import subprocess
 import pika
 import json
-import shutil 
+import threading
 import time
-import tempfile
+import struct
+import subprocess
+import functools
+import hashlib
+import contextlib
+from collections import OrderedDict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 import logging
 
+# Метрики Prometheus подключаются опционально: без пакета воркер работает, эндпоинт /metrics не поднимается
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# ONNX Runtime нужен только для DENOISER_BACKEND=onnx
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
 # --- Конфигурация логирования ---
 logging.basicConfig(
     level=os.getenv('LOG_LEVEL', 'INFO').upper(),
@@ -43,6 +65,89 @@ MINIO_DEFAULT_BUCKET = os.getenv('MINIO_BUCKET_NAME', 'audio-bucket')
 RECONNECT_DELAY_SECONDS = 5
 MAX_RETRIES_RABBITMQ = int(os.getenv('MAX_RETRIES_RABBITMQ', 5))
 
+# --- Конкурентная обработка ---
+# Сколько задач обрабатывается одновременно (скачивание/выгрузка идут параллельно с инференсом)
+WORKER_CONCURRENCY = max(int(os.getenv("WORKER_CONCURRENCY", 1)), 1)
+# Сколько инференсов модели может выполняться одновременно
+INFERENCE_CONCURRENCY = max(int(os.getenv("INFERENCE_CONCURRENCY", 1)), 1)
+# Сколько неподтверждённых сообщений брокер выдаёт воркеру (по умолчанию = WORKER_CONCURRENCY)
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", 0)) or WORKER_CONCURRENCY
+# Интервал heartbeat: инференс идёт вне потока соединения, поэтому длинный интервал не нужен
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 30))
+# Тайм-аут брокера на подтверждение доставки (x-consumer-timeout, мс); 0 = настройка сервера
+RABBITMQ_CONSUMER_TIMEOUT_MS = int(os.getenv("RABBITMQ_CONSUMER_TIMEOUT_MS", 0))
+# Сколько завершённых, но не подтверждённых из-за обрыва соединения задач помнить до повторной доставки
+COMPLETED_TASKS_MAX = int(os.getenv("COMPLETED_TASKS_MAX", 256))
+
+# --- Конфигурация модели historical-denoise (код модели лежит в базовом образе historical-denoiser) ---
+DENOISER_APP_DIR = os.getenv('DENOISER_APP_DIR', '/app')
+DENOISER_CONFIG_PATH = os.getenv('DENOISER_CONFIG_PATH', os.path.join(DENOISER_APP_DIR, 'conf', 'conf.yaml'))
+# По умолчанию чекпоинт ищется в <DENOISER_APP_DIR>/<path_experiment>/checkpoint из конфигурации модели
+DENOISER_CHECKPOINT = os.getenv('DENOISER_CHECKPOINT')
+DENOISER_SAMPLE_RATE = 44100
+DENOISER_SEGMENT_SECONDS = float(os.getenv('DENOISER_SEGMENT_SECONDS', 5))
+DENOISER_OVERLAP_SAMPLES = int(os.getenv('DENOISER_OVERLAP_SAMPLES', 2048))
+# Сколько сегментов подаётся в модель за один вызов: на CPU батч загружает ядра лучше, чем сегменты по одному
+DENOISER_BATCH_SIZE = max(int(os.getenv('DENOISER_BATCH_SIZE', 4)), 1)
+# Потоки TensorFlow внутри одной операции (intra-op); 0 = по умолчанию TensorFlow (все ядра)
+DENOISER_CPU_THREADS = int(os.getenv('DENOISER_CPU_THREADS', 0))
+# 'tensorflow' - Keras-модель из чекпоинта; 'saved_model' - оптимизированный граф из export_model.py;
+# 'onnx' - ONNX Runtime (export_model.py --onnx, в том числе квантованная в int8 модель)
+DENOISER_BACKEND = os.getenv('DENOISER_BACKEND', 'tensorflow').lower()
+# Экспортированная модель: каталог SavedModel или файл .onnx; export.json лежит в родительском каталоге
+DENOISER_EXPORT_PATH = os.getenv('DENOISER_EXPORT_PATH', '/models/denoise/saved_model')
+SUPPORTED_DENOISER_BACKENDS = ("tensorflow", "saved_model", "onnx")
+
+# --- Метрики Prometheus ---
+# Порт HTTP-эндпоинта /metrics; 0 = не запускать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_SERVICE = "historical_denoise"
+METRICS_STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# --- Кэш результатов по содержимому входного файла ---
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "True").lower() == "true"
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "cache").strip('/')
+# Предельный размер кэша одного сервиса в MinIO; при превышении удаляются самые старые записи
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+# Переполнение проверяется раз в RESULT_CACHE_EVICT_EVERY сохранений (первая проверка - при первом сохранении):
+# каждая проверка - полный LIST префикса сервиса. Между проверками кэш может превысить лимит на столько же записей
+RESULT_CACHE_EVICT_EVERY = max(int(os.getenv("RESULT_CACHE_EVICT_EVERY", 20)), 1)
+CACHE_STORES_SINCE_EVICT = {}
+CACHE_EVICT_LOCK = threading.Lock()
+
+# --- Общий декодированный звук: ffmpeg декодирует исходник один раз для всех этапов ---
+DECODED_AUDIO_ENABLED = os.getenv("DECODED_AUDIO_ENABLED", "True").lower() == "true"
+# Каталог общего тома: массивы .npy отображаются в память без копирования. Без него общий звук выключен:
+# копирование массива через MinIO во временный файл обошлось бы дороже повторного запуска ffmpeg
+DECODED_AUDIO_DIR = os.getenv("DECODED_AUDIO_DIR", "")
+# Предельный суммарный размер декодированного звука; при превышении удаляются самые старые массивы
+DECODED_AUDIO_MAX_BYTES = int(os.getenv("DECODED_AUDIO_MAX_BYTES", 20 * 1024 ** 3))
+if DECODED_AUDIO_ENABLED and not DECODED_AUDIO_DIR:
+    logger.warning("DECODED_AUDIO_DIR не задан: общий декодированный звук выключен, каждый этап декодирует исходник сам")
+
+# --- Потоковый обмен с MinIO: входной файл и результат не пишутся на диск ---
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 1024 * 1024))
+# Размер части multipart-выгрузки результата (не меньше минимальных для S3 5 МиБ)
+UPLOAD_PART_SIZE = max(int(os.getenv("UPLOAD_PART_SIZE", 16 * 1024 * 1024)), 5 * 1024 * 1024)
+# Сколько отсчётов за раз кодируется при выгрузке результата
+ENCODE_BLOCK_FRAMES = 1 << 18
+
+# --- Формат файла результата ---
+# 'flac' - без потерь (по умолчанию), 'opus' - компактный формат для потокового прослушивания, 'wav' - PCM 16 бит
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "flac").lower()
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "96k")
+OUTPUT_FORMATS = {
+    "wav": {"extension": ".wav", "content_type": "audio/wav", "ffmpeg_args": None},
+    "flac": {"extension": ".flac", "content_type": "audio/flac",
+             "ffmpeg_args": ["-c:a", "flac", "-sample_fmt", "s16", "-compression_level", "5", "-f", "flac"]},
+    # libopus работает с 48 кГц; Ogg/Opus проигрывается браузерами напрямую
+    "opus": {"extension": ".opus", "content_type": "audio/ogg",
+             "ffmpeg_args": ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-ar", "48000", "-f", "ogg"]},
+}
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    logger.critical(f"ОШИБКА: Неизвестный OUTPUT_FORMAT '{OUTPUT_FORMAT}'. Допустимые значения: {', '.join(OUTPUT_FORMATS)}")
+    sys.exit(1)
+
 # --- Инициализация клиента MinIO ---
 minio_client = None # по умолчанию
 try:
@@ -63,6 +168,30 @@ except Exception as e:
     logger.error(f"Не удалось инициализировать клиент MinIO: {e}")
     # minio_client останется None
 
+# Двухэтапный U-Net загружается один раз на процесс
+denoise_engine = None
+denoise_engine_lock = threading.Lock()
+
+# Этапы: queue_wait, download (чтение из сети), decode (декодирование вместе с потоковым чтением),
+# inference, encode, upload (выгрузка без учёта ожидания кодировщика)
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram("audio_worker_stage_seconds", "Длительность этапов обработки задачи",
+                                                ["service", "stage"], buckets=METRICS_STAGE_BUCKETS)
+    TASKS_TOTAL = prometheus_client.Counter("audio_worker_tasks_total", "Опубликованные результаты задач по статусу",
+                                            ["service", "status"])
+    AUDIO_SECONDS_TOTAL = prometheus_client.Counter("audio_worker_audio_seconds_total", "Суммарная длительность обработанного аудио",
+                                                    ["service", "model"])
+    REALTIME_FACTOR = prometheus_client.Gauge("audio_worker_realtime_factor", "Секунды обработки на секунду аудио (последняя задача)",
+                                              ["service", "model"])
+
+TASK_EXECUTOR = None
+INFERENCE_SLOTS = threading.BoundedSemaphore(INFERENCE_CONCURRENCY)
+
+# Задачи в работе и завершённые задачи, чей результат не удалось отправить: ключ задачи -> доставка / операции
+INFLIGHT_TASKS = {}
+COMPLETED_TASKS = OrderedDict()
+DELIVERY_LOCK = threading.RLock()
+
 
 def ensure_minio_bucket_exists(bucket_name):
     """Проверяет существование бакета и создает его, если необходимо."""
@@ -103,135 +232,746 @@ def publish_processing_result(channel, task_id, status, result_data):
                 correlation_id=task_id
             )
         )
+        count_task(status)
         logger.info(f"Результат для task_id {task_id} опубликован: tool='historical_denoise', status='{status}'")
     except Exception as e:
         logger.error(f"Не удалось опубликовать результат для task_id {task_id}: {e}")
 
 
-def run_historical_denoise_process(task_id, input_audio_path_host, base_temp_dir_for_docker_data_on_host):
+def observe_stage(stage, seconds):
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(METRICS_SERVICE, stage).observe(seconds)
+
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started)
+
+
+def count_task(status, service=METRICS_SERVICE):
+    if prometheus_client is not None:
+        TASKS_TOTAL.labels(service, status).inc()
+
+
+def observe_realtime_factor(model, processing_seconds, audio_seconds):
+    """Фактор реального времени задачи: секунды обработки (без ожидания в очереди) на секунду аудио."""
+    if prometheus_client is not None and audio_seconds > 0:
+        REALTIME_FACTOR.labels(METRICS_SERVICE, model).set(processing_seconds / audio_seconds)
+        AUDIO_SECONDS_TOTAL.labels(METRICS_SERVICE, model).inc(audio_seconds)
+
+
+def observe_queue_wait(properties):
+    """Ожидание в очереди от публикации задачи (заголовок x-published-at-ms или timestamp AMQP) до начала обработки."""
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get("x-published-at-ms"):
+        published_at = int(headers["x-published-at-ms"]) / 1000
+    elif getattr(properties, "timestamp", None):
+        published_at = properties.timestamp
+    else:
+        return
+    observe_stage("queue_wait", max(time.time() - published_at, 0.0))
+
+
+def start_metrics_server():
+    if prometheus_client is None:
+        logger.warning("Пакет prometheus_client не установлен: эндпоинт /metrics не запущен")
+    elif METRICS_PORT > 0:
+        prometheus_client.start_http_server(METRICS_PORT)
+        logger.info(f"Метрики Prometheus доступны на порту {METRICS_PORT} (/metrics)")
+
+
+def make_cache_key(content_id, params):
+    payload = json.dumps({"content": content_id, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_etag_cache_key(minio_client, bucket_name, object_name, params, task_id="N/A"):
+    """Ключ кэша по ETag и размеру объекта: вычисляется без скачивания файла."""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        stat = minio_client.stat_object(bucket_name, object_name)
+        etag = stat.etag.strip('"')
+        return make_cache_key(f"etag:{etag}:{stat.size}", params)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для кэша: {e}")
+        return None
+
+
+def get_content_cache_key(sha256_hex, params):
+    """Ключ кэша по SHA-256 содержимого: совпадает для одинаковых файлов, загруженных разными способами."""
+    if not RESULT_CACHE_ENABLED or not sha256_hex:
+        return None
+    return make_cache_key(f"sha256:{sha256_hex}", params)
+
+
+def get_cache_object_name(service, cache_key, suffix):
+    return f"{RESULT_CACHE_PREFIX}/{service}/{cache_key}{suffix}"
+
+
+def lookup_cached_result(minio_client, bucket_name, service, cache_key, task_id="N/A"):
+    """Возвращает манифест закэшированного результата или None."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return None
+    manifest_object = get_cache_object_name(service, cache_key, ".json")
+    try:
+        response = minio_client.get_object(bucket_name, manifest_object)
+        try:
+            manifest = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    except S3Error as e:
+        if e.code != "NoSuchKey":
+            logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
+    logger.info(f"Задача {task_id}: Найден результат в кэше: s3://{bucket_name}/{manifest_object}")
+    return manifest
+
+
+def restore_cached_artifact(minio_client, bucket_name, manifest, output_object_name, task_id="N/A"):
+    """Копирует закэшированный файл результата на место выходного объекта задачи (на стороне MinIO)."""
+    try:
+        minio_client.copy_object(bucket_name, output_object_name, CopySource(bucket_name, manifest["artifact_object"]))
+        return True
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось восстановить результат из кэша {manifest.get('artifact_object')}: {e}")
+        return False
+
+
+def store_cached_result(minio_client, bucket_name, service, cache_keys, result, artifact_object=None, artifact_suffix="", task_id="N/A"):
+    """Сохраняет результат в кэш под всеми переданными ключами. Ошибки кэша не влияют на задачу."""
+    cache_keys = list(dict.fromkeys(key for key in cache_keys if key))
+    if not RESULT_CACHE_ENABLED or not cache_keys:
+        return
+    try:
+        cached_artifact = None
+        if artifact_object:
+            cached_artifact = get_cache_object_name(service, cache_keys[-1], artifact_suffix)
+            minio_client.copy_object(bucket_name, cached_artifact, CopySource(bucket_name, artifact_object))
+        manifest = {"service": service, "created_at": time.time(), "artifact_object": cached_artifact, "result": result}
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        for cache_key in cache_keys:
+            minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                    io.BytesIO(data), len(data), content_type='application/json')
+        logger.info(f"Задача {task_id}: Результат сохранён в кэш {RESULT_CACHE_PREFIX}/{service}/ (ключей: {len(cache_keys)})")
+        if should_evict_cache(service):
+            evict_cache_overflow(minio_client, bucket_name, service)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось сохранить результат в кэш: {e}")
+
+
+def link_cached_result(minio_client, bucket_name, service, manifest, cache_key, task_id="N/A"):
+    """Регистрирует уже закэшированный результат под ещё одним ключом (например, ETag нового объекта с тем же содержимым)."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return
+    try:
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                io.BytesIO(data), len(data), content_type='application/json')
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось добавить ключ кэша {cache_key}: {e}")
+
+
+def should_evict_cache(service):
+    """True раз в RESULT_CACHE_EVICT_EVERY сохранений сервиса, начиная с первого."""
+    with CACHE_EVICT_LOCK:
+        count = CACHE_STORES_SINCE_EVICT.get(service, RESULT_CACHE_EVICT_EVERY - 1) + 1
+        CACHE_STORES_SINCE_EVICT[service] = 0 if count >= RESULT_CACHE_EVICT_EVERY else count
+        return count >= RESULT_CACHE_EVICT_EVERY
+
+
+def evict_cache_overflow(minio_client, bucket_name, service, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Удаляет самые старые объекты кэша сервиса, пока его размер превышает max_bytes."""
+    cached_objects = list(minio_client.list_objects(bucket_name, prefix=f"{RESULT_CACHE_PREFIX}/{service}/", recursive=True))
+    total_size = sum(obj.size for obj in cached_objects)
+    for obj in sorted(cached_objects, key=lambda o: o.last_modified):
+        if total_size <= max_bytes:
+            break
+        minio_client.remove_object(bucket_name, obj.object_name)
+        total_size -= obj.size
+        logger.info(f"Объект кэша {obj.object_name} удалён (превышен лимит {max_bytes} байт)")
+
+
+def _run_ffmpeg_decoder(source, sample_rate, channels, feed=None):
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-threads", "0", "-i", source,
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_chunks = []
+    threads = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+    if feed:
+        threads.append(threading.Thread(target=feed, args=(process.stdin,), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    pcm = bytearray()
+    for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b''):
+        pcm += chunk
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if process.returncode != 0:
+        stderr = b"".join(stderr_chunks).decode(errors='replace').strip()
+        raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {stderr[-500:]}")
+    return np.frombuffer(pcm, dtype=np.float32).reshape(-1, channels).T
+
+
+def decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
     """
-    Запускает процесс historical-denoise в Docker контейнере historical-denoiser.
-    input_audio_path_host - путь к ИСХОДНОМУ файлу на хост-машине воркера (уже скачанному из MinIO).
-    base_temp_dir_for_docker_data_on_host - путь к временной директории на хосте, которая будет смонтирована как /app/data в контейнер.
-    (Ожидаемая структура внутри base_temp_dir_for_docker_data_on_host: ./input/ и ./output/)
+    Декодирует объект MinIO в float32 [channels, samples] без временных файлов: тело get_object
+    по частям подаётся в stdin ffmpeg, попутно считается SHA-256 для ключа кэша.
+    Возвращает (audio, sha256_hex); для контейнеров, которые нельзя читать из потока
+    (например, MP4 с индексом в конце), ffmpeg читает объект по presigned URL, и хеш не считается.
     """
-    input_filename = os.path.basename(input_audio_path_host)
-    input_filename_stem = os.path.splitext(input_filename)[0]
+    decode_started = time.monotonic()
+    digest = hashlib.sha256()
+    feed_errors = []
+    network_seconds = [0.0]
 
-    # Пути внутри временной директории на хосте
-    host_docker_input_dir = os.path.join(base_temp_dir_for_docker_data_on_host, "input")
-    host_docker_output_dir = os.path.join(base_temp_dir_for_docker_data_on_host, "output") 
-    
-    os.makedirs(host_docker_input_dir, exist_ok=True)
-    os.makedirs(host_docker_output_dir, exist_ok=True)
+    def feed(stdin):
+        response = None
+        try:
+            read_started = time.monotonic()
+            response = minio_client.get_object(bucket_name, object_name)
+            for chunk in response.stream(STREAM_CHUNK_SIZE):
+                network_seconds[0] += time.monotonic() - read_started
+                digest.update(chunk)
+                stdin.write(chunk)
+                read_started = time.monotonic()
+        except BrokenPipeError:
+            pass # ffmpeg завершился раньше; причину покажет его код возврата
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+            if response is not None:
+                response.close()
+                response.release_conn()
+
+    try:
+        audio = _run_ffmpeg_decoder("pipe:0", sample_rate, channels, feed)
+    except RuntimeError as e:
+        if feed_errors:
+            raise feed_errors[0]
+        logger.warning(f"Задача {task_id}: Не удалось декодировать s3://{bucket_name}/{object_name} из потока ({e}), чтение по presigned URL")
+        url = minio_client.presigned_get_object(bucket_name, object_name, expires=timedelta(hours=1))
+        audio = _run_ffmpeg_decoder(url, sample_rate, channels)
+        observe_stage("decode", time.monotonic() - decode_started)
+        return audio, None
+    if feed_errors:
+        raise feed_errors[0]
+    observe_stage("download", network_seconds[0])
+    observe_stage("decode", time.monotonic() - decode_started)
+    return audio, digest.hexdigest()
 
-    host_input_file_for_docker = os.path.join(host_docker_input_dir, input_filename)
-    shutil.copy(input_audio_path_host, host_input_file_for_docker)
 
-    expected_denoised_file_on_host = os.path.join(host_docker_output_dir, input_filename_stem, "denoised.wav")
+def get_decoded_audio_key(minio_client, bucket_name, object_name):
+    """Ключ декодированного звука по ETag и размеру: одинаковые файлы под разными именами декодируются один раз."""
+    stat = minio_client.stat_object(bucket_name, object_name)
+    etag = stat.etag.strip('"')
+    return make_cache_key(f"etag:{etag}:{stat.size}", {"decoded_audio": 1})
 
-    inference_script_path_in_container = "/app/inference.py"
 
-    cmd = [
-        "docker", "run", "--rm",
-        "-v", f"{base_temp_dir_for_docker_data_on_host}:/app/data",
-        "historical-denoiser:latest", 
-        "python", inference_script_path_in_container
-    ]
+def get_decoded_audio_name(key, sample_rate, channels):
+    return f"{key}.{sample_rate}x{channels}"
 
-    logger.info(f"Задача {task_id}: Выполнение Historical Denoise: {' '.join(cmd)}")
+
+def read_object_bytes(minio_client, bucket_name, object_name):
+    response = minio_client.get_object(bucket_name, object_name)
     try:
-        process = subprocess.run(cmd, capture_output=True, text=True, check=False)
-        logger.debug(f"Задача {task_id}: Historical Denoise stdout:\n{process.stdout}")
-        if process.stderr:
-            logger.warning(f"Задача {task_id}: Historical Denoise stderr:\n{process.stderr}")
-
-        if process.returncode != 0:
-            return None, {
-                "error_message": "Ошибка обработки Historical Denoise",
-                "details": {"stdout": process.stdout, "stderr": process.stderr, "returncode": process.returncode}
-            }
-
-        if not os.path.exists(expected_denoised_file_on_host):
-            logger.warning(f"Задача {task_id}: Ожидаемый очищенный файл не найден по пути {expected_denoised_file_on_host}.")
-            found_denoised_files = []
-            output_subdir_for_file = os.path.join(host_docker_output_dir, input_filename_stem)
-            if os.path.exists(output_subdir_for_file):
-                for f_name in os.listdir(output_subdir_for_file):
-                    if "denoised.wav" in f_name.lower():
-                        found_denoised_files.append(os.path.join(output_subdir_for_file, f_name))
-            
-            if found_denoised_files:
-                logger.info(f"Задача {task_id}: Найден очищенный файл: {found_denoised_files[0]}. Используется этот файл.")
-                return found_denoised_files[0], None
-            
-            return None, {
-                "error_message": f"Выходной файл Historical Denoise 'denoised.wav' не найден в {output_subdir_for_file}",
-                "details": {"search_path": output_subdir_for_file, "stdout": process.stdout, "stderr": process.stderr }
-            }
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
 
-        logger.info(f"Задача {task_id}: Обработка Historical Denoise успешна. Очищенное аудио по пути {expected_denoised_file_on_host}")
-        return expected_denoised_file_on_host, None
 
+def load_decoded_audio(key, sample_rate, channels, task_id="N/A"):
+    """
+    Ищет звук, уже декодированный другим этапом: в нужном формате, а для моно - также стерео
+    той же частоты (сводится в моно). Возвращает (audio, sha256_hex) или None.
+    """
+    for stored_channels in dict.fromkeys((channels, 2)):
+        name = get_decoded_audio_name(key, sample_rate, stored_channels)
+        try:
+            # Описание пишется последним: если его нет, массив ещё не сохранён целиком
+            with open(os.path.join(DECODED_AUDIO_DIR, f"{name}.json"), encoding='utf-8') as f:
+                meta = json.load(f)
+            # copy-on-write: страницы читаются с общего тома по мере обращения, изменения не попадают в файл
+            audio = np.load(os.path.join(DECODED_AUDIO_DIR, f"{name}.npy"), mmap_mode='c')
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"Задача {task_id}: Ошибка чтения декодированного звука {name}: {e}")
+            continue
+        if stored_channels != channels:
+            audio = audio.mean(axis=0, keepdims=True, dtype=np.float32)
+        logger.info(f"Задача {task_id}: Использован декодированный звук {name} ({audio.shape[-1] / sample_rate:.1f} с), ffmpeg не запускался")
+        return audio, meta.get("sha256")
+    return None
+
+
+def evict_decoded_audio_dir():
+    """Удаляет самые старые файлы из DECODED_AUDIO_DIR, пока их размер превышает DECODED_AUDIO_MAX_BYTES."""
+    entries = []
+    for entry in os.scandir(DECODED_AUDIO_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= DECODED_AUDIO_MAX_BYTES:
+            break
+        # Уже отображённый в память файл остаётся доступен процессу, который его открыл
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
+
+
+def store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id="N/A"):
+    """Сохраняет декодированный звук [channels, samples] для следующих этапов. Ошибки не влияют на задачу."""
+    name = get_decoded_audio_name(key, sample_rate, audio.shape[0])
+    meta = json.dumps({"sha256": sha256_hex, "sample_rate": sample_rate, "channels": audio.shape[0],
+                       "frames": audio.shape[-1], "created_at": time.time()}).encode('utf-8')
+    try:
+        os.makedirs(DECODED_AUDIO_DIR, exist_ok=True)
+        # Через временный файл и переименование: другой процесс не увидит недописанный массив
+        # np.save пишет заголовок и audio.data в файл напрямую; массив после ffmpeg уже float32 и сохраняется
+        # как есть (транспонированный - с fortran_order), без промежуточной копии в памяти
+        for suffix, write in ((".npy", lambda f: np.save(f, audio if audio.dtype == np.float32 else audio.astype(np.float32))),
+                              (".json", lambda f: f.write(meta))):
+            temp_path = os.path.join(DECODED_AUDIO_DIR, f".{name}.{uuid.uuid4().hex}{suffix}")
+            with open(temp_path, 'wb') as f:
+                write(f)
+            os.replace(temp_path, os.path.join(DECODED_AUDIO_DIR, f"{name}{suffix}"))
+        evict_decoded_audio_dir()
+        logger.info(f"Задача {task_id}: Декодированный звук сохранён для следующих этапов: {name}")
     except Exception as e:
-        logger.exception(f"Задача {task_id}: Исключение во время выполнения Historical Denoise: {e}")
-        return None, {"error_message": f"Исключение при выполнении Historical Denoise: {str(e)}"}
-    finally:
-        if os.path.exists(host_input_file_for_docker):
+        logger.warning(f"Задача {task_id}: Не удалось сохранить декодированный звук {name}: {e}")
+
+
+def decode_object_audio_shared(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
+    """
+    decode_object_audio с общим декодированным звуком: если файл уже декодировал другой этап, массив
+    берётся готовым, иначе файл декодируется, а результат сохраняется для следующих этапов. Сохранение
+    синхронное: массив не переживает задачу в фоновом потоке, а число одновременных записей ограничено числом задач.
+    Возвращает (audio, sha256_hex).
+    """
+    if not DECODED_AUDIO_ENABLED or not DECODED_AUDIO_DIR:
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    try:
+        key = get_decoded_audio_key(minio_client, bucket_name, object_name)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для декодированного звука: {e}")
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+
+    load_started = time.monotonic()
+    found = load_decoded_audio(key, sample_rate, channels, task_id)
+    if found is not None:
+        observe_stage("load_decoded", time.monotonic() - load_started)
+        return found
+
+    audio, sha256_hex = decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    with measure_stage("store_decoded"):
+        store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id)
+    return audio, sha256_hex
+
+
+def iter_audio_blocks(audio):
+    """Блоки [channels, ENCODE_BLOCK_FRAMES] массива [channels, samples]."""
+    for position in range(0, audio.shape[1], ENCODE_BLOCK_FRAMES):
+        yield audio[:, position:position + ENCODE_BLOCK_FRAMES]
+
+
+class WavStreamReader:
+    """
+    Файлоподобный источник для put_object: кодирует float32 [channels, samples] в WAV (PCM 16 бит)
+    блоками по мере чтения, поэтому полный файл результата не собирается ни на диске, ни в памяти.
+    Вместо массива можно передать итератор блоков [channels, frames] с заранее известными channels и frames.
+    """
+
+    def __init__(self, audio, sample_rate, channels=None, frames=None):
+        if isinstance(audio, np.ndarray):
+            channels, frames = audio.shape
+            audio = iter_audio_blocks(audio)
+        self._blocks = iter(audio)
+        self.frames = frames
+        data_size = self.frames * channels * 2
+        header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, channels,
+                             sample_rate, sample_rate * channels * 2, channels * 2, 16, b'data', data_size)
+        self.length = len(header) + data_size
+        self._buffer = bytearray(header)
+        self._position = 0
+        self.encode_seconds = 0.0
+
+    def read(self, size=-1):
+        encode_started = time.monotonic()
+        while (size < 0 or len(self._buffer) < size) and self._position < self.frames:
+            block = next(self._blocks, None)
+            if block is None:
+                raise RuntimeError(f"Поток блоков закончился на {self._position} из {self.frames} отсчётов")
+            self._position += block.shape[1]
+            self._buffer += (np.clip(block, -1.0, 1.0) * 32767).astype('<i2').T.tobytes()
+        self.encode_seconds += time.monotonic() - encode_started
+        size = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class EncodedAudioReader:
+    """
+    Файлоподобный источник для put_object: float32 [channels, samples] блоками подаётся в stdin ffmpeg,
+    а закодированный поток читается из его stdout. Размер результата заранее неизвестен.
+    Вместо массива можно передать итератор блоков [channels, frames] (тогда нужен channels):
+    он вычисляется в потоке подачи по мере того, как ffmpeg принимает данные.
+    """
+
+    def __init__(self, audio, sample_rate, ffmpeg_args, channels=None):
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "f32le", "-ar", str(sample_rate),
+               "-ac", str(channels or audio.shape[0]), "-i", "pipe:0", *ffmpeg_args, "pipe:1"]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.length = 0
+        self.encode_seconds = 0.0
+        self._stderr_chunks = []
+        self._feed_errors = []
+        self._threads = [threading.Thread(target=self._feed, args=(audio,), daemon=True),
+                         threading.Thread(target=lambda: self._stderr_chunks.append(self.process.stderr.read()), daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _feed(self, audio):
+        blocks = iter_audio_blocks(audio) if isinstance(audio, np.ndarray) else audio
+        try:
+            for block in blocks:
+                block = np.clip(block, -1.0, 1.0)
+                self.process.stdin.write(np.ascontiguousarray(block.T, dtype='<f4').tobytes())
+        except BrokenPipeError:
+            pass # ffmpeg завершился раньше; причину покажет его код возврата
+        except Exception as e:
+            # Источник блоков упал (инференс): обрезанный файл не должен сойти за результат
+            self._feed_errors.append(e)
+            self.process.kill()
+        finally:
             try:
-                os.remove(host_input_file_for_docker)
-            except OSError as e_remove:
-                logger.warning(f"Не удалось удалить временный входной файл для Docker {host_input_file_for_docker}: {e_remove}")
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, size=-1):
+        # Ожидание вывода ffmpeg - это время кодирования, которое не перекрылось с выгрузкой
+        encode_started = time.monotonic()
+        data = self.process.stdout.read(size)
+        self.encode_seconds += time.monotonic() - encode_started
+        self.length += len(data)
+        return data
+
+    def close(self):
+        """Дожидается завершения ffmpeg и бросает исключение, если кодирование не удалось."""
+        self.process.wait()
+        for thread in self._threads:
+            thread.join()
+        if self._feed_errors:
+            raise self._feed_errors[0]
+        if self.process.returncode != 0:
+            stderr = b"".join(self._stderr_chunks).decode(errors='replace').strip()
+            raise RuntimeError(f"ffmpeg завершился с кодом {self.process.returncode}: {stderr[-500:]}")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def get_output_format():
+    """Описание формата результата: расширение файла, Content-Type и параметры кодирования."""
+    return OUTPUT_FORMATS[OUTPUT_FORMAT]
+
+
+def upload_audio_to_minio(minio_client, bucket_name, object_name, audio, sample_rate, channels=None, frames=None):
+    """
+    Кодирует массив [channels, samples] в OUTPUT_FORMAT и выгружает multipart-загрузкой частями
+    по UPLOAD_PART_SIZE. Вместо массива можно передать итератор блоков с числом каналов channels
+    и общей длиной frames: тогда блоки вычисляются, кодируются и выгружаются конвейером.
+    Возвращает размер выгруженного файла в байтах.
+    """
+    upload_started = time.monotonic()
+    output_format = get_output_format()
+    streaming = not isinstance(audio, np.ndarray)
+    if output_format["ffmpeg_args"] is None:
+        reader = WavStreamReader(audio, sample_rate, channels, frames)
+        minio_client.put_object(bucket_name, object_name, reader, reader.length,
+                                content_type=output_format["content_type"], part_size=UPLOAD_PART_SIZE)
+    else:
+        reader = EncodedAudioReader(audio, sample_rate, output_format["ffmpeg_args"], channels)
+        try:
+            minio_client.put_object(bucket_name, object_name, reader, -1,
+                                    content_type=output_format["content_type"], part_size=UPLOAD_PART_SIZE)
+        except Exception:
+            reader.abort()
+            raise
+        try:
+            reader.close()
+        except Exception:
+            # Объект уже выгружен, но поток мог оборваться: не оставляем битый файл
+            minio_client.remove_object(bucket_name, object_name)
+            raise
+    # В конвейере чтение блоков включает инференс, поэтому этапы encode/upload не разделить
+    if not streaming:
+        observe_stage("encode", reader.encode_seconds)
+        observe_stage("upload", time.monotonic() - upload_started - reader.encode_seconds)
+    return reader.length
+
+
+class HistoricalDenoiseEngine:
+    """
+    Двухэтапный U-Net из historical-denoise, загруженный в процесс воркера.
+    Повторяет обработку /app/inference.py: STFT сегментов по DENOISER_SEGMENT_SECONDS,
+    предсказание моделью, ISTFT и сшивка сегментов окном Ханна. Сегменты подаются
+    в модель мини-батчами по DENOISER_BATCH_SIZE, а результат отдаётся блоками по мере готовности.
+    """
+
+    def __init__(self):
+        if DENOISER_APP_DIR not in sys.path:
+            sys.path.insert(0, DENOISER_APP_DIR)
+        import tensorflow as tf
+        from omegaconf import OmegaConf
+        import unet
+
+        if DENOISER_BACKEND not in SUPPORTED_DENOISER_BACKENDS:
+            raise ValueError(f"Неизвестный DENOISER_BACKEND '{DENOISER_BACKEND}'. Допустимые значения: {', '.join(SUPPORTED_DENOISER_BACKENDS)}")
+        if DENOISER_CPU_THREADS > 0:
+            # Настраивается только до первой операции TensorFlow в процессе
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(DENOISER_CPU_THREADS)
+            except RuntimeError as e:
+                logger.warning(f"Не удалось задать число потоков TensorFlow: {e}")
+        self.tf = tf
+        self.args = OmegaConf.load(DENOISER_CONFIG_PATH)
+        self.win_size = self.args.stft.win_size
+        self.hop_size = self.args.stft.hop_size
+        self.segment_size = int(DENOISER_SAMPLE_RATE * DENOISER_SEGMENT_SECONDS)
+        self.overlap = DENOISER_OVERLAP_SAMPLES
+        # Шаг сегментов segment_size - overlap должен быть положительным, а окна сшивки в начале и в конце
+        # сегмента не должны перекрываться; экспорт сверяется с той же длиной сегмента в _check_export
+        if not 0 < self.overlap <= self.segment_size // 2:
+            raise ValueError(f"DENOISER_OVERLAP_SAMPLES={self.overlap} вне допустимого диапазона 1..{self.segment_size // 2} "
+                             f"для сегмента {self.segment_size} отсчётов (DENOISER_SEGMENT_SECONDS={DENOISER_SEGMENT_SECONDS})")
+
+        if DENOISER_BACKEND == "tensorflow":
+            self.model = unet.build_model_denoise(unet_args=self.args.unet)
+            source = DENOISER_CHECKPOINT or os.path.join(DENOISER_APP_DIR, str(self.args.path_experiment), 'checkpoint')
+            self.model.load_weights(source)
+            self._predict = self._predict_keras
+        else:
+            self._check_export()
+            source = DENOISER_EXPORT_PATH
+            if DENOISER_BACKEND == "saved_model":
+                self.exported = tf.saved_model.load(DENOISER_EXPORT_PATH)
+                self._predict = self.exported.denoise
+            else:
+                if onnxruntime is None:
+                    raise RuntimeError("Пакет onnxruntime не установлен")
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                options.intra_op_num_threads = DENOISER_CPU_THREADS
+                self.session = onnxruntime.InferenceSession(DENOISER_EXPORT_PATH, options, providers=["CPUExecutionProvider"])
+                self._predict = self._predict_onnx
+        logger.info(f"Модель historical-denoise ({DENOISER_BACKEND}) загружена из {source} (сегмент {self.segment_size} отсчётов, "
+                    f"перекрытие {self.overlap}, батч {DENOISER_BATCH_SIZE}, потоков {DENOISER_CPU_THREADS or 'по умолчанию'})")
+
+    def _check_export(self):
+        """Экспорт привязан к длине сегмента и параметрам STFT: с другими настройками вход модели не совпадёт."""
+        with open(get_export_meta_path(), encoding='utf-8') as f:
+            meta = json.load(f)
+        expected = {"segment_size": self.segment_size, "win_size": self.win_size, "hop_size": self.hop_size}
+        mismatched = {key: meta.get(key) for key, value in expected.items() if meta.get(key) != value}
+        if mismatched:
+            raise ValueError(f"Экспорт {DENOISER_EXPORT_PATH} сделан для других параметров: {mismatched}, ожидается {expected}")
+
+    def _predict_keras(self, stft_batch):
+        outputs = self.model(stft_batch, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = outputs[0] # выход второго (финального) этапа
+        return outputs
+
+    def _predict_onnx(self, stft_batch):
+        return self.session.run(None, {self.session.get_inputs()[0].name: np.asarray(stft_batch, dtype=np.float32)})[0]
+
+    def _stft(self, segment):
+        stft_signal = self.tf.signal.stft(segment, frame_length=self.win_size, frame_step=self.hop_size,
+                                          window_fn=self.tf.signal.hamming_window, pad_end=True)
+        return self.tf.stack(values=[self.tf.math.real(stft_signal), self.tf.math.imag(stft_signal)], axis=-1)
+
+    def _istft(self, stacked):
+        inv_window_fn = self.tf.signal.inverse_stft_window_fn(self.hop_size, forward_window_fn=self.tf.signal.hamming_window)
+        complex_stft = self.tf.complex(stacked[..., 0], stacked[..., 1])
+        return self.tf.signal.inverse_stft(complex_stft, self.win_size, self.hop_size, window_fn=inv_window_fn)
+
+    def _denoise_batch(self, segments):
+        """segments - массив [batch, segment_size]; возвращает очищенные сегменты той же формы."""
+        outputs = self._predict(self._stft(self.tf.constant(segments, dtype=self.tf.float32)))
+        return np.asarray(self._istft(self.tf.convert_to_tensor(outputs)))[:, :self.segment_size]
+
+    def iter_denoised_blocks(self, data):
+        """
+        Очищает моно-сигнал с частотой DENOISER_SAMPLE_RATE и отдаёт результат блоками [1, frames]
+        в сумме той же длины. Хвост перекрытия каждого сегмента держится до следующего сегмента,
+        поэтому в памяти одновременно только батч сегментов, а не вся очищенная запись.
+        Слот INFERENCE_SLOTS занимается только на время инференса батча: пока потребитель блоков
+        кодирует и выгружает их в MinIO, слот свободен для инференса следующей задачи.
+        """
+        length = len(data)
+        window = np.hanning(2 * self.overlap)
+        window_left, window_right = window[:self.overlap], window[self.overlap:]
+
+        pointers, pointer = [], 0
+        while pointer < length:
+            pointers.append(pointer)
+            if pointer + self.segment_size >= length:
+                break
+            pointer += self.segment_size - self.overlap
+
+        carry = None # хвост предыдущего сегмента, уже умноженный на окно
+        inference_seconds = 0.0
+        for batch_start in range(0, len(pointers), DENOISER_BATCH_SIZE):
+            batch_pointers = pointers[batch_start:batch_start + DENOISER_BATCH_SIZE]
+            segments = np.zeros((len(batch_pointers), self.segment_size), dtype=np.float32)
+            for row, pointer in enumerate(batch_pointers):
+                segment = data[pointer:pointer + self.segment_size]
+                segments[row, :len(segment)] = segment
+
+            with INFERENCE_SLOTS:
+                inference_started = time.monotonic()
+                preds = self._denoise_batch(segments)
+                inference_seconds += time.monotonic() - inference_started
+            for pointer, pred in zip(batch_pointers, preds):
+                if pointer > 0:
+                    pred[:self.overlap] = pred[:self.overlap] * window_left + carry
+                if pointer + self.segment_size >= length:
+                    yield pred[None, :length - pointer]
+                else:
+                    pred[-self.overlap:] *= window_right
+                    carry = pred[-self.overlap:].copy()
+                    yield pred[None, :-self.overlap]
+        observe_stage("inference", inference_seconds)
+
+    def denoise(self, data):
+        """Очищает моно-сигнал с частотой DENOISER_SAMPLE_RATE и возвращает массив той же длины."""
+        blocks = [block[0] for block in self.iter_denoised_blocks(data)]
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+
+
+def get_export_meta_path():
+    return os.path.join(os.path.dirname(os.path.normpath(DENOISER_EXPORT_PATH)), 'export.json')
+
+
+def get_denoise_engine():
+    """Возвращает движок historical-denoise, загружая модель при первом обращении."""
+    global denoise_engine
+    with denoise_engine_lock:
+        if denoise_engine is None:
+            load_started = time.monotonic()
+            denoise_engine = HistoricalDenoiseEngine()
+            logger.info(f"Движок historical-denoise готов за {time.monotonic() - load_started:.2f} с.")
+    return denoise_engine
+
+
+def run_historical_denoise_process(task_id, data, output_bucket, output_object_name):
+    """
+    Выполняет historical-denoise в процессе воркера и выгружает результат в MinIO потоком, минуя диск.
+    data - моно-сигнал с частотой DENOISER_SAMPLE_RATE, декодированный из входного объекта.
+    Очищенные блоки кодируются и выгружаются по мере готовности, так что пик памяти не зависит от длины записи.
+    """
+    logger.info(f"Задача {task_id}: Выполнение Historical Denoise ({len(data) / DENOISER_SAMPLE_RATE:.1f} с аудио) "
+                f"с выгрузкой в s3://{output_bucket}/{output_object_name}")
+    try:
+        processing_started = time.monotonic()
+        engine = get_denoise_engine()
+        # Инференс идёт по мере того, как put_object читает блоки; слот занимается на каждый батч отдельно
+        uploaded_bytes = upload_audio_to_minio(minio_client, output_bucket, output_object_name, engine.iter_denoised_blocks(data),
+                                               DENOISER_SAMPLE_RATE, channels=1, frames=len(data))
+    except S3Error:
+        raise
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: Исключение во время выполнения Historical Denoise: {e}")
+        return {"error_message": f"Исключение при выполнении Historical Denoise: {str(e)}"}
+    logger.info(f"Задача {task_id}: Обработка Historical Denoise успешна за {time.monotonic() - processing_started:.2f} с, "
+                f"результат загружен в MinIO ({uploaded_bytes} байт).")
+    return None
+
+
+def get_cache_params():
+    """Параметры, от которых зависит результат очистки: входят в ключ кэша."""
+    backend = {"name": DENOISER_BACKEND, "path": DENOISER_EXPORT_PATH} if DENOISER_BACKEND != "tensorflow" else None
+    return {"service": "historical_denoise", "config": DENOISER_CONFIG_PATH, "checkpoint": DENOISER_CHECKPOINT, "backend": backend,
+            "segment_seconds": DENOISER_SEGMENT_SECONDS, "overlap_samples": DENOISER_OVERLAP_SAMPLES,
+            "format": OUTPUT_FORMAT, "opus_bitrate": OPUS_BITRATE if OUTPUT_FORMAT == "opus" else None}
 
 
 def process_single_task(task_id, input_bucket, input_object_name, output_file_basename):
     """Полный цикл обработки одной задачи: скачать, обработать, загрузить."""
+    task_started = time.monotonic()
     if not minio_client:
         logger.error(f"Задача {task_id}: Клиент MinIO недоступен. Невозможно обработать задачу.")
         return {"error_message": "Клиент MinIO недоступен. Ошибка конфигурации воркера."}
 
-    with tempfile.TemporaryDirectory(prefix="hd_worker_docker_mount_") as host_temp_docker_data_dir:
-        with tempfile.NamedTemporaryFile(delete=False, prefix=f"{task_id}_", suffix=os.path.splitext(input_object_name)[1]) as temp_downloaded_file_on_host:
-            host_local_downloaded_path = temp_downloaded_file_on_host.name
-        
-        try:
-            logger.info(f"Задача {task_id}: Загрузка s3://{input_bucket}/{input_object_name} в {host_local_downloaded_path}")
-            minio_client.fget_object(input_bucket, input_object_name, host_local_downloaded_path)
+    output_format = get_output_format()
+    minio_output_object_name = f"results/historical_denoise/{task_id}_{output_file_basename}_denoised{output_format['extension']}"
+    success_result = {
+        "output_bucket_name": input_bucket,
+        "output_object_name": minio_output_object_name,
+        "output_format": OUTPUT_FORMAT,
+        "content_type": output_format["content_type"],
+        "message": "Обработка Historical Denoise успешно завершена."
+    }
 
-            denoised_file_path_on_host, processing_error = run_historical_denoise_process(
-                task_id,
-                host_local_downloaded_path,
-                host_temp_docker_data_dir
-            )
-            
-            if processing_error:
-                return processing_error
-
-            minio_output_object_name = f"results/historical_denoise/{task_id}_{output_file_basename}_denoised.wav"
-            logger.info(f"Задача {task_id}: Загрузка {denoised_file_path_on_host} в s3://{input_bucket}/{minio_output_object_name}")
-            minio_client.fput_object(
-                input_bucket,
-                minio_output_object_name,
-                denoised_file_path_on_host, 
-                content_type='audio/wav'
-            )
-            logger.info(f"Задача {task_id}: Результат успешно загружен в MinIO.")
-            return {
-                "output_bucket_name": input_bucket,
-                "output_object_name": minio_output_object_name,
-                "message": "Обработка Historical Denoise успешно завершена."
-            }
-
-        except S3Error as e: 
-            logger.error(f"Задача {task_id}: Ошибка операции MinIO: {e}")
-            return {"error_message": f"Ошибка операции MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
-        except Exception as e: 
-            logger.exception(f"Задача {task_id}: Необработанное исключение в process_single_task: {e}")
-            return {"error_message": f"Необработанное исключение в process_single_task: {str(e)}"}
-        finally:
-            if os.path.exists(host_local_downloaded_path):
-                 try: os.remove(host_local_downloaded_path)
-                 except OSError as e_remove: logger.warning(f"Не удалось удалить временный загруженный файл {host_local_downloaded_path}: {e_remove}")
+    # Проверка кэша по ETag: при попадании файл даже не скачивается
+    cache_params = get_cache_params()
+    etag_cache_key = get_etag_cache_key(minio_client, input_bucket, input_object_name, cache_params, task_id)
+    manifest = lookup_cached_result(minio_client, input_bucket, "historical_denoise", etag_cache_key, task_id)
+    if manifest and restore_cached_artifact(minio_client, input_bucket, manifest, minio_output_object_name, task_id):
+        return {**success_result, "cache_hit": True}
+
+    try:
+        logger.info(f"Задача {task_id}: Чтение s3://{input_bucket}/{input_object_name}")
+        data, content_sha256 = decode_object_audio_shared(minio_client, input_bucket, input_object_name,
+                                                   DENOISER_SAMPLE_RATE, 1, task_id)
+
+        # Проверка кэша по содержимому: тот же файл мог быть загружен под другим именем
+        content_cache_key = get_content_cache_key(content_sha256, cache_params)
+        manifest = lookup_cached_result(minio_client, input_bucket, "historical_denoise", content_cache_key, task_id)
+        if manifest and restore_cached_artifact(minio_client, input_bucket, manifest, minio_output_object_name, task_id):
+            link_cached_result(minio_client, input_bucket, "historical_denoise", manifest, etag_cache_key, task_id)
+            return {**success_result, "cache_hit": True}
+
+        audio_seconds = data.shape[-1] / DENOISER_SAMPLE_RATE
+        processing_error = run_historical_denoise_process(task_id, data[0], input_bucket, minio_output_object_name)
+        del data
+        if processing_error:
+            return processing_error
+        observe_realtime_factor(os.path.basename(DENOISER_CHECKPOINT or "default"), time.monotonic() - task_started, audio_seconds)
+
+        store_cached_result(minio_client, input_bucket, "historical_denoise", [etag_cache_key, content_cache_key],
+                            {"message": success_result["message"]}, artifact_object=minio_output_object_name,
+                            artifact_suffix=get_output_format()["extension"], task_id=task_id)
+        return success_result
+
+    except S3Error as e: 
+        logger.error(f"Задача {task_id}: Ошибка операции MinIO: {e}")
+        return {"error_message": f"Ошибка операции MinIO: {str(e)}", "details": {"bucket": input_bucket, "object": input_object_name}}
+    except Exception as e: 
+        logger.exception(f"Задача {task_id}: Необработанное исключение в process_single_task: {e}")
+        return {"error_message": f"Необработанное исключение в process_single_task: {str(e)}"}
 
 
 def on_message_callback(channel, method_frame, properties, body):
@@ -276,13 +1016,150 @@ def on_message_callback(channel, method_frame, properties, body):
         channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
 
 
+class TaskDelivery:
+    """
+    Доставка задачи, которую обрабатывает рабочий поток. Канал BlockingConnection нельзя
+    трогать вне потока соединения, поэтому publish/ack/nack копятся и по завершении задачи
+    одним пакетом передаются в поток соединения через add_callback_threadsafe.
+
+    Если соединение оборвалось во время инференса, брокер доставит сообщение повторно
+    (redelivered=True): доставка перепривязывается к новому каналу и результат уходит
+    уже по нему, а задача не выполняется второй раз.
+    """
+
+    def __init__(self, task_key, connection, channel, delivery_tag):
+        self.task_key = task_key
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+        self._operations = []
+
+    @property
+    def is_open(self):
+        # Операции копятся и отправляются по актуальной привязке, поэтому доставка всегда их принимает
+        return True
+
+    def rebind(self, connection, channel, delivery_tag):
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+
+    def basic_publish(self, **kwargs):
+        self._operations.append(("basic_publish", kwargs))
+
+    def basic_ack(self, **kwargs):
+        self._operations.append(("basic_ack", kwargs))
+        self._flush()
+
+    def basic_nack(self, **kwargs):
+        self._operations.append(("basic_nack", kwargs))
+        self._flush()
+
+    def _flush(self):
+        operations, self._operations = self._operations, []
+        with DELIVERY_LOCK:
+            INFLIGHT_TASKS.pop(self.task_key, None)
+            # Результат запоминается до передачи в поток соединения: если соединение оборвётся раньше,
+            # чем callback выполнится, он будет отброшен, а повторная доставка должна найти готовый результат
+            remember_completed_task(self.task_key, operations)
+            try:
+                if not self._connection.is_open:
+                    raise ConnectionError("соединение закрыто")
+                self._connection.add_callback_threadsafe(
+                    functools.partial(replay_operations, self.task_key, self._channel, self._delivery_tag, operations))
+            except Exception as e:
+                logger.warning(f"Задача {self.task_key}: результат сохранён до повторной доставки сообщения ({e}).")
+
+
+def remember_completed_task(task_key, operations):
+    COMPLETED_TASKS[task_key] = operations
+    while len(COMPLETED_TASKS) > COMPLETED_TASKS_MAX:
+        COMPLETED_TASKS.popitem(last=False)
+
+
+def replay_operations(task_key, channel, delivery_tag, operations):
+    """
+    Выполняется в потоке соединения: публикует результаты задачи и подтверждает доставку.
+    Сохранённый результат удаляется из COMPLETED_TASKS только после успешного подтверждения,
+    до этого его найдёт повторная доставка.
+    """
+    try:
+        for method_name, kwargs in operations:
+            if method_name != "basic_publish":
+                kwargs = {**kwargs, "delivery_tag": delivery_tag}
+            getattr(channel, method_name)(**kwargs)
+    except Exception as e:
+        logger.warning(f"Задача {task_key}: не удалось отправить результат ({e}), он будет отправлен при повторной доставке.")
+        return
+    with DELIVERY_LOCK:
+        if COMPLETED_TASKS.get(task_key) is operations:
+            del COMPLETED_TASKS[task_key]
+
+
+def get_task_key(properties, body):
+    return (properties and properties.message_id) or hashlib.sha256(body).hexdigest()
+
+
+def get_consumer_arguments():
+    # Подтверждение приходит только после выгрузки результата, поэтому для часовых записей
+    # тайм-аут брокера на ack (по умолчанию 30 минут) может понадобиться увеличить
+    return {"x-consumer-timeout": RABBITMQ_CONSUMER_TIMEOUT_MS} if RABBITMQ_CONSUMER_TIMEOUT_MS > 0 else None
+
+
+def get_task_executor():
+    global TASK_EXECUTOR
+    if TASK_EXECUTOR is None:
+        TASK_EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY, thread_name_prefix="task")
+    return TASK_EXECUTOR
+
+
+def _run_task_in_pool(delivery, method_frame, properties, body):
+    observe_queue_wait(properties)
+    try:
+        on_message_callback(delivery, method_frame, properties, body)
+    except Exception as e:
+        logger.exception(f"Необработанное исключение в рабочем потоке (delivery_tag={method_frame.delivery_tag}): {e}")
+        delivery.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
+
+
+def dispatch_message(channel, method_frame, properties, body, connection):
+    """Выполняется в потоке соединения: передаёт задачу в пул, не блокируя ввод-вывод и heartbeat RabbitMQ."""
+    task_key = get_task_key(properties, body)
+    with DELIVERY_LOCK:
+        if method_frame.redelivered:
+            # Не извлекается: replay_operations удалит результат сам, когда подтверждение пройдёт
+            completed_operations = COMPLETED_TASKS.get(task_key)
+            if completed_operations is not None:
+                logger.info(f"Задача {task_key}: повторная доставка уже обработанной задачи, отправляется сохранённый результат.")
+                replay_operations(task_key, channel, method_frame.delivery_tag, completed_operations)
+                return
+            inflight = INFLIGHT_TASKS.get(task_key)
+            if inflight is not None:
+                logger.info(f"Задача {task_key}: повторная доставка задачи, которая ещё выполняется. Результат будет отправлен по новой доставке.")
+                inflight.rebind(connection, channel, method_frame.delivery_tag)
+                return
+        if task_key in INFLIGHT_TASKS:
+            task_key = f"{task_key}:{uuid.uuid4()}"
+        delivery = TaskDelivery(task_key, connection, channel, method_frame.delivery_tag)
+        INFLIGHT_TASKS[task_key] = delivery
+    get_task_executor().submit(_run_task_in_pool, delivery, method_frame, properties, body)
+
+
 def main():
-    logger.info("Historical Denoise Worker запускается...")
+    logger.info(f"Historical Denoise Worker запускается... (задач одновременно: {WORKER_CONCURRENCY}, инференсов: {INFERENCE_CONCURRENCY}, prefetch: {WORKER_PREFETCH})")
 
     # Глобальная переменная minio_client инициализируется в начале файла.
     if not minio_client:
         logger.warning("Клиент MinIO не был инициализирован при запуске. Проверьте переменные окружения MINIO_ACCESS_KEY/MINIO_SECRET_KEY и доступность сервера MinIO. Воркер попытается продолжить работу, но операции MinIO завершатся ошибкой.")
 
+    start_metrics_server()
+
+    try:
+        get_denoise_engine()
+    except Exception as e:
+        logger.critical(f"Критическая ошибка: Не удалось загрузить модель historical-denoise при старте: {e}. Воркер не будет запущен.")
+        return
+
     connection = None
     retries = 0
     while retries < MAX_RETRIES_RABBITMQ or MAX_RETRIES_RABBITMQ == 0:
@@ -294,7 +1171,7 @@ def main():
                 RABBITMQ_PORT,
                 RABBITMQ_VHOST,
                 credentials,
-                heartbeat=600,
+                heartbeat=RABBITMQ_HEARTBEAT,
                 blocked_connection_timeout=300
             )
             connection = pika.BlockingConnection(parameters)
@@ -322,10 +1199,11 @@ def main():
             except Exception as e_minio_bucket:
                 logger.error(f"Ошибка при проверке существования бакета MinIO '{MINIO_DEFAULT_BUCKET}': {e_minio_bucket}. Воркер может некорректно обрабатывать задачи.")
 
-            channel.basic_qos(prefetch_count=1)
+            channel.basic_qos(prefetch_count=WORKER_PREFETCH)
             channel.basic_consume(
                 queue=RABBITMQ_CONSUME_QUEUE_NAME,
-                on_message_callback=on_message_callback
+                on_message_callback=functools.partial(dispatch_message, connection=connection),
+                arguments=get_consumer_arguments()
             )
 
             logger.info(f"[*] Ожидание задач в очереди '{RABBITMQ_CONSUME_QUEUE_NAME}'. Для выхода нажмите CTRL+C")
@@ -0,0 +1,207 @@
+"""
+Экспорт U-Net historical-denoise для инференса на CPU (DENOISER_BACKEND в app.py).
+
+Модель собирается и загружается из чекпоинта так же, как в app.py, затем сохраняется как SavedModel
+с функцией denoise (STFT-батч [batch, frames, bins, 2] -> выход финального этапа). С --onnx граф
+дополнительно конвертируется в ONNX (нужен пакет tf2onnx), с --quantize ONNX-модель динамически
+квантуется в int8 (onnxruntime.quantization). STFT/ISTFT остаются в TensorFlow на стороне воркера.
+С --check каждый экспорт сравнивается с Keras-моделью на одних и тех же сегментах; при SNR ниже
+--min-snr-db код возврата 1.
+
+Пример (в контейнере воркера):
+    python export_model.py --output /models/denoise --onnx --quantize --check
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("denoise_export")
+
+DENOISER_APP_DIR = os.getenv('DENOISER_APP_DIR', '/app')
+DENOISER_CONFIG_PATH = os.getenv('DENOISER_CONFIG_PATH', os.path.join(DENOISER_APP_DIR, 'conf', 'conf.yaml'))
+DENOISER_CHECKPOINT = os.getenv('DENOISER_CHECKPOINT')
+DENOISER_SAMPLE_RATE = 44100
+DENOISER_SEGMENT_SECONDS = float(os.getenv('DENOISER_SEGMENT_SECONDS', 5))
+
+
+def load_keras_model():
+    if DENOISER_APP_DIR not in sys.path:
+        sys.path.insert(0, DENOISER_APP_DIR)
+    from omegaconf import OmegaConf
+    import unet
+
+    args = OmegaConf.load(DENOISER_CONFIG_PATH)
+    model = unet.build_model_denoise(unet_args=args.unet)
+    checkpoint = DENOISER_CHECKPOINT or os.path.join(DENOISER_APP_DIR, str(args.path_experiment), 'checkpoint')
+    model.load_weights(checkpoint)
+    return model, args, checkpoint
+
+
+def stft(tf, segments, win_size, hop_size):
+    stft_signal = tf.signal.stft(tf.constant(segments, dtype=tf.float32), frame_length=win_size, frame_step=hop_size,
+                                 window_fn=tf.signal.hamming_window, pad_end=True)
+    return tf.stack(values=[tf.math.real(stft_signal), tf.math.imag(stft_signal)], axis=-1)
+
+
+def build_denoise_function(tf, model, input_shape, jit_compile):
+    @tf.function(input_signature=[tf.TensorSpec([None, *input_shape], tf.float32, name="stft")], jit_compile=jit_compile)
+    def denoise(stft_batch):
+        outputs = model(stft_batch, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = outputs[0] # выход второго (финального) этапа
+        return outputs
+    return denoise
+
+
+def export_model(output_dir, export_onnx, quantize, opset, jit_compile):
+    import tensorflow as tf
+
+    model, args, checkpoint = load_keras_model()
+    segment_size = int(DENOISER_SAMPLE_RATE * DENOISER_SEGMENT_SECONDS)
+    win_size, hop_size = args.stft.win_size, args.stft.hop_size
+    input_shape = tuple(stft(tf, np.zeros((1, segment_size), dtype=np.float32), win_size, hop_size).shape[1:])
+    os.makedirs(output_dir, exist_ok=True)
+
+    started = time.monotonic()
+    module = tf.Module()
+    module.model = model
+    module.denoise = build_denoise_function(tf, model, input_shape, jit_compile)
+    saved_model_path = os.path.join(output_dir, "saved_model")
+    tf.saved_model.save(module, saved_model_path, signatures={"serving_default": module.denoise})
+    logger.info(f"SavedModel сохранена в {saved_model_path} за {time.monotonic() - started:.1f} с (вход [batch, {', '.join(map(str, input_shape))}])")
+
+    files = {"saved_model": "saved_model"}
+    if export_onnx:
+        import tf2onnx
+
+        started = time.monotonic()
+        onnx_path = os.path.join(output_dir, "model.onnx")
+        # Для ONNX функция трассируется без XLA: tf2onnx не конвертирует кластеры XLA
+        tf2onnx.convert.from_function(build_denoise_function(tf, model, input_shape, False),
+                                      input_signature=[tf.TensorSpec([None, *input_shape], tf.float32, name="stft")],
+                                      opset=opset, output_path=onnx_path)
+        files["onnx"] = "model.onnx"
+        logger.info(f"ONNX-модель сохранена в {onnx_path} за {time.monotonic() - started:.1f} с (opset {opset})")
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantized_path = os.path.join(output_dir, "model.int8.onnx")
+            quantize_dynamic(onnx_path, quantized_path, weight_type=QuantType.QInt8)
+            files["onnx_int8"] = "model.int8.onnx"
+            logger.info(f"Квантованная int8 ONNX-модель сохранена в {quantized_path}")
+
+    meta = {"checkpoint": checkpoint, "config": DENOISER_CONFIG_PATH, "segment_size": segment_size,
+            "win_size": win_size, "hop_size": hop_size, "input_shape": list(input_shape), "files": files,
+            "jit_compile": jit_compile, "tensorflow_version": tf.__version__,
+            "exported_at": datetime.now(timezone.utc).isoformat()}
+    # export.json пишется последним: воркер сверяет по нему длину сегмента и параметры STFT
+    with open(os.path.join(output_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def load_check_segments(path, segment_size, count):
+    if path:
+        # Декодируем так же, как воркер: моно float32 с частотой модели
+        cmd = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', path,
+               '-ac', '1', '-ar', str(DENOISER_SAMPLE_RATE), '-f', 'f32le', '-']
+        data = np.frombuffer(subprocess.run(cmd, check=True, capture_output=True).stdout, dtype=np.float32)
+        data = np.pad(data, (0, max(count * segment_size - len(data), 0)))
+        return data[:count * segment_size].reshape(count, segment_size)
+    return (0.1 * np.random.default_rng(0).standard_normal((count, segment_size))).astype(np.float32)
+
+
+def snr_db(reference, estimate):
+    noise = np.sum((reference - estimate) ** 2)
+    return float(10 * np.log10(np.sum(reference ** 2) / max(noise, 1e-20)))
+
+
+def check_parity(output_dir, path, count, threads):
+    """SNR (дБ) выхода каждого экспорта относительно Keras-модели на одних и тех же сегментах."""
+    import tensorflow as tf
+
+    with open(os.path.join(output_dir, "export.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    model, _, _ = load_keras_model()
+    stft_batch = stft(tf, load_check_segments(path, meta["segment_size"], count), meta["win_size"], meta["hop_size"])
+
+    predictors = {"keras": build_denoise_function(tf, model, tuple(meta["input_shape"]), False)}
+    exported = tf.saved_model.load(os.path.join(output_dir, meta["files"]["saved_model"]))
+    predictors["saved_model"] = exported.denoise
+    onnx_files = {name: file for name, file in meta["files"].items() if name.startswith("onnx")}
+    if onnx_files:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        for name, file in onnx_files.items():
+            session = onnxruntime.InferenceSession(os.path.join(output_dir, file), options, providers=["CPUExecutionProvider"])
+            predictors[name] = lambda x, session=session: session.run(None, {session.get_inputs()[0].name: np.asarray(x)})[0]
+
+    outputs, timings = {}, {}
+    for name, predict in predictors.items():
+        predict(stft_batch[:1]) # прогрев: трассировка графа и выделение буферов
+        started = time.monotonic()
+        outputs[name] = np.asarray(predict(stft_batch))
+        timings[name] = time.monotonic() - started
+    seconds = count * meta["segment_size"] / DENOISER_SAMPLE_RATE
+    logger.info(f"Время на {seconds:.1f} с аудио: " + ", ".join(f"{name} {value:.2f} с" for name, value in timings.items()))
+    return {name: snr_db(outputs["keras"], output) for name, output in outputs.items() if name != "keras"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Экспорт модели historical-denoise для CPU")
+    parser.add_argument("--output", default="/models/denoise", help="Каталог для saved_model/, model.onnx и export.json")
+    parser.add_argument("--onnx", action="store_true", help="Дополнительно конвертировать в ONNX (нужен tf2onnx)")
+    parser.add_argument("--quantize", action="store_true", help="Динамическое квантование ONNX-модели в int8")
+    parser.add_argument("--opset", type=int, default=17, help="Версия opset ONNX")
+    parser.add_argument("--jit-compile", action="store_true", help="Компилировать функцию SavedModel через XLA")
+    parser.add_argument("--threads", type=int, default=0, help="Потоков intra-op (0 - по умолчанию)")
+    parser.add_argument("--skip-export", action="store_true", help="Только проверить уже экспортированную модель")
+    parser.add_argument("--check", action="store_true", help="Сравнить экспорт с Keras-моделью")
+    parser.add_argument("--check-input", help="Аудиофайл для проверки (по умолчанию шум)")
+    parser.add_argument("--check-segments", type=int, default=4, help="Число сегментов для проверки")
+    parser.add_argument("--min-snr-db", type=float, default=60.0, help="Минимальный SNR для float-экспорта")
+    parser.add_argument("--min-snr-db-int8", type=float, default=20.0, help="Минимальный SNR для int8-модели")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.quantize and not args.onnx:
+        logger.error("--quantize применяется только вместе с --onnx")
+        return 2
+    if args.threads > 0:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+
+    if not args.skip_export:
+        meta = export_model(args.output, args.onnx, args.quantize, args.opset, args.jit_compile)
+        logger.info(f"Экспорт завершён: {args.output} ({', '.join(meta['files'])})")
+
+    if args.check or args.skip_export:
+        results = check_parity(args.output, args.check_input, args.check_segments, args.threads)
+        failed = []
+        for name, value in results.items():
+            threshold = args.min_snr_db_int8 if name == "onnx_int8" else args.min_snr_db
+            if value < threshold:
+                failed.append(name)
+            logger.info(f"SNR {name}: {value:.1f} дБ (порог {threshold:.0f} дБ){' - ниже порога' if name in failed else ''}")
+        if failed:
+            logger.error(f"Экспорт расходится с Keras-моделью: {', '.join(failed)}")
+            return 1
+        logger.info("Паритет с Keras-моделью подтверждён")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,5 +6,6 @@ public interface ITaskResultHandler
 {
     Task HandleDemucsResultAsync(DemucsResultData result);
     Task HandleWhisperResultAsync(WhisperResultData result);
+    Task HandleWhisperPartialResultAsync(WhisperPartialResultData result);
     Task HandleFailedResultAsync(TaskResultBase result, string originalMessage);
 }
\ No newline at end of file
@@ -10,6 +10,15 @@ public class AudioRecordForElastic
     public string Title { get; set; }                // Название песни
     public ICollection<TranscriptSegment> TranscriptSegments { get; set; }
     public string FullText { get; set; }
+    // Задача Whisper, чьи сегменты записаны в транскрипцию, и номер последней дописанной пачки
+    public string TranscriptTaskId { get; set; }
+    public int? TranscriptSequence { get; set; }
+    // Уровень качества транскрипции: "fast" - кандидат на повторный прогон с quality_tier=high,
+    // "preview" - предварительный результат, его заменит окончательный той же задачи
+    public string TranscriptQualityTier { get; set; }
+    // Ревизия результата задачи и его вид: "preview" заменяется результатом "final" с большей ревизией
+    public int? TranscriptRevision { get; set; }
+    public string TranscriptKind { get; set; }
     
     public string Path { get; set; }
     public string AuthorName { get; set; }
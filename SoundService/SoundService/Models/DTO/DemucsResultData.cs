@@ -12,8 +12,23 @@ public class DemucsResultData:  TaskResultBase
 
     [JsonPropertyName("output_object_name")]
     public string OutputObjectName { get; set; }
+
+    // Формат файла результата ("flac", "opus", "wav") и его Content-Type для потоковой отдачи
+    [JsonPropertyName("output_format")]
+    public string? OutputFormat { get; set; }
+
+    [JsonPropertyName("content_type")]
+    public string? ContentType { get; set; }
     
     // ДОБАВЛЕНО: Путь к исходному файлу, который был обработан Demucs
     [JsonPropertyName("original_input_object")]
     public string OriginalInputObject { get; set; }
+
+    // Воркер в совмещённом режиме уже распознал вокал и опубликовал результат Whisper
+    [JsonPropertyName("transcription_included")]
+    public bool TranscriptionIncluded { get; set; }
+
+    // "high" или "fast": под нагрузкой воркер переходит на более дешёвую модель
+    [JsonPropertyName("quality_tier")]
+    public string? QualityTier { get; set; }
 }
\ No newline at end of file
@@ -6,6 +6,10 @@ public class DemucsTaskData
 {
     public string TaskId { get; set; }
     public string MinioFilePath { get; set; }
+
+    // null - уровень качества выбирает воркер по своей очереди; "high" - повторный прогон в высоком качестве
+    [JsonPropertyName("quality_tier")]
+    public string? QualityTier { get; set; }
     
    
 }
\ No newline at end of file
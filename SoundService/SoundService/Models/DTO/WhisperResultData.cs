@@ -16,6 +16,78 @@ public class WhisperResultData : TaskResultBase
     
     [JsonPropertyName("segments")]
     public List<WhisperSegment> Segments { get; set; }
+
+    // Сколько промежуточных пачек было опубликовано до этого финального сообщения
+    [JsonPropertyName("partials_published")]
+    public int PartialsPublished { get; set; }
+
+    // "inline" - текст и сегменты в сообщении; "reference" - только ссылка на transcription_detailed.json в MinIO
+    [JsonPropertyName("result_payload")]
+    public string ResultPayload { get; set; }
+
+    [JsonPropertyName("transcription_detailed_json_object_path")]
+    public string TranscriptionObjectPath { get; set; }
+
+    // sha256 байтов объекта в MinIO (после сжатия, если оно есть)
+    [JsonPropertyName("transcription_sha256")]
+    public string TranscriptionSha256 { get; set; }
+
+    // null или "gzip"
+    [JsonPropertyName("transcription_content_encoding")]
+    public string TranscriptionContentEncoding { get; set; }
+
+    [JsonPropertyName("segments_count")]
+    public int SegmentsCount { get; set; }
+
+    // "high" или "fast": под нагрузкой воркер переходит на более лёгкую модель; "preview" - предварительный результат
+    [JsonPropertyName("quality_tier")]
+    public string? QualityTier { get; set; }
+
+    // "preview" - быстрый предварительный результат, "final" - результат полного прохода с тем же TaskId
+    [JsonPropertyName("result_kind")]
+    public string? ResultKind { get; set; }
+
+    // Номер ревизии результата задачи: окончательный результат приходит с большей ревизией, чем предварительный
+    [JsonPropertyName("revision")]
+    public int Revision { get; set; }
+}
+
+/// <summary>
+/// Содержимое transcription_detailed.json
+/// </summary>
+public class WhisperTranscriptionDetailed
+{
+    [JsonPropertyName("full_text")]
+    public string FullText { get; set; }
+
+    [JsonPropertyName("segments")]
+    public List<WhisperSegment> Segments { get; set; }
+}
+
+/// <summary>
+/// Пачка готовых сегментов длинной транскрипции, публикуется до финального результата
+/// </summary>
+public class WhisperPartialResultData : TaskResultBase
+{
+    [JsonPropertyName("input_object")]
+    public string InputObject { get; set; }
+
+    // Номер пачки в рамках задачи, начиная с 1
+    [JsonPropertyName("sequence")]
+    public int Sequence { get; set; }
+
+    // До какого места исходной записи дошло распознавание (в секундах)
+    [JsonPropertyName("audio_offset_seconds")]
+    public double AudioOffsetSeconds { get; set; }
+
+    [JsonPropertyName("audio_duration_seconds")]
+    public double AudioDurationSeconds { get; set; }
+
+    [JsonPropertyName("text")]
+    public string Text { get; set; }
+
+    [JsonPropertyName("segments")]
+    public List<WhisperSegment> Segments { get; set; }
 }
 
 public class WhisperSegment
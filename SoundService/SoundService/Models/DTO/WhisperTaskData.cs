@@ -12,5 +12,9 @@ public class WhisperTaskData
     // ДОБАВЛЕНО: Путь к самому первому файлу в цепочке 
     [JsonPropertyName("original_input_object")]
     public string OriginalInputObject { get; set; }
+
+    // null - уровень качества выбирает воркер по своей очереди; "high" - повторный прогон в высоком качестве
+    [JsonPropertyName("quality_tier")]
+    public string? QualityTier { get; set; }
     
 }
\ No newline at end of file
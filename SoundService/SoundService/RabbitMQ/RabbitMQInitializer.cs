@@ -66,6 +66,10 @@ public class RabbitMQInitializer : IHostedService
             // Очередь для результатов Whisper
             await _channel.QueueDeclareAsync(queue: _conf.WhisperResultQueue, durable: true, exclusive: false, autoDelete: false);
             await _channel.QueueBindAsync(queue: _conf.WhisperResultQueue, exchange: _conf.ResultsExchange, routingKey: _conf.WhisperResultRoutingKey);
+
+            // Очередь для промежуточных результатов Whisper (пачки сегментов длинных записей)
+            await _channel.QueueDeclareAsync(queue: _conf.WhisperPartialQueue, durable: true, exclusive: false, autoDelete: false);
+            await _channel.QueueBindAsync(queue: _conf.WhisperPartialQueue, exchange: _conf.ResultsExchange, routingKey: _conf.WhisperPartialRoutingKey);
             
             _logger.LogInformation("RabbitMQ infrastructure declared successfully.");
         }
@@ -17,6 +17,8 @@ public class RabbitMqConf
     public string WhisperTaskRoutingKey { get; }
     public string WhisperResultQueue { get; }
     public string WhisperResultRoutingKey { get; }
+    public string WhisperPartialQueue { get; }
+    public string WhisperPartialRoutingKey { get; }
 
     public RabbitMqConf(IConfiguration configuration)
     {
@@ -35,5 +37,13 @@ public class RabbitMqConf
         WhisperTaskRoutingKey = configuration["RABBITMQ_WHISPER_TASK_ROUTING_KEY"];
         WhisperResultQueue = configuration["RABBITMQ_WHISPER_RESULT_QUEUE"];
         WhisperResultRoutingKey = configuration["RABBITMQ_WHISPER_RESULT_ROUTING_KEY"];
+
+        // Промежуточные результаты длинных транскрипций: по умолчанию очередь и ключ результатов с суффиксом .partial
+        WhisperPartialQueue = string.IsNullOrEmpty(configuration["RABBITMQ_WHISPER_PARTIAL_QUEUE"])
+            ? $"{WhisperResultQueue}.partial"
+            : configuration["RABBITMQ_WHISPER_PARTIAL_QUEUE"];
+        WhisperPartialRoutingKey = string.IsNullOrEmpty(configuration["RABBITMQ_WHISPER_PARTIAL_ROUTING_KEY"])
+            ? $"{WhisperResultRoutingKey}.partial"
+            : configuration["RABBITMQ_WHISPER_PARTIAL_ROUTING_KEY"];
     }
 }
\ No newline at end of file
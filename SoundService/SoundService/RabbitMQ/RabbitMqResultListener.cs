@@ -48,6 +48,7 @@ public class RabbitMqResultListener: BackgroundService
 
                 await SetupConsumer(_conf.DemucsResultQueue, _conf.DemucsResultRoutingKey, stoppingToken);
                 await SetupConsumer(_conf.WhisperResultQueue, _conf.WhisperResultRoutingKey, stoppingToken);
+                await SetupConsumer(_conf.WhisperPartialQueue, _conf.WhisperPartialRoutingKey, stoppingToken);
 
                 // Держим ExecuteAsync живым, пока не придет сигнал отмены
                 await Task.Delay(Timeout.Infinite, stoppingToken);
@@ -104,6 +105,11 @@ public class RabbitMqResultListener: BackgroundService
                     var whisperResult = JsonSerializer.Deserialize<WhisperResultData>(message);
                     await resultHandler.HandleWhisperResultAsync(whisperResult);
                 }
+                else if (ea.RoutingKey == _conf.WhisperPartialRoutingKey)
+                {
+                    var partialResult = JsonSerializer.Deserialize<WhisperPartialResultData>(message);
+                    await resultHandler.HandleWhisperPartialResultAsync(partialResult);
+                }
                 else
                 {
                     _logger.LogWarning("Unknown routing key '{RoutingKey}' for message: {Message}", ea.RoutingKey, message);
@@ -111,6 +117,12 @@ public class RabbitMqResultListener: BackgroundService
                 
                 await _channel.BasicAckAsync(ea.DeliveryTag, false);
             }
+            catch (InvalidDataException dataEx)
+            {
+                // Артефакт по ссылке повреждён или не совпадает с контрольной суммой: повтор не поможет
+                _logger.LogError(dataEx, "Result artifact is invalid. Message: {Message}", message);
+                await _channel.BasicNackAsync(ea.DeliveryTag, false, false);
+            }
             catch (JsonException jsonEx)
             {
                  _logger.LogError(jsonEx, "Failed to deserialize message. Moving to dead-letter queue if configured. Message: {Message}", message);
@@ -90,6 +90,10 @@ public class RabbitMqService : IDisposable
             var properties = new BasicProperties();
             properties.Persistent = true; // Делаем сообщение персистентным
             properties.ContentType = "application/json";
+            // Время публикации: воркеры считают по нему ожидание задачи в очереди
+            var publishedAt = DateTimeOffset.UtcNow;
+            properties.Timestamp = new AmqpTimestamp(publishedAt.ToUnixTimeSeconds());
+            properties.Headers = new Dictionary<string, object?> { ["x-published-at-ms"] = publishedAt.ToUnixTimeMilliseconds() };
             if (!string.IsNullOrEmpty(data.TaskId)) // Предполагаем, что у DemucsTaskData есть TaskId
             {
                 properties.MessageId = data.TaskId;
@@ -129,6 +133,9 @@ public class RabbitMqService : IDisposable
             var properties = new BasicProperties();
             properties.Persistent = true;
             properties.ContentType = "application/json";
+            var publishedAt = DateTimeOffset.UtcNow;
+            properties.Timestamp = new AmqpTimestamp(publishedAt.ToUnixTimeSeconds());
+            properties.Headers = new Dictionary<string, object?> { ["x-published-at-ms"] = publishedAt.ToUnixTimeMilliseconds() };
             if (!string.IsNullOrEmpty(data.TaskId))
             {
                 properties.MessageId = data.TaskId;
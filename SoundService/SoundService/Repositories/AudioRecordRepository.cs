@@ -419,7 +419,8 @@ public class AudioRecordRepository
         return response.Documents.ToList();
     }
 
-    public async Task EditAudioRecordAsyncByPath(string path, string fulltext, List<TranscriptSegment> segments)
+    public async Task EditAudioRecordAsyncByPath(string path, string fulltext, List<TranscriptSegment> segments, string taskId = null,
+        string qualityTier = null, int revision = 1, string kind = "final")
     {
         var response = await _elasticClient.UpdateByQueryAsync<AudioRecordForElastic>("audio_records", req => req
             .Query(q => q
@@ -427,13 +428,25 @@ public class AudioRecordRepository
             )
             // 2. SCRIPT: Описать, какие поля и как нужно обновить.
             .Script(s => s
-                // Исходный код скрипта на языке Painless
+                // Исходный код скрипта на языке Painless. Финальный результат помечается максимальным номером пачки,
+                // чтобы опоздавшие промежуточные результаты той же задачи его не дописывали. Результат с меньшей
+                // ревизией той же задачи (предварительный, пришедший после окончательного) не применяется
                 .Source(
-                    "ctx._source.fullText = params.newFullText; ctx._source.transcriptSegments = params.newSegments;")
+                    "if (ctx._source.transcriptTaskId == params.taskId && ctx._source.transcriptRevision != null && " +
+                    "ctx._source.transcriptRevision > params.revision) { ctx.op = 'noop'; } else { " +
+                    "ctx._source.fullText = params.newFullText; ctx._source.transcriptSegments = params.newSegments; " +
+                    "ctx._source.transcriptTaskId = params.taskId; ctx._source.transcriptSequence = params.finalSequence; " +
+                    "ctx._source.transcriptQualityTier = params.qualityTier; ctx._source.transcriptRevision = params.revision; " +
+                    "ctx._source.transcriptKind = params.kind; }")
                 // Передача параметров в скрипт. Это безопасно и эффективно.
                 .Params(p => p
                     .Add("newFullText", fulltext)
                     .Add("newSegments", segments)
+                    .Add("taskId", taskId ?? string.Empty)
+                    .Add("finalSequence", int.MaxValue)
+                    .Add("qualityTier", qualityTier ?? "high")
+                    .Add("revision", revision)
+                    .Add("kind", kind ?? "final")
                 )
             )
             // Опционально: не останавливаться при конфликтах версий
@@ -468,6 +481,50 @@ public class AudioRecordRepository
         }
     }
 
+    /// <summary>
+    /// Дописывает пачку сегментов промежуточного результата к транскрипции трека по указанному пути.
+    /// Первая пачка новой задачи заменяет прежнюю транскрипцию; повторные и опоздавшие пачки
+    /// (номер не больше уже записанного) пропускаются
+    /// </summary>
+    public async Task AppendTranscriptAsyncByPath(string path, string taskId, int sequence, string text,
+        List<TranscriptSegment> segments)
+    {
+        var response = await _elasticClient.UpdateByQueryAsync<AudioRecordForElastic>("audio_records", req => req
+            .Query(q => q
+                .Term(t => t.Field("path.keyword").Value(path))
+            )
+            .Script(s => s
+                .Source(
+                    "if (ctx._source.transcriptTaskId != params.taskId) { " +
+                    "ctx._source.transcriptTaskId = params.taskId; ctx._source.transcriptSequence = 0; " +
+                    "ctx._source.fullText = ''; ctx._source.transcriptSegments = []; } " +
+                    "if (ctx._source.transcriptSequence != null && params.sequence <= ctx._source.transcriptSequence) { ctx.op = 'noop'; } " +
+                    "else { " +
+                    "ctx._source.fullText = (ctx._source.fullText == null ? '' : ctx._source.fullText) + params.text; " +
+                    "if (ctx._source.transcriptSegments == null) { ctx._source.transcriptSegments = []; } " +
+                    "ctx._source.transcriptSegments.addAll(params.newSegments); " +
+                    "ctx._source.transcriptSequence = params.sequence; }")
+                .Params(p => p
+                    .Add("taskId", taskId ?? string.Empty)
+                    .Add("sequence", sequence)
+                    .Add("text", text ?? string.Empty)
+                    .Add("newSegments", segments)
+                )
+            )
+            .Conflicts(Conflicts.Proceed)
+            .WaitForCompletion(true)
+        );
+
+        if (!response.IsValidResponse)
+        {
+            _logger.LogError("Ошибка при дописывании транскрипции для '{Path}': {Debug}", path, response.DebugInformation);
+        }
+        else if (response.Total == 0)
+        {
+            _logger.LogWarning("Документ с путем '{Path}' не найден, промежуточный результат #{Sequence} пропущен.", path, sequence);
+        }
+    }
+
     public async Task<List<AudioRecordForElastic>> GetTracksByThematicTags(IEnumerable<string> tags, int from,
         int size)
     {
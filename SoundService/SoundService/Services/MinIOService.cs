@@ -37,6 +37,31 @@ public class MinIOService
         }
     }
 
+    /// <summary>
+    /// Читает объект из произвольного бакета целиком в память (небольшие артефакты воркеров)
+    /// </summary>
+    public async Task<byte[]> GetObjectBytesAsync(string bucketName, string objectName, CancellationToken ct = default)
+    {
+        try
+        {
+            using var stream = new MemoryStream();
+            var getArgs = new GetObjectArgs()
+                .WithBucket(bucketName)
+                .WithObject(objectName)
+                .WithCallbackStream(async (s, token) =>
+                {
+                    await s.CopyToAsync(stream, 81920, token);
+                });
+
+            await _minioClient.GetObjectAsync(getArgs, ct).ConfigureAwait(false);
+            return stream.ToArray();
+        }
+        catch (Minio.Exceptions.ObjectNotFoundException)
+        {
+            throw new FileNotFoundException($"Object '{objectName}' not found in bucket '{bucketName}'.");
+        }
+    }
+
     public async Task<(Stream, string, long)> GetTrackAsync(string objectName, CancellationToken ct = default)
     {
         try
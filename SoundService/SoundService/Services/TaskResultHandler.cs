@@ -1,4 +1,7 @@
-﻿using SoundService.Abstractions;
+﻿using System.IO.Compression;
+using System.Security.Cryptography;
+using System.Text.Json;
+using SoundService.Abstractions;
 using SoundService.Models;
 using SoundService.RabbitMQ;
 using SoundService.Repositories;
@@ -10,12 +13,14 @@ public class TaskResultHandler : ITaskResultHandler
     private readonly ILogger<TaskResultHandler> _logger;
     private readonly RabbitMqService _rabbitMQService;
     private readonly AudioRecordRepository _audioRecordRepository;
+    private readonly MinIOService _minioService;
     public TaskResultHandler(ILogger<TaskResultHandler> logger, RabbitMqService rabbitMQService
-    , AudioRecordRepository audioRecordRepository)
+    , AudioRecordRepository audioRecordRepository, MinIOService minioService)
     {
         _logger = logger;
         _rabbitMQService = rabbitMQService;
         _audioRecordRepository = audioRecordRepository;
+        _minioService = minioService;
     }
 
     /// <summary>
@@ -25,8 +30,15 @@ public class TaskResultHandler : ITaskResultHandler
     /// <param name="result"></param>
     public async Task HandleDemucsResultAsync(DemucsResultData result)
     {
-        _logger.LogInformation("Получен успешный результат от Demucs для TaskId: {TaskId}. Файл: s3://{Bucket}/{Object}",
-            result.TaskId, result.OutputBucketName, result.OutputObjectName);
+        _logger.LogInformation("Получен успешный результат от Demucs для TaskId: {TaskId}. Файл: s3://{Bucket}/{Object} ({Format}, качество {Tier})",
+            result.TaskId, result.OutputBucketName, result.OutputObjectName, result.OutputFormat ?? "wav", result.QualityTier ?? "high");
+
+        if (result.TranscriptionIncluded)
+        {
+            // Транскрипция вокала придёт отдельным сообщением с ключом результатов Whisper
+            _logger.LogInformation("TaskId: {TaskId}: транскрипция выполнена воркером Demucs, задача Whisper не нужна", result.TaskId);
+            return;
+        }
         
         var whisperTaskData = new WhisperTaskData()
         {
@@ -46,6 +58,10 @@ public class TaskResultHandler : ITaskResultHandler
     /// <returns></returns>
     public async Task HandleWhisperResultAsync(WhisperResultData result)
     {
+        if (result.ResultPayload == "reference")
+        {
+            await LoadTranscriptionAsync(result);
+        }
         var path = result.InputObject;
         _logger.LogInformation("Получен успешный результат от Whisper для TaskId: {TaskId}. Текст: {Text}. Изначальный файл {Path}",
             result.TaskId, result.FullText, path);
@@ -60,11 +76,75 @@ public class TaskResultHandler : ITaskResultHandler
             };
             segments.Add(Newsegment);
         }
-        await _audioRecordRepository.EditAudioRecordAsyncByPath(path, result.FullText, segments);
+        var revision = result.Revision > 0 ? result.Revision : 1;
+        if (result.ResultKind == "preview")
+        {
+            _logger.LogInformation("TaskId: {TaskId}: предварительная транскрипция {Path} (ревизия {Revision}), ожидается полный проход",
+                result.TaskId, path, revision);
+        }
+        else if (result.QualityTier == "fast")
+        {
+            _logger.LogWarning("TaskId: {TaskId}: транскрипция {Path} выполнена на уровне качества fast, запись помечена для повторного прогона",
+                result.TaskId, path);
+        }
+        await _audioRecordRepository.EditAudioRecordAsyncByPath(path, result.FullText, segments, result.TaskId, result.QualityTier,
+            revision, result.ResultKind ?? "final");
         // TODO: Сохранить транскрипцию в базе данных
         
     }
 
+    /// <summary>
+    /// Дописывает в Elastic очередную пачку сегментов длинной транскрипции, чтобы текст
+    /// был доступен для поиска до завершения распознавания всей записи
+    /// </summary>
+    /// <param name="result"></param>
+    /// <returns></returns>
+    public async Task HandleWhisperPartialResultAsync(WhisperPartialResultData result)
+    {
+        _logger.LogInformation("Получен промежуточный результат #{Sequence} от Whisper для TaskId: {TaskId}: {Offset:F0} из {Duration:F0} с. Изначальный файл {Path}",
+            result.Sequence, result.TaskId, result.AudioOffsetSeconds, result.AudioDurationSeconds, result.InputObject);
+        var segments = result.Segments.Select(segment => new TranscriptSegment()
+        {
+            Start = segment.Start,
+            End = segment.End,
+            Text = segment.Text
+        }).ToList();
+        await _audioRecordRepository.AppendTranscriptAsyncByPath(result.InputObject, result.TaskId, result.Sequence, result.Text, segments);
+    }
+
+    /// <summary>
+    /// Для сообщения-ссылки читает transcription_detailed.json из MinIO, сверяет sha256
+    /// и заполняет FullText и Segments
+    /// </summary>
+    /// <param name="result"></param>
+    /// <exception cref="InvalidDataException">Ссылка некорректна или объект не совпадает с контрольной суммой</exception>
+    private async Task LoadTranscriptionAsync(WhisperResultData result)
+    {
+        var uri = result.TranscriptionObjectPath;
+        if (string.IsNullOrEmpty(uri) || !uri.StartsWith("s3://") || uri.IndexOf('/', 5) < 0)
+            throw new InvalidDataException($"Некорректная ссылка на транскрипцию: '{uri}'");
+        var bucket = uri.Substring(5, uri.IndexOf('/', 5) - 5);
+        var objectName = uri.Substring(uri.IndexOf('/', 5) + 1);
+
+        var data = await _minioService.GetObjectBytesAsync(bucket, objectName);
+        var sha256 = Convert.ToHexString(SHA256.HashData(data)).ToLowerInvariant();
+        if (!string.IsNullOrEmpty(result.TranscriptionSha256) && sha256 != result.TranscriptionSha256)
+            throw new InvalidDataException($"Контрольная сумма {uri} не совпадает: {sha256} вместо {result.TranscriptionSha256}");
+
+        if (result.TranscriptionContentEncoding == "gzip")
+        {
+            using var input = new GZipStream(new MemoryStream(data), CompressionMode.Decompress);
+            using var output = new MemoryStream();
+            await input.CopyToAsync(output);
+            data = output.ToArray();
+        }
+        var transcription = JsonSerializer.Deserialize<WhisperTranscriptionDetailed>(data);
+        result.FullText = transcription?.FullText ?? string.Empty;
+        result.Segments = transcription?.Segments ?? new List<WhisperSegment>();
+        _logger.LogInformation("TaskId: {TaskId}: транскрипция прочитана из {Uri} ({Bytes} байт, сегментов: {Segments})",
+            result.TaskId, uri, data.Length, result.Segments.Count);
+    }
+
     public Task HandleFailedResultAsync(TaskResultBase result, string originalMessage)
     {
         _logger.LogError("Получен результат с ошибкой для TaskId: {TaskId}. Ошибка: {Error}. Сообщение: {OriginalMessage}",
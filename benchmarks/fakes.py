@@ -0,0 +1,158 @@
+"""
+Заглушки внешних сервисов для офлайн-бенчмарка воркеров: MinIO на локальной файловой системе
+и канал RabbitMQ, который только запоминает опубликованные сообщения и подтверждения.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from minio.error import S3Error
+
+
+class FakeObjectResponse:
+    """Ответ get_object: поддерживает read()/stream(), как urllib3.HTTPResponse в minio-py."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+
+    def read(self, amt=None):
+        return self._file.read() if amt is None else self._file.read(amt)
+
+    def stream(self, amt=64 * 1024):
+        for chunk in iter(lambda: self._file.read(amt), b''):
+            yield chunk
+
+    def close(self):
+        self._file.close()
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    """
+    Минимальная реализация API клиента Minio поверх каталога root/<bucket>/<object>.
+    Покрывает методы, которые вызывают воркеры: stat/get/put/copy/remove/list и presigned URL
+    (вместо URL возвращается локальный путь, его ffmpeg читает напрямую).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _path(self, bucket_name, object_name):
+        return os.path.join(self.root, bucket_name, object_name.lstrip('/'))
+
+    def _not_found(self, bucket_name, object_name):
+        return S3Error("NoSuchKey", "Object does not exist", f"/{bucket_name}/{object_name}", "fake", "fake", None,
+                       bucket_name=bucket_name, object_name=object_name)
+
+    def _existing_path(self, bucket_name, object_name):
+        path = self._path(bucket_name, object_name)
+        if not os.path.isfile(path):
+            raise self._not_found(bucket_name, object_name)
+        return path
+
+    def add_file(self, bucket_name, object_name, source_path):
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(source_path, path)
+
+    def bucket_exists(self, bucket_name):
+        return os.path.isdir(os.path.join(self.root, bucket_name))
+
+    def make_bucket(self, bucket_name):
+        os.makedirs(os.path.join(self.root, bucket_name), exist_ok=True)
+
+    def stat_object(self, bucket_name, object_name):
+        path = self._existing_path(bucket_name, object_name)
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        stat = os.stat(path)
+        return SimpleNamespace(bucket_name=bucket_name, object_name=object_name, etag=f'"{digest.hexdigest()}"',
+                               size=stat.st_size, last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+
+    def get_object(self, bucket_name, object_name):
+        path = self._existing_path(bucket_name, object_name)
+        with self._lock:
+            self.bytes_read += os.path.getsize(path)
+        return FakeObjectResponse(path)
+
+    def fget_object(self, bucket_name, object_name, file_path):
+        shutil.copyfile(self._existing_path(bucket_name, object_name), file_path)
+
+    def presigned_get_object(self, bucket_name, object_name, expires=None):
+        return self._existing_path(bucket_name, object_name)
+
+    def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream", part_size=0, **kwargs):
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        read_size = part_size or 5 * 1024 * 1024
+        with open(path, 'wb') as f:
+            while length < 0 or size < length:
+                chunk = data.read(read_size if length < 0 else min(read_size, length - size))
+                if not chunk:
+                    break
+                f.write(chunk)
+                size += len(chunk)
+        with self._lock:
+            self.bytes_written += size
+        return SimpleNamespace(bucket_name=bucket_name, object_name=object_name, etag=None)
+
+    def fput_object(self, bucket_name, object_name, file_path, content_type="application/octet-stream", **kwargs):
+        self.add_file(bucket_name, object_name, file_path)
+
+    def copy_object(self, bucket_name, object_name, source):
+        source_path = self._existing_path(source.bucket_name, source.object_name)
+        self.add_file(bucket_name, object_name, source_path)
+
+    def remove_object(self, bucket_name, object_name):
+        path = self._path(bucket_name, object_name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False):
+        base = os.path.join(self.root, bucket_name)
+        for directory, _, files in os.walk(base):
+            for name in files:
+                path = os.path.join(directory, name)
+                object_name = os.path.relpath(path, base).replace(os.sep, '/')
+                if prefix and not object_name.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                yield SimpleNamespace(object_name=object_name, size=stat.st_size,
+                                      last_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+
+
+class FakeChannel:
+    """Канал pika без брокера: опубликованные сообщения и ack/nack складываются в списки."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published = []
+        self.acked = []
+        self.nacked = []
+
+    @property
+    def is_open(self):
+        return True
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        with self._lock:
+            self.published.append({"exchange": exchange, "routing_key": routing_key, "body": body})
+
+    def basic_ack(self, delivery_tag=None, **kwargs):
+        with self._lock:
+            self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag=None, requeue=False, **kwargs):
+        with self._lock:
+            self.nacked.append(delivery_tag)
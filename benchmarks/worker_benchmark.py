@@ -0,0 +1,349 @@
+"""
+Офлайн-бенчмарк аудио-воркеров без docker-compose: MinIO заменяется каталогом на диске, RabbitMQ - фиктивным каналом.
+
+Для demucs и historical_denoise вызывается process_single_task, для whisper - callback с JSON-сообщением,
+как при доставке из очереди. По корпусу из синтетических клипов разной длины и файлов music_test
+считаются RTF, пиковый RSS, задержки по стадиям и задач/час; отчёт пишется в JSON.
+С --baseline отчёт сравнивается с сохранённым, при регрессии код возврата 1.
+
+Пример:
+    python benchmarks/worker_benchmark.py --worker whisper --durations 10,60,300 --repeat 2 \\
+        --env WHISPER_BACKEND=faster_whisper --env WHISPER_MODEL_NAME=small --output whisper.json
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+
+from fakes import FakeChannel, FakeMinio
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("worker_benchmark")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_BUCKET = "bench-bucket"
+WORKERS = {
+    "whisper": {"path": os.path.join("whisper_worker", "worker.py"), "client_attr": "MINIO_CLIENT"},
+    "demucs": {"path": os.path.join("DemucsWorker", "app.py"), "client_attr": "MINIO_CLIENT"},
+    "historical_denoise": {"path": os.path.join("HistoricalDenoiseWorker", "app.py"), "client_attr": "minio_client"},
+}
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".opus", ".m4a", ".aac")
+SYNTHETIC_SAMPLE_RATE = 44100
+# Метрики, для которых рост значения означает регрессию
+HIGHER_IS_WORSE = ("rtf_mean", "rtf_p95", "peak_rss_mb")
+LOWER_IS_WORSE = ("tasks_per_hour", "audio_hours_per_hour")
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def describe(values):
+    return {"count": len(values), "mean": statistics.fmean(values) if values else None,
+            "p50": percentile(values, 50), "p95": percentile(values, 95)}
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса и дочерних процессов (ffmpeg, пул чанков); ru_maxrss в Linux - в КиБ, в macOS - в байтах."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+def write_synthetic_clip(path, seconds, seed):
+    """
+    Стерео WAV, похожий на речь поверх музыки: гармонический «голос» с огибающей слогов и паузами,
+    аккомпанемент из аккордов и шум. Этого достаточно, чтобы VAD, Demucs и шумоподавление работали не вхолостую.
+    """
+    rng = np.random.default_rng(seed)
+    sr = SYNTHETIC_SAMPLE_RATE
+    frames = int(seconds * sr)
+    with wave.open(path, "wb") as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(sr)
+        block = sr * 10
+        for start in range(0, frames, block):
+            t = (np.arange(start, min(start + block, frames)) / sr).astype(np.float64)
+            pitch = 140 + 30 * np.sin(2 * np.pi * 0.3 * t)
+            phase = 2 * np.pi * np.cumsum(pitch) / sr
+            voice = sum(np.sin(k * phase) / k for k in range(1, 8))
+            syllables = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+            # Паузы 1.5 с каждые 8 с
+            voice *= syllables * ((t % 8) < 6.5)
+            chord = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6)) / 3
+            noise = rng.normal(0, 0.02, t.shape)
+            left = 0.35 * voice + 0.2 * chord + noise
+            right = 0.35 * voice + 0.2 * np.roll(chord, 37) + noise
+            pcm = (np.clip(np.stack([left, right], axis=1), -1, 1) * 32767).astype("<i2")
+            out.writeframes(pcm.tobytes())
+
+
+def probe_duration(path):
+    try:
+        output = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                                capture_output=True, check=True, text=True).stdout.strip()
+        return float(output)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        logger.warning(f"Не удалось определить длительность {path}: {e}")
+        return None
+
+
+def build_corpus(args, fake_minio, workdir):
+    """Кладёт клипы корпуса в фиктивный бакет. Возвращает список {object_name, clip, audio_seconds}."""
+    corpus = []
+    for index, seconds in enumerate(args.durations):
+        path = os.path.join(workdir, f"synthetic_{seconds:g}s.wav")
+        write_synthetic_clip(path, seconds, seed=index)
+        object_name = f"bench/{os.path.basename(path)}"
+        fake_minio.add_file(BENCH_BUCKET, object_name, path)
+        corpus.append({"object_name": object_name, "clip": os.path.basename(path), "audio_seconds": float(seconds)})
+
+    corpus_dir = args.corpus if os.path.isabs(args.corpus) else os.path.join(REPO_ROOT, args.corpus)
+    if os.path.isdir(corpus_dir):
+        for name in sorted(os.listdir(corpus_dir)):
+            if not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(corpus_dir, name)
+            object_name = f"bench/{name}"
+            fake_minio.add_file(BENCH_BUCKET, object_name, path)
+            corpus.append({"object_name": object_name, "clip": name, "audio_seconds": probe_duration(path)})
+    else:
+        logger.info(f"Каталог корпуса {corpus_dir} не найден, используются только синтетические клипы")
+    return corpus
+
+
+def load_worker(name, args, fake_minio):
+    """Импортирует модуль воркера из файла и подставляет фиктивный клиент MinIO."""
+    # Обязательные переменные окружения воркеров; брокер не используется, значения фиктивные
+    for key, value in {
+        "RABBITMQ_CONSUME_QUEUE": "bench.queue", "RABBITMQ_CONSUME_EXCHANGE": "bench.exchange",
+        "RABBITMQ_CONSUME_ROUTING_KEY": "bench.task", "RABBITMQ_PUBLISH_EXCHANGE": "bench.exchange",
+        "RABBITMQ_PUBLISH_ROUTING_KEY": "bench.result", "RABBITMQ_WHISPER_RESULT_ROUTING_KEY": "bench.whisper.result",
+        "MINIO_ACCESS_KEY": "bench", "MINIO_SECRET_KEY": "bench", "MINIO_BUCKET_NAME": BENCH_BUCKET,
+        "METRICS_PORT": "0",
+        # Без брокера и реальных вызовов кэш только исказит замер; включается флагом --with-cache
+        "RESULT_CACHE_ENABLED": "True" if args.with_cache else "False",
+        # Дочерние процессы spawn не смогут импортировать модуль, загруженный из файла под другим именем
+        "WHISPER_CHUNK_EXECUTOR": "thread",
+    }.items():
+        os.environ.setdefault(key, value)
+    for assignment in args.env:
+        key, _, value = assignment.partition("=")
+        os.environ[key] = value
+
+    worker = WORKERS[name]
+    path = os.path.join(REPO_ROOT, worker["path"])
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(f"bench_{name}_worker", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    setattr(module, worker["client_attr"], fake_minio)
+    return module
+
+
+class StageRecorder:
+    """
+    Перехватывает observe_stage воркера и раскладывает длительности стадий по задачам.
+    Часть стадий воркер замеряет не в потоке задачи (пакетный батчер, пул чанков), поэтому состояние общее, под блокировкой:
+    стадия из потока задачи достаётся ей, из чужого потока - единственной выполняемой задаче, а при нескольких
+    одновременных задачах (--concurrency > 1) копится отдельно в unattributed.
+    """
+
+    def __init__(self, module):
+        self._lock = threading.Lock()
+        self._active = {} # идентификатор потока задачи -> стадии
+        self.unattributed = {}
+        self._original = module.observe_stage
+        module.observe_stage = self.observe
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            stages = self._active.get(threading.get_ident())
+            if stages is None:
+                stages = next(iter(self._active.values())) if len(self._active) == 1 else self.unattributed
+            stages[stage] = stages.get(stage, 0.0) + seconds
+        self._original(stage, seconds)
+
+    def start(self):
+        with self._lock:
+            self._active[threading.get_ident()] = {}
+
+    def stop(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident())
+
+
+def run_task(name, module, recorder, item, repeat_index):
+    task_id = f"bench-{uuid.uuid4().hex[:8]}"
+    basename = os.path.splitext(os.path.basename(item["object_name"]))[0]
+    channel = FakeChannel()
+    recorder.start()
+    started = time.monotonic()
+    try:
+        if name == "whisper":
+            body = json.dumps({"task_id": task_id, "input_object_name": item["object_name"],
+                               "input_bucket_name": BENCH_BUCKET, "output_minio_folder": "bench_output"}).encode("utf-8")
+            method = SimpleNamespace(delivery_tag=1)
+            properties = SimpleNamespace(correlation_id=task_id, message_id=task_id, headers={}, timestamp=None)
+            module.callback(channel, method, properties, body)
+            # Кроме результата воркер публикует промежуточные результаты и задачу полного прохода - статус берётся из результата
+            results = [message for message in channel.published if message["routing_key"] == module.PUBLISH_ROUTING_KEY]
+            status = json.loads(results[-1]["body"]).get("status", "unknown") if results else "no_result"
+        else:
+            result = module.process_single_task(task_id, BENCH_BUCKET, item["object_name"], basename)
+            status = "error" if "error_message" in result else "success"
+    except Exception as e:
+        logger.exception(f"Задача {task_id}: исключение во время замера: {e}")
+        status = "exception"
+    wall = time.monotonic() - started
+    stages = recorder.stop()
+    audio_seconds = item["audio_seconds"]
+    return {"task_id": task_id, "clip": item["clip"], "repeat": repeat_index, "status": status,
+            "audio_seconds": audio_seconds, "wall_seconds": wall,
+            "rtf": wall / audio_seconds if audio_seconds else None, "stages": stages}
+
+
+def summarize(tasks, elapsed):
+    succeeded = [task for task in tasks if task["status"] == "success"]
+    rtfs = [task["rtf"] for task in succeeded if task["rtf"] is not None]
+    audio_seconds = sum(task["audio_seconds"] or 0 for task in succeeded)
+    stage_names = sorted({stage for task in succeeded for stage in task["stages"]})
+    rss = peak_rss_mb()
+    return {
+        "tasks": len(tasks), "succeeded": len(succeeded), "elapsed_seconds": elapsed,
+        "rtf_mean": statistics.fmean(rtfs) if rtfs else None, "rtf_p50": percentile(rtfs, 50), "rtf_p95": percentile(rtfs, 95),
+        "tasks_per_hour": len(succeeded) * 3600 / elapsed if elapsed else None,
+        "audio_hours_per_hour": audio_seconds / elapsed if elapsed else None,
+        "peak_rss_mb": max(rss.values()), "peak_rss_self_mb": rss["self"], "peak_rss_children_mb": rss["children"],
+        "stages": {stage: describe([task["stages"][stage] for task in succeeded if stage in task["stages"]])
+                   for stage in stage_names},
+    }
+
+
+def compare_with_baseline(summary, baseline_summary, tolerance):
+    """Список регрессий: метрика ухудшилась больше чем на tolerance (доля) относительно базового отчёта."""
+    regressions = []
+
+    def check(metric, current, reference, higher_is_worse):
+        if current is None or not reference:
+            return
+        change = (current - reference) / reference
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append({"metric": metric, "baseline": reference, "current": current, "change": change})
+
+    for metric in HIGHER_IS_WORSE:
+        check(metric, summary.get(metric), baseline_summary.get(metric), True)
+    for metric in LOWER_IS_WORSE:
+        check(metric, summary.get(metric), baseline_summary.get(metric), False)
+    for stage, stats in summary["stages"].items():
+        reference = baseline_summary.get("stages", {}).get(stage, {})
+        check(f"stages.{stage}.p95", stats["p95"], reference.get("p95"), True)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк воркеров whisper/demucs/historical_denoise")
+    parser.add_argument("--worker", choices=sorted(WORKERS), required=True)
+    parser.add_argument("--durations", default="10,60,300",
+                        type=lambda value: [float(item) for item in value.split(",") if item],
+                        help="Длительности синтетических клипов в секундах через запятую (пусто - без синтетики)")
+    parser.add_argument("--corpus", default="music_test", help="Каталог с реальными клипами (относительно корня репозитория)")
+    parser.add_argument("--repeat", type=int, default=1, help="Сколько раз прогнать каждый клип")
+    parser.add_argument("--warmup", type=int, default=1, help="Сколько задач выполнить до замера (загрузка модели, JIT)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Сколько задач выполнять одновременно")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Переопределить переменную окружения воркера (модель, бэкенд, потоки)")
+    parser.add_argument("--with-cache", action="store_true", help="Не отключать кэш результатов воркера")
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON-отчёт, с которым сравнить результаты")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Допустимое ухудшение метрик относительно базового отчёта")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="worker_benchmark_")
+    try:
+        fake_minio = FakeMinio(os.path.join(workdir, "minio"))
+        fake_minio.make_bucket(BENCH_BUCKET)
+        corpus = build_corpus(args, fake_minio, workdir)
+        if not corpus:
+            logger.error("Корпус пуст: задайте --durations или --corpus")
+            return 2
+
+        module = load_worker(args.worker, args, fake_minio)
+        recorder = StageRecorder(module)
+
+        for index in range(args.warmup):
+            warmup = run_task(args.worker, module, recorder, corpus[index % len(corpus)], -1)
+            logger.info(f"Прогрев: {warmup['clip']} за {warmup['wall_seconds']:.2f} с ({warmup['status']})")
+
+        jobs = [(item, repeat_index) for repeat_index in range(args.repeat) for item in corpus]
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+            tasks = list(executor.map(lambda job: run_task(args.worker, module, recorder, *job), jobs))
+        elapsed = time.monotonic() - started
+        if recorder.unattributed:
+            logger.info(f"Стадии вне потоков задач, не отнесённые ни к одной задаче: {recorder.unattributed}")
+        for task in tasks:
+            rtf = f"{task['rtf']:.3f}" if task["rtf"] is not None else "n/a"
+            logger.info(f"{task['clip']} #{task['repeat']}: {task['status']}, {task['wall_seconds']:.2f} с, RTF {rtf}")
+
+        report = {
+            "worker": args.worker,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "settings": {"durations": args.durations, "corpus": args.corpus, "repeat": args.repeat, "warmup": args.warmup,
+                         "concurrency": args.concurrency, "with_cache": args.with_cache, "env": args.env},
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpu_count": os.cpu_count(), "hostname": platform.node()},
+            "summary": {**summarize(tasks, elapsed), "unattributed_stages_seconds": recorder.unattributed},
+            "results": tasks,
+        }
+
+        exit_code = 0
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            regressions = compare_with_baseline(report["summary"], baseline["summary"], args.tolerance)
+            report["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+            for regression in regressions:
+                logger.warning(f"Регрессия {regression['metric']}: {regression['baseline']:.4g} -> "
+                               f"{regression['current']:.4g} ({regression['change']:+.1%})")
+            exit_code = 1 if regressions else 0
+
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+            logger.info(f"Отчёт записан в {args.output}")
+        else:
+            print(text)
+        return exit_code
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,54 @@
+import io
 import os
 import sys
 import json
+import gzip
 import logging
 import time
 import traceback
 from pathlib import Path
-import tempfile
+import threading
 import uuid
+import gc
+import signal
+import functools
+import copy
+import hashlib
+import contextlib
+import subprocess
+import multiprocessing
+import pickle
+import shutil
+import tempfile
+import queue
+import bisect
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
+import numpy as np
 import pika
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 from dotenv import load_dotenv
-import whisper # Используем openai-whisper
+
+# Метрики Prometheus подключаются опционально: без пакета воркер работает, эндпоинт /metrics не поднимается
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Движки распознавания подключаются опционально: в образе может быть установлен только один из них
+try:
+    import whisper # openai-whisper
+except ImportError:
+    whisper = None
+try:
+    import faster_whisper # faster-whisper (CTranslate2)
+except ImportError:
+    faster_whisper = None
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -20,7 +56,7 @@ load_dotenv()
 # Настройка логирования
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
-    level=LOG_LEVEL, format="%(asctime)s - %(levelname)s - %(process)d - %(module)s - %(funcName)s - %(message)s"
+    level=LOG_LEVEL, format="%(asctime)s - %(levelname)s - %(process)d - %(threadName)s - %(module)s - %(funcName)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
@@ -56,11 +92,257 @@ MINIO_BUCKET_NAME = os.getenv("MINIO_BUCKET_NAME", "audio-bucket")
 MINIO_USE_SSL = os.getenv("MINIO_USE_SSL", "False").lower() == "true"
 
 WHISPER_MODEL_NAME = os.getenv("WHISPER_MODEL_NAME", "base")
+# Движок инференса: 'openai' (openai-whisper, PyTorch) или 'faster_whisper' (CTranslate2)
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "openai").lower()
+# Устройство: 'cuda', 'cpu' или 'auto' (cuda при наличии GPU)
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "auto").lower()
+# Тип вычислений для faster-whisper: int8, int8_float16, int8_float32, float16, float32, default
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", 5))
+# Потоки внутри одной операции (intra-op) и число параллельных исполнителей (inter-op); 0 = по умолчанию библиотеки
+WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", 0))
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", 1))
+
+# --- Потоковый обмен с MinIO: входной файл не пишется на диск ---
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 1024 * 1024))
+
+# --- Предварительный проход VAD: распознаётся только речь ---
+# 'energy' - по энергии относительно шумового фона, 'silero' - модель Silero VAD из faster-whisper, 'off' - выключено.
+# По умолчанию выключено: на записях, где речь звучит поверх музыки, энергетический порог может срезать вокал
+WHISPER_VAD = os.getenv("WHISPER_VAD", "off").lower()
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", 250))
+# Паузы короче этого значения не разрывают речевой участок
+VAD_MIN_SILENCE_MS = int(os.getenv("VAD_MIN_SILENCE_MS", 1000))
+# Запас вокруг каждого участка, чтобы не срезать начало и конец слов
+VAD_SPEECH_PAD_MS = int(os.getenv("VAD_SPEECH_PAD_MS", 300))
+# Энергетический VAD: кадр считается речью, если громче шумового фона на VAD_ENERGY_MARGIN_DB и не тише VAD_ENERGY_MIN_DBFS
+VAD_ENERGY_MARGIN_DB = float(os.getenv("VAD_ENERGY_MARGIN_DB", 12))
+VAD_ENERGY_MIN_DBFS = float(os.getenv("VAD_ENERGY_MIN_DBFS", -50))
+# Если речи больше этой доли записи, запись распознаётся целиком: сжатие почти ничего не даст
+VAD_MAX_SPEECH_RATIO = float(os.getenv("VAD_MAX_SPEECH_RATIO", 0.9))
+SUPPORTED_VAD_MODES = ("off", "energy", "silero")
+
+# --- Батчинг коротких записей из разных задач ---
+# До WHISPER_BATCH_SIZE записей (не длиннее одного 30-секундного окна) декодируются одним батчем; 1 = выключено.
+# Чтобы батч набирался, WORKER_CONCURRENCY должен быть не меньше WHISPER_BATCH_SIZE
+WHISPER_BATCH_SIZE = max(int(os.getenv("WHISPER_BATCH_SIZE", 1)), 1)
+# Сколько ждать следующие записи после первой, прежде чем запустить неполный батч
+WHISPER_BATCH_WAIT_MS = int(os.getenv("WHISPER_BATCH_WAIT_MS", 50))
+
+# --- Транскрибация длинных записей по частям ---
+# Записи не короче этого порога режутся на части и распознаются параллельно; 0 = режим выключен
+WHISPER_CHUNKED_MIN_SECONDS = float(os.getenv("WHISPER_CHUNKED_MIN_SECONDS", 0))
+WHISPER_CHUNK_SECONDS = float(os.getenv("WHISPER_CHUNK_SECONDS", 300))
+WHISPER_CHUNK_OVERLAP_SECONDS = float(os.getenv("WHISPER_CHUNK_OVERLAP_SECONDS", 5))
+# В каком окне вокруг целевой границы искать самую тихую точку для разреза
+WHISPER_CHUNK_SEARCH_SECONDS = float(os.getenv("WHISPER_CHUNK_SEARCH_SECONDS", 15))
+WHISPER_CHUNK_WORKERS = max(int(os.getenv("WHISPER_CHUNK_WORKERS", 2)), 1)
+# 'process' - отдельные процессы со своей копией модели; 'thread' - потоки над моделью основного процесса
+# (имеет смысл для faster_whisper с WHISPER_NUM_WORKERS > 1)
+WHISPER_CHUNK_EXECUTOR = os.getenv("WHISPER_CHUNK_EXECUTOR", "process").lower()
+
+# --- Промежуточные результаты длинных транскрипций ---
+# Готовые сегменты публикуются пачками с ключом PARTIAL_ROUTING_KEY, пока распознаётся остальная запись.
+# Финальное сообщение с полной транскрипцией по-прежнему уходит с ключом PUBLISH_ROUTING_KEY
+WHISPER_PARTIAL_RESULTS = os.getenv("WHISPER_PARTIAL_RESULTS", "False").lower() == "true"
+# Промежуточные результаты только для записей не короче этого порога
+WHISPER_PARTIAL_MIN_SECONDS = float(os.getenv("WHISPER_PARTIAL_MIN_SECONDS", 300))
+# Пачка отправляется не чаще раза в указанный интервал или при наборе WHISPER_PARTIAL_MAX_SEGMENTS сегментов
+WHISPER_PARTIAL_INTERVAL_SECONDS = float(os.getenv("WHISPER_PARTIAL_INTERVAL_SECONDS", 15))
+WHISPER_PARTIAL_MAX_SEGMENTS = max(int(os.getenv("WHISPER_PARTIAL_MAX_SEGMENTS", 50)), 1)
+PARTIAL_ROUTING_KEY = os.getenv("RABBITMQ_PARTIAL_ROUTING_KEY") or f"{PUBLISH_ROUTING_KEY}.partial"
+
+# --- Два прохода: быстрый предварительный результат, затем полное качество ---
+# Сначала запись (или её первые WHISPER_PREVIEW_MAX_SECONDS) распознаётся WHISPER_PREVIEW_MODEL_NAME и публикуется
+# результат result_kind=preview, затем полный проход публикует result_kind=final с тем же task_id и большей revision
+WHISPER_PREVIEW = os.getenv("WHISPER_PREVIEW", "False").lower() == "true"
+WHISPER_PREVIEW_MODEL_NAME = os.getenv("WHISPER_PREVIEW_MODEL_NAME", "tiny")
+WHISPER_PREVIEW_MAX_SECONDS = float(os.getenv("WHISPER_PREVIEW_MAX_SECONDS", 0)) # 0 = вся запись
+# 'enqueue' - полный проход ставится отдельной задачей (при полосе bulk - в неё, с более низким приоритетом);
+# 'inline' - выполняется сразу после предварительного в той же задаче
+WHISPER_PREVIEW_REFINE = os.getenv("WHISPER_PREVIEW_REFINE", "enqueue").lower()
+# Ключ задачи полного прохода; по умолчанию полоса bulk при включённых TASK_LANES, иначе общий ключ задач
+REFINE_ROUTING_KEY = os.getenv("RABBITMQ_REFINE_ROUTING_KEY")
+if WHISPER_PREVIEW_REFINE not in ("enqueue", "inline"):
+    logger.critical(f"ОШИБКА: Неизвестный WHISPER_PREVIEW_REFINE '{WHISPER_PREVIEW_REFINE}'. Допустимые значения: enqueue, inline")
+    sys.exit(1)
+
+# --- Формат сообщения с результатом ---
+# 'inline' - полный текст и сегменты прямо в сообщении; 'reference' - только ссылка на transcription_detailed.json
+# в MinIO, счётчики и контрольная сумма; 'auto' - inline, пока транскрипция не больше RESULT_INLINE_MAX_BYTES
+RESULT_PAYLOAD_MODE = os.getenv("RESULT_PAYLOAD_MODE", "inline").lower()
+RESULT_INLINE_MAX_BYTES = int(os.getenv("RESULT_INLINE_MAX_BYTES", 64 * 1024))
+# Сжатие transcription_detailed.json: 'none' или 'gzip' (объект получает суффикс .gz и Content-Encoding: gzip)
+TRANSCRIPTION_JSON_COMPRESSION = os.getenv("TRANSCRIPTION_JSON_COMPRESSION", "none").lower()
+SUPPORTED_RESULT_PAYLOAD_MODES = ("inline", "reference", "auto")
+SUPPORTED_JSON_COMPRESSIONS = ("none", "gzip")
+if RESULT_PAYLOAD_MODE not in SUPPORTED_RESULT_PAYLOAD_MODES:
+    logger.critical(f"ОШИБКА: Неизвестный RESULT_PAYLOAD_MODE '{RESULT_PAYLOAD_MODE}'. Допустимые значения: {', '.join(SUPPORTED_RESULT_PAYLOAD_MODES)}")
+    sys.exit(1)
+if TRANSCRIPTION_JSON_COMPRESSION not in SUPPORTED_JSON_COMPRESSIONS:
+    logger.critical(f"ОШИБКА: Неизвестный TRANSCRIPTION_JSON_COMPRESSION '{TRANSCRIPTION_JSON_COMPRESSION}'. "
+                    f"Допустимые значения: {', '.join(SUPPORTED_JSON_COMPRESSIONS)}")
+    sys.exit(1)
+
+# --- Метрики Prometheus ---
+# Порт HTTP-эндпоинта /metrics; 0 = не запускать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_SERVICE = "whisper"
+METRICS_STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# --- Кэш результатов по содержимому входного файла ---
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "True").lower() == "true"
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "cache").strip('/')
+# Предельный размер кэша одного сервиса в MinIO; при превышении удаляются самые старые записи
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+# Переполнение проверяется раз в RESULT_CACHE_EVICT_EVERY сохранений (первая проверка - при первом сохранении):
+# каждая проверка - полный LIST префикса сервиса. Между проверками кэш может превысить лимит на столько же записей
+RESULT_CACHE_EVICT_EVERY = max(int(os.getenv("RESULT_CACHE_EVICT_EVERY", 20)), 1)
+CACHE_STORES_SINCE_EVICT = {}
+CACHE_EVICT_LOCK = threading.Lock()
+
+# --- Общий декодированный звук: ffmpeg декодирует исходник один раз для всех этапов ---
+DECODED_AUDIO_ENABLED = os.getenv("DECODED_AUDIO_ENABLED", "True").lower() == "true"
+# Каталог общего тома: массивы .npy отображаются в память без копирования. Без него общий звук выключен:
+# копирование массива через MinIO во временный файл обошлось бы дороже повторного запуска ffmpeg
+DECODED_AUDIO_DIR = os.getenv("DECODED_AUDIO_DIR", "")
+# Предельный суммарный размер декодированного звука; при превышении удаляются самые старые массивы
+DECODED_AUDIO_MAX_BYTES = int(os.getenv("DECODED_AUDIO_MAX_BYTES", 20 * 1024 ** 3))
+if DECODED_AUDIO_ENABLED and not DECODED_AUDIO_DIR:
+    logger.warning("DECODED_AUDIO_DIR не задан: общий декодированный звук выключен, каждый этап декодирует исходник сам")
 WHISPER_CACHE_DIR = os.getenv("WHISPER_CACHE_DIR", "/app/.cache/whisper")
+# Сколько альтернативных моделей (помимо WHISPER_MODEL_NAME) держать в памяти одновременно
+WHISPER_ALT_MODELS_CACHE_SIZE = int(os.getenv("WHISPER_ALT_MODELS_CACHE_SIZE", 1))
+# Прогрев модели коротким тихим клипом при старте, чтобы первая задача не платила за инициализацию
+WHISPER_WARMUP = os.getenv("WHISPER_WARMUP", "True").lower() == "true"
+WHISPER_WARMUP_SECONDS = float(os.getenv("WHISPER_WARMUP_SECONDS", 1.0))
 
 RECONNECT_DELAY_SECONDS = int(os.getenv("RECONNECT_DELAY_SECONDS", 5))
 
+# --- Конкурентная обработка ---
+# Сколько задач обрабатывается одновременно (скачивание/выгрузка идут параллельно с инференсом)
+WORKER_CONCURRENCY = max(int(os.getenv("WORKER_CONCURRENCY", 1)), 1)
+# Сколько инференсов модели может выполняться одновременно
+INFERENCE_CONCURRENCY = max(int(os.getenv("INFERENCE_CONCURRENCY", 1)), 1)
+# Сколько неподтверждённых сообщений брокер выдаёт воркеру (по умолчанию = WORKER_CONCURRENCY)
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", 0)) or WORKER_CONCURRENCY
+# Интервал heartbeat: инференс идёт вне потока соединения, поэтому длинный интервал не нужен
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", 30))
+# Тайм-аут брокера на подтверждение доставки (x-consumer-timeout, мс); 0 = настройка сервера
+RABBITMQ_CONSUMER_TIMEOUT_MS = int(os.getenv("RABBITMQ_CONSUMER_TIMEOUT_MS", 0))
+# Сколько завершённых, но не подтверждённых из-за обрыва соединения задач помнить до повторной доставки
+COMPLETED_TASKS_MAX = int(os.getenv("COMPLETED_TASKS_MAX", 256))
+
+# --- Pre-fork: несколько процессов-потребителей с общими весами модели ---
+# Родитель загружает модель один раз и порождает WORKER_PROCESSES дочерних процессов через fork: у каждого своё
+# соединение RabbitMQ и WORKER_CONCURRENCY слотов, а страницы весов общие (copy-on-write). 1 = без супервизора.
+# Для faster_whisper модель загружается в каждом процессе: пул потоков CTranslate2 не переживает fork
+WORKER_PROCESSES = max(int(os.getenv("WORKER_PROCESSES", 1)), 1)
+# Пауза перед перезапуском упавшего процесса; при падениях чаще PREFORK_STABLE_SECONDS удваивается до максимума
+PREFORK_RESTART_DELAY_SECONDS = float(os.getenv("PREFORK_RESTART_DELAY_SECONDS", 1))
+PREFORK_RESTART_MAX_DELAY_SECONDS = float(os.getenv("PREFORK_RESTART_MAX_DELAY_SECONDS", 60))
+PREFORK_STABLE_SECONDS = float(os.getenv("PREFORK_STABLE_SECONDS", 60))
+# Как часто процесс, получивший повторную доставку задачи, которую ещё выполняет соседний процесс, проверяет её результат
+PREFORK_SIBLING_POLL_SECONDS = float(os.getenv("PREFORK_SIBLING_POLL_SECONDS", 5))
+
+# --- Адаптивное качество: при большой очереди задачи распознаются более лёгкой моделью ---
+# Уровень 'high' - WHISPER_MODEL_NAME, уровень 'fast' - WHISPER_FAST_MODEL_NAME. Уровень записывается в результат
+# (quality_tier); задача с quality_tier или явной model_name в сообщении выполняется без подмены модели
+ADAPTIVE_QUALITY = os.getenv("ADAPTIVE_QUALITY", "False").lower() == "true"
+WHISPER_FAST_MODEL_NAME = os.getenv("WHISPER_FAST_MODEL_NAME", "tiny")
+# Оценка очереди в секундах: сообщения × среднее время задачи на уровне high / (потребители × WORKER_CONCURRENCY).
+# Выше DEGRADE воркер переходит на 'fast', обратно - только ниже RESTORE (гистерезис)
+ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS", 3600))
+ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS", 600))
+# Период опроса очереди (пассивный queue_declare) и минимальное время на уровне до следующего переключения
+ADAPTIVE_QUALITY_CHECK_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_CHECK_SECONDS", 30))
+ADAPTIVE_QUALITY_MIN_HOLD_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_MIN_HOLD_SECONDS", 300))
+# Время задачи на уровне high, пока не измерено ни одной
+ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS = float(os.getenv("ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS", 120))
+QUALITY_TIERS = {
+    "high": {"name": "high", "model": WHISPER_MODEL_NAME},
+    "fast": {"name": "fast", "model": WHISPER_FAST_MODEL_NAME},
+}
+if ADAPTIVE_QUALITY and ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS >= ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:
+    logger.critical("ОШИБКА: ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS должен быть меньше ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS")
+    sys.exit(1)
+
+# --- Полосы задач: короткие записи не ждут в очереди за часовыми ---
+# Полосы, которые разбирает воркер, и их доли слотов, например "fast:3,bulk:1"; пусто = одна общая очередь.
+# Задача полосы lane приходит в очередь <RABBITMQ_CONSUME_QUEUE>.<lane> с ключом <RABBITMQ_CONSUME_ROUTING_KEY>.<lane>
+SUPPORTED_TASK_LANES = ("fast", "bulk")
+TASK_LANES = {}
+for _lane_spec in filter(None, (item.strip() for item in os.getenv("TASK_LANES", "").split(","))):
+    _lane_name, _, _lane_weight = _lane_spec.partition(":")
+    if _lane_name not in SUPPORTED_TASK_LANES:
+        logger.critical(f"ОШИБКА: Неизвестная полоса '{_lane_name}' в TASK_LANES. Допустимые значения: {', '.join(SUPPORTED_TASK_LANES)}")
+        sys.exit(1)
+    TASK_LANES[_lane_name] = max(int(_lane_weight or 1), 1)
+if TASK_LANES and WORKER_CONCURRENCY < len(TASK_LANES):
+    logger.critical(f"ОШИБКА: WORKER_CONCURRENCY={WORKER_CONCURRENCY} меньше числа полос в TASK_LANES ({len(TASK_LANES)}): "
+                    f"слоты полос делят WORKER_CONCURRENCY, и каждой нужен хотя бы один")
+    sys.exit(1)
+# Разбирать ли общую очередь, распределяя её задачи по полосам (достаточно одного такого воркера на сервис)
+TASK_LANE_ROUTER = os.getenv("TASK_LANE_ROUTER", "True").lower() == "true"
+# Граница полос по длительности записи (ffprobe по presigned URL) и, если длительность не узнать, по размеру файла
+LANE_FAST_MAX_SECONDS = float(os.getenv("LANE_FAST_MAX_SECONDS", 600))
+LANE_FAST_MAX_BYTES = int(os.getenv("LANE_FAST_MAX_BYTES", 32 * 1024 * 1024))
+LANE_PROBE_DURATION = os.getenv("LANE_PROBE_DURATION", "True").lower() == "true"
+LANE_PROBE_TIMEOUT_SECONDS = float(os.getenv("LANE_PROBE_TIMEOUT_SECONDS", 10))
+# Сколько задач общей очереди классифицируется одновременно (stat_object и ffprobe идут вне потока соединения)
+LANE_ROUTER_WORKERS = max(int(os.getenv("LANE_ROUTER_WORKERS", 4)), 1)
+# Через сколько секунд задача, которую брокер не принял в полосу, возвращается в общую очередь
+LANE_ROUTE_RETRY_SECONDS = float(os.getenv("LANE_ROUTE_RETRY_SECONDS", 5))
+
+WHISPER_SAMPLE_RATE = 16000
+# Длина окна, которое модель Whisper обрабатывает за один проход, и шаг меток времени
+WHISPER_WINDOW_SECONDS = 30
+WHISPER_TIME_PRECISION = 0.02
+# Пороги transcribe() обоих движков: по ним окно батча признаётся тишиной или отправляется на повтор с температурой
+WHISPER_COMPRESSION_RATIO_THRESHOLD = 2.4
+WHISPER_LOGPROB_THRESHOLD = -1.0
+WHISPER_NO_SPEECH_THRESHOLD = 0.6
+SUPPORTED_WHISPER_BACKENDS = ("openai", "faster_whisper")
+SUPPORTED_COMPUTE_TYPES = ("default", "int8", "int8_float16", "int8_float32", "int8_bfloat16", "float16", "bfloat16", "float32")
+
 MINIO_CLIENT = None
+WHISPER_BACKEND_IMPL = None
+CHUNK_EXECUTOR = None
+WHISPER_BATCHER = None
+WHISPER_BATCHER_LOCK = threading.Lock()
+
+# Реестр загруженных моделей на время жизни процесса: имя модели -> модель (порядок = LRU)
+WHISPER_MODELS = OrderedDict()
+WHISPER_MODELS_LOCK = threading.Lock()
+# Модели, которые загружаются прямо сейчас: имя -> Future с моделью
+WHISPER_MODEL_LOADS = {}
+
+# Этапы: queue_wait, download (чтение из сети), decode (декодирование вместе с потоковым чтением),
+# inference, encode, upload (выгрузка без учёта ожидания кодировщика)
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram("audio_worker_stage_seconds", "Длительность этапов обработки задачи",
+                                                ["service", "stage"], buckets=METRICS_STAGE_BUCKETS)
+    TASKS_TOTAL = prometheus_client.Counter("audio_worker_tasks_total", "Опубликованные результаты задач по статусу",
+                                            ["service", "status"])
+    AUDIO_SECONDS_TOTAL = prometheus_client.Counter("audio_worker_audio_seconds_total", "Суммарная длительность обработанного аудио",
+                                                    ["service", "model"])
+    REALTIME_FACTOR = prometheus_client.Gauge("audio_worker_realtime_factor", "Секунды обработки на секунду аудио (последняя задача)",
+                                              ["service", "model"])
+    BACKLOG_SECONDS = prometheus_client.Gauge("audio_worker_backlog_seconds", "Оценка времени разбора очереди задач",
+                                              ["service"])
+    QUALITY_DEGRADED = prometheus_client.Gauge("audio_worker_quality_degraded", "1, если задачи выполняются на уровне качества fast",
+                                               ["service"])
+
+TASK_EXECUTOR = None
+ROUTER_EXECUTOR = None
+INFERENCE_SLOTS = threading.BoundedSemaphore(INFERENCE_CONCURRENCY)
+
+# Задачи в работе и завершённые задачи, чей результат не удалось отправить: ключ задачи -> доставка / операции
+INFLIGHT_TASKS = {}
+COMPLETED_TASKS = OrderedDict()
+DELIVERY_LOCK = threading.RLock()
+# В режиме pre-fork - общий для дочерних процессов реестр задач (SharedTaskRegistry), иначе None
+SHARED_TASKS = None
 
 # --- Функции (без изменений, кроме publish_result) ---
 
@@ -82,50 +364,890 @@ def get_minio_client():
             raise
     return MINIO_CLIENT
 
-def download_file_from_minio(minio_client, bucket_name, object_name, download_path, task_id="N/A"):
-    # ... (код без изменений)
+def observe_stage(stage, seconds):
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(METRICS_SERVICE, stage).observe(seconds)
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    started = time.monotonic()
     try:
-        minio_client.fget_object(bucket_name, object_name, download_path)
-        logger.info(f"Задача {task_id}: Файл {object_name} скачан из бакета {bucket_name} в {download_path}")
-        return True
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started)
+
+def count_task(status, service=METRICS_SERVICE):
+    if prometheus_client is not None:
+        TASKS_TOTAL.labels(service, status).inc()
+
+def observe_realtime_factor(model, processing_seconds, audio_seconds):
+    """Фактор реального времени задачи: секунды обработки (без ожидания в очереди) на секунду аудио."""
+    if prometheus_client is not None and audio_seconds > 0:
+        REALTIME_FACTOR.labels(METRICS_SERVICE, model).set(processing_seconds / audio_seconds)
+        AUDIO_SECONDS_TOTAL.labels(METRICS_SERVICE, model).inc(audio_seconds)
+
+def observe_queue_wait(properties):
+    """Ожидание в очереди от публикации задачи (заголовок x-published-at-ms или timestamp AMQP) до начала обработки."""
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get("x-published-at-ms"):
+        published_at = int(headers["x-published-at-ms"]) / 1000
+    elif getattr(properties, "timestamp", None):
+        published_at = properties.timestamp
+    else:
+        return
+    observe_stage("queue_wait", max(time.time() - published_at, 0.0))
+
+def start_metrics_server():
+    if prometheus_client is None:
+        logger.warning("Пакет prometheus_client не установлен: эндпоинт /metrics не запущен")
+    elif METRICS_PORT > 0:
+        prometheus_client.start_http_server(METRICS_PORT)
+        logger.info(f"Метрики Prometheus доступны на порту {METRICS_PORT} (/metrics)")
+
+def make_cache_key(content_id, params):
+    payload = json.dumps({"content": content_id, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_etag_cache_key(minio_client, bucket_name, object_name, params, task_id="N/A"):
+    """Ключ кэша по ETag и размеру объекта: вычисляется без скачивания файла."""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    try:
+        stat = minio_client.stat_object(bucket_name, object_name)
+        etag = stat.etag.strip('"')
+        return make_cache_key(f"etag:{etag}:{stat.size}", params)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для кэша: {e}")
+        return None
+
+def get_content_cache_key(sha256_hex, params):
+    """Ключ кэша по SHA-256 содержимого: совпадает для одинаковых файлов, загруженных разными способами."""
+    if not RESULT_CACHE_ENABLED or not sha256_hex:
+        return None
+    return make_cache_key(f"sha256:{sha256_hex}", params)
+
+def get_cache_object_name(service, cache_key, suffix):
+    return f"{RESULT_CACHE_PREFIX}/{service}/{cache_key}{suffix}"
+
+def lookup_cached_result(minio_client, bucket_name, service, cache_key, task_id="N/A"):
+    """Возвращает манифест закэшированного результата или None."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return None
+    manifest_object = get_cache_object_name(service, cache_key, ".json")
+    try:
+        response = minio_client.get_object(bucket_name, manifest_object)
+        try:
+            manifest = json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
     except S3Error as e:
-        logger.error(f"Задача {task_id}: Ошибка MinIO S3 при скачивании: {e}. Бакет: {bucket_name}, Объект: {object_name}")
+        if e.code != "NoSuchKey":
+            logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
     except Exception as e:
-        logger.error(f"Задача {task_id}: Не удалось скачать файл {object_name} из MinIO: {e}")
-    return False
+        logger.warning(f"Задача {task_id}: Ошибка чтения кэша s3://{bucket_name}/{manifest_object}: {e}")
+        return None
+    logger.info(f"Задача {task_id}: Найден результат в кэше: s3://{bucket_name}/{manifest_object}")
+    return manifest
 
-def upload_file_to_minio(minio_client, bucket_name, file_path, object_name, task_id="N/A", content_type='application/octet-stream'):
-    # ... (код без изменений)
+def restore_cached_artifact(minio_client, bucket_name, manifest, output_object_name, task_id="N/A"):
+    """Копирует закэшированный файл результата на место выходного объекта задачи (на стороне MinIO)."""
     try:
-        found = minio_client.bucket_exists(bucket_name)
-        if not found:
-            minio_client.make_bucket(bucket_name)
-            logger.info(f"Задача {task_id}: Бакет {bucket_name} создан.")
-        
-        minio_client.fput_object(bucket_name, object_name, file_path, content_type=content_type)
-        logger.info(f"Задача {task_id}: Файл {file_path} загружен в MinIO как {object_name} в бакет {bucket_name} (тип: {content_type})")
+        minio_client.copy_object(bucket_name, output_object_name, CopySource(bucket_name, manifest["artifact_object"]))
         return True
-    except S3Error as e:
-        logger.error(f"Задача {task_id}: Ошибка MinIO S3 при загрузке: {e}. Бакет: {bucket_name}, Объект: {object_name}, Файл: {file_path}")
     except Exception as e:
-        logger.error(f"Задача {task_id}: Не удалось загрузить файл {file_path} в MinIO: {e}")
-    return False
+        logger.warning(f"Задача {task_id}: Не удалось восстановить результат из кэша {manifest.get('artifact_object')}: {e}")
+        return False
+
+def store_cached_result(minio_client, bucket_name, service, cache_keys, result, artifact_object=None, artifact_suffix="", task_id="N/A"):
+    """Сохраняет результат в кэш под всеми переданными ключами. Ошибки кэша не влияют на задачу."""
+    cache_keys = list(dict.fromkeys(key for key in cache_keys if key))
+    if not RESULT_CACHE_ENABLED or not cache_keys:
+        return
+    try:
+        cached_artifact = None
+        if artifact_object:
+            cached_artifact = get_cache_object_name(service, cache_keys[-1], artifact_suffix)
+            minio_client.copy_object(bucket_name, cached_artifact, CopySource(bucket_name, artifact_object))
+        manifest = {"service": service, "created_at": time.time(), "artifact_object": cached_artifact, "result": result}
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        for cache_key in cache_keys:
+            minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                    io.BytesIO(data), len(data), content_type='application/json')
+        logger.info(f"Задача {task_id}: Результат сохранён в кэш {RESULT_CACHE_PREFIX}/{service}/ (ключей: {len(cache_keys)})")
+        if should_evict_cache(service):
+            evict_cache_overflow(minio_client, bucket_name, service)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось сохранить результат в кэш: {e}")
+
+def link_cached_result(minio_client, bucket_name, service, manifest, cache_key, task_id="N/A"):
+    """Регистрирует уже закэшированный результат под ещё одним ключом (например, ETag нового объекта с тем же содержимым)."""
+    if not RESULT_CACHE_ENABLED or not cache_key:
+        return
+    try:
+        data = json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+        minio_client.put_object(bucket_name, get_cache_object_name(service, cache_key, ".json"),
+                                io.BytesIO(data), len(data), content_type='application/json')
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось добавить ключ кэша {cache_key}: {e}")
+
+def should_evict_cache(service):
+    """True раз в RESULT_CACHE_EVICT_EVERY сохранений сервиса, начиная с первого."""
+    with CACHE_EVICT_LOCK:
+        count = CACHE_STORES_SINCE_EVICT.get(service, RESULT_CACHE_EVICT_EVERY - 1) + 1
+        CACHE_STORES_SINCE_EVICT[service] = 0 if count >= RESULT_CACHE_EVICT_EVERY else count
+        return count >= RESULT_CACHE_EVICT_EVERY
+
+def evict_cache_overflow(minio_client, bucket_name, service, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """Удаляет самые старые объекты кэша сервиса, пока его размер превышает max_bytes."""
+    cached_objects = list(minio_client.list_objects(bucket_name, prefix=f"{RESULT_CACHE_PREFIX}/{service}/", recursive=True))
+    total_size = sum(obj.size for obj in cached_objects)
+    for obj in sorted(cached_objects, key=lambda o: o.last_modified):
+        if total_size <= max_bytes:
+            break
+        minio_client.remove_object(bucket_name, obj.object_name)
+        total_size -= obj.size
+        logger.info(f"Объект кэша {obj.object_name} удалён (превышен лимит {max_bytes} байт)")
+
+class OpenAIWhisperBackend:
+    """Инференс через openai-whisper (PyTorch)."""
+    name = "openai"
+    # transcribe отдаёт сегменты только после всей записи
+    streams_segments = False
+
+    def __init__(self):
+        if whisper is None:
+            raise RuntimeError("Пакет openai-whisper не установлен")
+        import torch
+        self.device = WHISPER_DEVICE if WHISPER_DEVICE != "auto" else ("cuda" if torch.cuda.is_available() else "cpu")
+        if WHISPER_CPU_THREADS > 0:
+            torch.set_num_threads(WHISPER_CPU_THREADS)
+        if WHISPER_NUM_WORKERS > 1:
+            torch.set_num_interop_threads(WHISPER_NUM_WORKERS)
+        self.version = whisper.__version__
+        # openai-whisper вешает хуки kv-кэша на модули модели при каждом декодировании,
+        # поэтому параллельные вызовы transcribe на одной модели портят друг другу кэш
+        self._transcribe_lock = threading.Lock()
+
+    def is_known_model(self, model_name):
+        return model_name in whisper.available_models()
+
+    def load_model(self, model_name, cache_dir):
+        return whisper.load_model(model_name, device=self.device, download_root=cache_dir)
+
+    def transcribe(self, model, audio, language, on_segment=None):
+        with self._transcribe_lock:
+            result = model.transcribe(audio, language=language, fp16=self.device == "cuda")
+        segments = [
+            {"start": segment.get("start"), "end": segment.get("end"), "text": segment.get("text")}
+            for segment in result.get("segments", [])
+        ]
+        # openai-whisper отдаёт сегменты только после всей записи, поэтому on_segment вызывается в конце
+        for segment in segments:
+            if on_segment is not None:
+                on_segment(segment)
+        return {
+            "text": result.get("text", ""),
+            "language": result.get("language"),
+            "segments": segments,
+        }
+
+    def transcribe_batch(self, model, audios, language):
+        """Декодирует батч записей не длиннее одного окна за один проход энкодера и декодера."""
+        import torch
+        mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels) for audio in audios])
+        options = whisper.DecodingOptions(language=language, fp16=self.device == "cuda")
+        with self._transcribe_lock, torch.no_grad():
+            decoded = whisper.decode(model, mel.to(model.device), options)
+        tokenizer_kwargs = {"num_languages": model.num_languages} if hasattr(model, "num_languages") else {}
+        tokenizer = whisper.tokenizer.get_tokenizer(model.is_multilingual, language=language, task="transcribe", **tokenizer_kwargs)
+        windows = [
+            (build_window_result(result.tokens, tokenizer.timestamp_begin, tokenizer.eot, tokenizer.decode,
+                                 len(audio) / WHISPER_SAMPLE_RATE, language), result.avg_logprob, result.no_speech_prob)
+            for audio, result in zip(audios, decoded)
+        ]
+        return apply_window_checks(self, model, audios, language, windows)
+
+
+class FasterWhisperBackend:
+    """Инференс через faster-whisper (CTranslate2) с квантованием весов."""
+    name = "faster_whisper"
+    # Сегменты декодируются лениво и доступны по ходу распознавания
+    streams_segments = True
+
+    def __init__(self):
+        if faster_whisper is None:
+            raise RuntimeError("Пакет faster-whisper не установлен")
+        import ctranslate2
+        self.device = WHISPER_DEVICE if WHISPER_DEVICE != "auto" else ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
+        self.compute_type = WHISPER_COMPUTE_TYPE
+        supported = ctranslate2.get_supported_compute_types(self.device)
+        if self.compute_type != "default" and self.compute_type not in supported:
+            logger.warning(f"Тип вычислений '{self.compute_type}' не поддерживается на устройстве {self.device} "
+                           f"(доступно: {', '.join(sorted(supported))}). Используется 'default'.")
+            self.compute_type = "default"
+        self.version = faster_whisper.__version__
+
+    def is_known_model(self, model_name):
+        # Помимо стандартных имён faster-whisper принимает репозитории Hugging Face и локальные пути к моделям CTranslate2
+        return model_name in faster_whisper.available_models() or "/" in model_name or os.path.isdir(model_name)
+
+    def load_model(self, model_name, cache_dir):
+        return faster_whisper.WhisperModel(
+            model_name,
+            device=self.device,
+            compute_type=self.compute_type,
+            cpu_threads=WHISPER_CPU_THREADS,
+            num_workers=max(WHISPER_NUM_WORKERS, 1),
+            download_root=cache_dir,
+        )
+
+    def transcribe(self, model, audio, language, on_segment=None):
+        # Сегменты декодируются лениво, по мере обхода генератора: on_segment получает каждый сразу после декодирования
+        segments_iter, info = model.transcribe(audio, language=language, beam_size=WHISPER_BEAM_SIZE)
+        segments = []
+        for segment in segments_iter:
+            segments.append({"start": segment.start, "end": segment.end, "text": segment.text})
+            if on_segment is not None:
+                on_segment(segments[-1])
+        return {
+            "text": "".join(segment["text"] for segment in segments),
+            "language": info.language,
+            "segments": segments,
+        }
+
+    def transcribe_batch(self, model, audios, language):
+        """Декодирует батч записей не длиннее одного окна одним вызовом generate CTranslate2."""
+        import ctranslate2
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.tokenizer import Tokenizer
+
+        features = np.stack([pad_or_trim(model.feature_extractor(audio)) for audio in audios]).astype(np.float32)
+        tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language)
+        prompt = list(tokenizer.sot_sequence)
+        results = model.model.generate(ctranslate2.StorageView.from_array(np.ascontiguousarray(features)),
+                                       [prompt] * len(audios), beam_size=WHISPER_BEAM_SIZE, suppress_blank=True,
+                                       length_penalty=1, return_scores=True, return_no_speech_prob=True)
+        windows = []
+        for audio, result in zip(audios, results):
+            tokens = result.sequences_ids[0]
+            # Средний logprob считается так же, как в faster_whisper.transcribe (score нормирован на длину)
+            avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+            windows.append((build_window_result(tokens, tokenizer.timestamp_begin, tokenizer.eot, tokenizer.decode,
+                                                len(audio) / WHISPER_SAMPLE_RATE, language), avg_logprob, result.no_speech_prob))
+        return apply_window_checks(self, model, audios, language, windows)
+
+
+def check_window_quality(text, avg_logprob, no_speech_prob):
+    """
+    Проверки, которые transcribe() делает для каждого окна: 'silence' - речи в окне нет,
+    'fallback' - вероятная галлюцинация или зацикливание, нужен повтор с температурой; None - окно принято.
+    """
+    if no_speech_prob > WHISPER_NO_SPEECH_THRESHOLD and avg_logprob < WHISPER_LOGPROB_THRESHOLD:
+        return "silence"
+    text_bytes = text.encode("utf-8")
+    if text_bytes and len(text_bytes) / len(zlib.compress(text_bytes)) > WHISPER_COMPRESSION_RATIO_THRESHOLD:
+        return "fallback"
+    if avg_logprob < WHISPER_LOGPROB_THRESHOLD:
+        return "fallback"
+    return None
+
+
+def apply_window_checks(backend, model, audios, language, windows):
+    """
+    windows - [(результат, avg_logprob, no_speech_prob)] батча. Окна без речи отдаются пустыми, а не прошедшие
+    проверки распознаются заново через transcribe() с его повтором по температурам, как без батчинга.
+    """
+    results = []
+    for audio, (result, avg_logprob, no_speech_prob) in zip(audios, windows):
+        verdict = check_window_quality(result["text"], avg_logprob, no_speech_prob)
+        if verdict == "silence":
+            result = {"text": "", "language": language, "segments": []}
+        elif verdict == "fallback":
+            logger.info(f"Окно батча ({len(audio) / WHISPER_SAMPLE_RATE:.1f} с) не прошло проверки "
+                        f"(avg_logprob {avg_logprob:.2f}), повторное распознавание через transcribe()")
+            result = backend.transcribe(model, audio, language)
+        results.append(result)
+    return results
+
+
+def build_window_result(tokens, timestamp_begin, eot, decode, duration, language):
+    """Разбирает токены одного окна Whisper на сегменты по токенам-меткам времени."""
+    segments = []
+    start, text_tokens = 0.0, []
+    for token in tokens:
+        if token >= timestamp_begin:
+            timestamp = (token - timestamp_begin) * WHISPER_TIME_PRECISION
+            if text_tokens:
+                segments.append({"start": round(start, 3), "end": round(min(timestamp, duration), 3), "text": decode(text_tokens)})
+                text_tokens = []
+            start = timestamp
+        elif token < eot:
+            text_tokens.append(token)
+    if text_tokens:
+        segments.append({"start": round(start, 3), "end": round(duration, 3), "text": decode(text_tokens)})
+    return {"text": "".join(segment["text"] for segment in segments), "language": language, "segments": segments}
+
+
+def get_whisper_backend():
+    global WHISPER_BACKEND_IMPL
+    if WHISPER_BACKEND_IMPL is None:
+        if WHISPER_BACKEND not in SUPPORTED_WHISPER_BACKENDS:
+            raise ValueError(f"Неизвестный WHISPER_BACKEND '{WHISPER_BACKEND}'. Допустимые значения: {', '.join(SUPPORTED_WHISPER_BACKENDS)}")
+        if WHISPER_COMPUTE_TYPE not in SUPPORTED_COMPUTE_TYPES:
+            raise ValueError(f"Неизвестный WHISPER_COMPUTE_TYPE '{WHISPER_COMPUTE_TYPE}'. Допустимые значения: {', '.join(SUPPORTED_COMPUTE_TYPES)}")
+        if WHISPER_VAD not in SUPPORTED_VAD_MODES:
+            raise ValueError(f"Неизвестный WHISPER_VAD '{WHISPER_VAD}'. Допустимые значения: {', '.join(SUPPORTED_VAD_MODES)}")
+        backend_cls = FasterWhisperBackend if WHISPER_BACKEND == "faster_whisper" else OpenAIWhisperBackend
+        WHISPER_BACKEND_IMPL = backend_cls()
+        logger.info(f"Движок Whisper: {WHISPER_BACKEND_IMPL.name} {WHISPER_BACKEND_IMPL.version}, устройство: {WHISPER_BACKEND_IMPL.device}")
+    return WHISPER_BACKEND_IMPL
+
+def get_whisper_model(model_name=WHISPER_MODEL_NAME, cache_dir=WHISPER_CACHE_DIR, task_id="N/A"):
+    """
+    Возвращает модель из реестра процесса, загружая её только при первом обращении.
+    Основная модель (WHISPER_MODEL_NAME), модель уровня fast и модель предварительного прохода не вытесняются никогда, альтернативные
+    хранятся в LRU размером WHISPER_ALT_MODELS_CACHE_SIZE. Загрузка (возможно, со скачиванием) идёт вне блокировки
+    реестра: задачи на уже загруженные модели её не ждут, а параллельные запросы той же модели ждут одну загрузку.
+    """
+    with WHISPER_MODELS_LOCK:
+        model = WHISPER_MODELS.get(model_name)
+        if model is not None:
+            WHISPER_MODELS.move_to_end(model_name)
+            return model
+        load = WHISPER_MODEL_LOADS.get(model_name)
+        is_loader = load is None
+        if is_loader:
+            load = WHISPER_MODEL_LOADS[model_name] = Future()
+    if not is_loader:
+        logger.info(f"Задача {task_id}: Ожидание загрузки модели Whisper {model_name} другой задачей")
+        return load.result()
 
-def transcribe_audio_russian(audio_file_path, model_name=WHISPER_MODEL_NAME, cache_dir=WHISPER_CACHE_DIR, task_id="N/A"):
-    # ... (код без изменений)
     try:
         logger.info(f"Задача {task_id}: Загрузка модели Whisper: {model_name} с cache_dir: {cache_dir}")
         Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        load_started = time.monotonic()
+        model = get_whisper_backend().load_model(model_name, cache_dir)
+        logger.info(f"Задача {task_id}: Модель Whisper {model_name} загружена за {time.monotonic() - load_started:.2f} с.")
+    except BaseException as e:
+        with WHISPER_MODELS_LOCK:
+            WHISPER_MODEL_LOADS.pop(model_name, None)
+        load.set_exception(e)
+        raise
 
-        model = whisper.load_model(model_name, download_root=cache_dir)
-        logger.info(f"Задача {task_id}: Модель Whisper {model_name} загружена. Начало транскрибации для {audio_file_path}...")
+    with WHISPER_MODELS_LOCK:
+        WHISPER_MODELS[model_name] = model
+        WHISPER_MODEL_LOADS.pop(model_name, None)
+        pinned = {WHISPER_MODEL_NAME}
+        if ADAPTIVE_QUALITY:
+            pinned.add(WHISPER_FAST_MODEL_NAME)
+        if WHISPER_PREVIEW:
+            pinned.add(WHISPER_PREVIEW_MODEL_NAME)
+        alternates = [name for name in WHISPER_MODELS if name not in pinned]
+        evicted = []
+        while len(alternates) > WHISPER_ALT_MODELS_CACHE_SIZE:
+            evicted_name = alternates.pop(0)
+            del WHISPER_MODELS[evicted_name]
+            evicted.append(evicted_name)
+    load.set_result(model)
+    for evicted_name in evicted:
+        logger.info(f"Модель Whisper {evicted_name} вытеснена из реестра (лимит альтернативных моделей: {WHISPER_ALT_MODELS_CACHE_SIZE})")
+    if evicted:
+        gc.collect()
+    return model
 
-        transcribe_options = {
-            "language": "ru",
-            "fp16": False 
-        }
-        
-        result = model.transcribe(audio_file_path, **transcribe_options)
+def warmup_whisper_model(model_name=WHISPER_MODEL_NAME):
+    """Прогоняет через модель короткий тихий клип, чтобы инициализировать веса и буферы до первой задачи."""
+    model = get_whisper_model(model_name, task_id="warmup")
+    if not WHISPER_WARMUP:
+        return
+    try:
+        warmup_started = time.monotonic()
+        dummy_audio = np.zeros(int(WHISPER_SAMPLE_RATE * WHISPER_WARMUP_SECONDS), dtype=np.float32)
+        get_whisper_backend().transcribe(model, dummy_audio, "ru")
+        logger.info(f"Модель Whisper {model_name} прогрета за {time.monotonic() - warmup_started:.2f} с.")
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть модель Whisper {model_name}: {e}")
+
+def _run_ffmpeg_decoder(source, sample_rate, channels, feed=None):
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-threads", "0", "-i", source,
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stderr_chunks = []
+    threads = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+    if feed:
+        threads.append(threading.Thread(target=feed, args=(process.stdin,), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    pcm = bytearray()
+    for chunk in iter(lambda: process.stdout.read(STREAM_CHUNK_SIZE), b''):
+        pcm += chunk
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if process.returncode != 0:
+        stderr = b"".join(stderr_chunks).decode(errors='replace').strip()
+        raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}: {stderr[-500:]}")
+    return np.frombuffer(pcm, dtype=np.float32).reshape(-1, channels).T
+
+def decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
+    """
+    Декодирует объект MinIO в float32 [channels, samples] без временных файлов: тело get_object
+    по частям подаётся в stdin ffmpeg, попутно считается SHA-256 для ключа кэша.
+    Возвращает (audio, sha256_hex); для контейнеров, которые нельзя читать из потока
+    (например, MP4 с индексом в конце), ffmpeg читает объект по presigned URL, и хеш не считается.
+    """
+    decode_started = time.monotonic()
+    digest = hashlib.sha256()
+    feed_errors = []
+    network_seconds = [0.0]
+
+    def feed(stdin):
+        response = None
+        try:
+            read_started = time.monotonic()
+            response = minio_client.get_object(bucket_name, object_name)
+            for chunk in response.stream(STREAM_CHUNK_SIZE):
+                network_seconds[0] += time.monotonic() - read_started
+                digest.update(chunk)
+                stdin.write(chunk)
+                read_started = time.monotonic()
+        except BrokenPipeError:
+            pass # ffmpeg завершился раньше; причину покажет его код возврата
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+            if response is not None:
+                response.close()
+                response.release_conn()
+
+    try:
+        audio = _run_ffmpeg_decoder("pipe:0", sample_rate, channels, feed)
+    except RuntimeError as e:
+        if feed_errors:
+            raise feed_errors[0]
+        logger.warning(f"Задача {task_id}: Не удалось декодировать s3://{bucket_name}/{object_name} из потока ({e}), чтение по presigned URL")
+        url = minio_client.presigned_get_object(bucket_name, object_name, expires=timedelta(hours=1))
+        audio = _run_ffmpeg_decoder(url, sample_rate, channels)
+        observe_stage("decode", time.monotonic() - decode_started)
+        return audio, None
+    if feed_errors:
+        raise feed_errors[0]
+    observe_stage("download", network_seconds[0])
+    observe_stage("decode", time.monotonic() - decode_started)
+    return audio, digest.hexdigest()
+
+def get_decoded_audio_key(minio_client, bucket_name, object_name):
+    """Ключ декодированного звука по ETag и размеру: одинаковые файлы под разными именами декодируются один раз."""
+    stat = minio_client.stat_object(bucket_name, object_name)
+    etag = stat.etag.strip('"')
+    return make_cache_key(f"etag:{etag}:{stat.size}", {"decoded_audio": 1})
+
+def get_decoded_audio_name(key, sample_rate, channels):
+    return f"{key}.{sample_rate}x{channels}"
+
+def read_object_bytes(minio_client, bucket_name, object_name):
+    response = minio_client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+def load_decoded_audio(key, sample_rate, channels, task_id="N/A"):
+    """
+    Ищет звук, уже декодированный другим этапом: в нужном формате, а для моно - также стерео
+    той же частоты (сводится в моно). Возвращает (audio, sha256_hex) или None.
+    """
+    for stored_channels in dict.fromkeys((channels, 2)):
+        name = get_decoded_audio_name(key, sample_rate, stored_channels)
+        try:
+            # Описание пишется последним: если его нет, массив ещё не сохранён целиком
+            with open(os.path.join(DECODED_AUDIO_DIR, f"{name}.json"), encoding='utf-8') as f:
+                meta = json.load(f)
+            # copy-on-write: страницы читаются с общего тома по мере обращения, изменения не попадают в файл
+            audio = np.load(os.path.join(DECODED_AUDIO_DIR, f"{name}.npy"), mmap_mode='c')
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"Задача {task_id}: Ошибка чтения декодированного звука {name}: {e}")
+            continue
+        if stored_channels != channels:
+            audio = audio.mean(axis=0, keepdims=True, dtype=np.float32)
+        logger.info(f"Задача {task_id}: Использован декодированный звук {name} ({audio.shape[-1] / sample_rate:.1f} с), ffmpeg не запускался")
+        return audio, meta.get("sha256")
+    return None
+
+def evict_decoded_audio_dir():
+    """Удаляет самые старые файлы из DECODED_AUDIO_DIR, пока их размер превышает DECODED_AUDIO_MAX_BYTES."""
+    entries = []
+    for entry in os.scandir(DECODED_AUDIO_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= DECODED_AUDIO_MAX_BYTES:
+            break
+        # Уже отображённый в память файл остаётся доступен процессу, который его открыл
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total_size -= size
+
+def store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id="N/A"):
+    """Сохраняет декодированный звук [channels, samples] для следующих этапов. Ошибки не влияют на задачу."""
+    name = get_decoded_audio_name(key, sample_rate, audio.shape[0])
+    meta = json.dumps({"sha256": sha256_hex, "sample_rate": sample_rate, "channels": audio.shape[0],
+                       "frames": audio.shape[-1], "created_at": time.time()}).encode('utf-8')
+    try:
+        os.makedirs(DECODED_AUDIO_DIR, exist_ok=True)
+        # Через временный файл и переименование: другой процесс не увидит недописанный массив
+        # np.save пишет заголовок и audio.data в файл напрямую; массив после ffmpeg уже float32 и сохраняется
+        # как есть (транспонированный - с fortran_order), без промежуточной копии в памяти
+        for suffix, write in ((".npy", lambda f: np.save(f, audio if audio.dtype == np.float32 else audio.astype(np.float32))),
+                              (".json", lambda f: f.write(meta))):
+            temp_path = os.path.join(DECODED_AUDIO_DIR, f".{name}.{uuid.uuid4().hex}{suffix}")
+            with open(temp_path, 'wb') as f:
+                write(f)
+            os.replace(temp_path, os.path.join(DECODED_AUDIO_DIR, f"{name}{suffix}"))
+        evict_decoded_audio_dir()
+        logger.info(f"Задача {task_id}: Декодированный звук сохранён для следующих этапов: {name}")
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось сохранить декодированный звук {name}: {e}")
+
+def decode_object_audio_shared(minio_client, bucket_name, object_name, sample_rate, channels, task_id="N/A"):
+    """
+    decode_object_audio с общим декодированным звуком: если файл уже декодировал другой этап, массив
+    берётся готовым, иначе файл декодируется, а результат сохраняется для следующих этапов. Сохранение
+    синхронное: массив не переживает задачу в фоновом потоке, а число одновременных записей ограничено числом задач.
+    Возвращает (audio, sha256_hex).
+    """
+    if not DECODED_AUDIO_ENABLED or not DECODED_AUDIO_DIR:
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    try:
+        key = get_decoded_audio_key(minio_client, bucket_name, object_name)
+    except Exception as e:
+        logger.warning(f"Задача {task_id}: Не удалось получить ETag s3://{bucket_name}/{object_name} для декодированного звука: {e}")
+        return decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+
+    load_started = time.monotonic()
+    found = load_decoded_audio(key, sample_rate, channels, task_id)
+    if found is not None:
+        observe_stage("load_decoded", time.monotonic() - load_started)
+        return found
+
+    audio, sha256_hex = decode_object_audio(minio_client, bucket_name, object_name, sample_rate, channels, task_id)
+    with measure_stage("store_decoded"):
+        store_decoded_audio(key, audio, sample_rate, sha256_hex, task_id)
+    return audio, sha256_hex
+
+def find_chunk_boundaries(audio, sample_rate=WHISPER_SAMPLE_RATE):
+    """
+    Возвращает точки разреза (в отсчётах), включая начало и конец записи. Каждая внутренняя
+    граница ставится в самый тихий 20-мс кадр в окне WHISPER_CHUNK_SEARCH_SECONDS вокруг
+    очередной отметки WHISPER_CHUNK_SECONDS, чтобы не резать слова посередине.
+    """
+    frame = int(sample_rate * 0.02)
+    n_frames = len(audio) // frame
+    energy = np.sqrt(np.mean(audio[:n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    chunk_frames = max(int(WHISPER_CHUNK_SECONDS / 0.02), 1)
+    search_frames = int(WHISPER_CHUNK_SEARCH_SECONDS / 0.02)
+
+    boundaries = [0]
+    target = chunk_frames
+    while target < n_frames - chunk_frames // 4:
+        lo = max(target - search_frames, boundaries[-1] // frame + 1)
+        hi = min(target + search_frames, n_frames - 1)
+        cut_frame = lo + int(np.argmin(energy[lo:hi + 1])) if hi >= lo else target
+        boundaries.append(cut_frame * frame)
+        target = cut_frame + chunk_frames
+    boundaries.append(len(audio))
+    return boundaries
+
+def _normalize_segment_text(text):
+    return " ".join((text or "").lower().split())
+
+def merge_chunk_results(chunk_results, boundaries, sample_rate=WHISPER_SAMPLE_RATE):
+    """
+    Склеивает результаты частей в один результат. Таймкоды сдвигаются на начало окна части;
+    из зоны перекрытия берётся сегмент той части, которой принадлежит его середина,
+    а повтор одного и того же текста на стыке отбрасывается.
+    """
+    segments = []
+    for index, (window_start, result) in enumerate(chunk_results):
+        own_start = boundaries[index] / sample_rate
+        own_end = boundaries[index + 1] / sample_rate
+        for segment in result["segments"]:
+            start = segment["start"] + window_start
+            end = segment["end"] + window_start
+            middle = (start + end) / 2
+            if not own_start <= middle < own_end and not (index == len(chunk_results) - 1 and middle >= own_end):
+                continue
+            if segments and _normalize_segment_text(segments[-1]["text"]) == _normalize_segment_text(segment["text"]) \
+                    and start - segments[-1]["end"] < WHISPER_CHUNK_OVERLAP_SECONDS:
+                continue
+            segments.append({"start": round(start, 3), "end": round(end, 3), "text": segment["text"]})
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "language": chunk_results[0][1].get("language") if chunk_results else None,
+        "segments": segments,
+    }
+
+def _chunk_worker_init(cpu_threads):
+    # Выполняется в дочернем процессе пула: делим ядра между процессами
+    global WHISPER_CPU_THREADS
+    WHISPER_CPU_THREADS = cpu_threads
+
+def _transcribe_chunk(model_name, audio_chunk, language):
+    backend = get_whisper_backend()
+    return backend.transcribe(get_whisper_model(model_name, task_id="chunk"), audio_chunk, language)
+
+def get_chunk_executor():
+    global CHUNK_EXECUTOR
+    if CHUNK_EXECUTOR is None:
+        if WHISPER_CHUNK_EXECUTOR == "thread":
+            CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=WHISPER_CHUNK_WORKERS, thread_name_prefix="chunk")
+        else:
+            # spawn: форк процесса с уже загруженными torch/CTranslate2 и их пулами потоков небезопасен
+            cpu_threads = WHISPER_CPU_THREADS or max((os.cpu_count() or 1) // WHISPER_CHUNK_WORKERS, 1)
+            CHUNK_EXECUTOR = ProcessPoolExecutor(max_workers=WHISPER_CHUNK_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_chunk_worker_init, initargs=(cpu_threads,))
+        logger.info(f"Пул для транскрибации по частям: {WHISPER_CHUNK_EXECUTOR}, исполнителей: {WHISPER_CHUNK_WORKERS}")
+    return CHUNK_EXECUTOR
+
+def transcribe_chunked(audio, model_name, language, task_id="N/A", on_segments=None):
+    """
+    Режет запись на перекрывающиеся окна по тихим местам и распознаёт их параллельно.
+    on_segments(segments, offset) получает окончательные сегменты по порядку, как только
+    готовы все части до границы offset (в секундах).
+    """
+    boundaries = find_chunk_boundaries(audio)
+    overlap = int(WHISPER_CHUNK_OVERLAP_SECONDS * WHISPER_SAMPLE_RATE)
+    windows = [(max(boundaries[i] - overlap, 0), min(boundaries[i + 1] + overlap, len(audio))) for i in range(len(boundaries) - 1)]
+    logger.info(f"Задача {task_id}: Запись {len(audio) / WHISPER_SAMPLE_RATE:.1f} с разбита на {len(windows)} частей")
+
+    executor = get_chunk_executor()
+    futures = [executor.submit(_transcribe_chunk, model_name, audio[start:end], language) for start, end in windows]
+    chunk_results, reported = [], 0
+    for (start, _), future in zip(windows, futures):
+        chunk_results.append((start / WHISPER_SAMPLE_RATE, future.result()))
+        if on_segments is None or len(chunk_results) == len(windows):
+            continue
+        # Сегменты из хвоста перекрытия последней готовой части ещё может забрать следующая
+        own_end = boundaries[len(chunk_results)] / WHISPER_SAMPLE_RATE
+        settled = [segment for segment in merge_chunk_results(chunk_results, boundaries)["segments"]
+                   if (segment["start"] + segment["end"]) / 2 < own_end]
+        if len(settled) > reported:
+            on_segments(settled[reported:], own_end)
+            reported = len(settled)
+    result = merge_chunk_results(chunk_results, boundaries)
+    if on_segments is not None and len(result["segments"]) > reported:
+        on_segments(result["segments"][reported:], len(audio) / WHISPER_SAMPLE_RATE)
+    return result
+
+class WhisperBatcher:
+    """
+    Собирает короткие записи из разных задач в батчи: первая запись ждёт остальные не дольше
+    WHISPER_BATCH_WAIT_MS, в батч попадает до WHISPER_BATCH_SIZE записей для одной модели и языка.
+    Потоки задач блокируются на своём Future, пока отдельный поток батчера выполняет инференс.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="whisper-batcher", daemon=True)
+        self._thread.start()
+
+    def transcribe(self, model_name, audio, language):
+        future = Future()
+        self._queue.put((model_name, language, audio, future))
+        return future.result()
+
+    def _collect(self):
+        first = self._queue.get()
+        batch, deferred = [first], []
+        deadline = time.monotonic() + WHISPER_BATCH_WAIT_MS / 1000
+        while len(batch) < WHISPER_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            (batch if item[:2] == first[:2] else deferred).append(item)
+        for item in deferred:
+            self._queue.put(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            model_name, language = batch[0][:2]
+            try:
+                model = get_whisper_model(model_name, task_id="batch")
+                batch_started = time.monotonic()
+                with INFERENCE_SLOTS, measure_stage("inference"):
+                    results = get_whisper_backend().transcribe_batch(model, [item[2] for item in batch], language)
+                logger.info(f"Батч из {len(batch)} записей ({sum(len(item[2]) for item in batch) / WHISPER_SAMPLE_RATE:.1f} с аудио) "
+                            f"распознан за {time.monotonic() - batch_started:.2f} с")
+                for item, result in zip(batch, results):
+                    item[3].set_result(result)
+            except Exception as e:
+                logger.exception(f"Ошибка батчевой транскрибации ({len(batch)} записей): {e}")
+                for item in batch:
+                    item[3].set_exception(e)
+
+def get_whisper_batcher():
+    global WHISPER_BATCHER
+    with WHISPER_BATCHER_LOCK:
+        if WHISPER_BATCHER is None:
+            WHISPER_BATCHER = WhisperBatcher()
+            logger.info(f"Батчинг коротких записей: до {WHISPER_BATCH_SIZE} записей, ожидание {WHISPER_BATCH_WAIT_MS} мс")
+    return WHISPER_BATCHER
+
+def detect_speech_energy(audio, sample_rate=WHISPER_SAMPLE_RATE):
+    """
+    Речевые участки [(start, end)] в отсчётах: кадры по 30 мс, порог от 10-го перцентиля громкости.
+    None, если громкость почти не меняется (музыка под вокалом, плотная речь): пауз в такой записи не найти.
+    """
+    frame = int(sample_rate * 0.03)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return []
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    level_db = 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10)
+    noise_floor_db, loud_db = np.percentile(level_db, [10, 90])
+    if loud_db - noise_floor_db < VAD_ENERGY_MARGIN_DB:
+        return None
+    threshold = max(noise_floor_db + VAD_ENERGY_MARGIN_DB, VAD_ENERGY_MIN_DBFS)
+    is_speech = np.concatenate(([False], level_db > threshold, [False]))
+    edges = np.flatnonzero(np.diff(is_speech.astype(np.int8)))
+    return [(int(start) * frame, int(end) * frame) for start, end in zip(edges[::2], edges[1::2])]
+
+def detect_speech_silero(audio, sample_rate=WHISPER_SAMPLE_RATE):
+    """Речевые участки [(start, end)] в отсчётах по модели Silero VAD, встроенной в faster-whisper."""
+    if faster_whisper is None:
+        raise RuntimeError("Для WHISPER_VAD=silero нужен пакет faster-whisper")
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+    options = VadOptions(min_speech_duration_ms=VAD_MIN_SPEECH_MS, min_silence_duration_ms=VAD_MIN_SILENCE_MS, speech_pad_ms=0)
+    return [(item["start"], item["end"]) for item in get_speech_timestamps(audio, options)]
+
+def merge_speech_regions(regions, total_length, sample_rate=WHISPER_SAMPLE_RATE):
+    """Добавляет запас, склеивает участки с короткими паузами и отбрасывает слишком короткие."""
+    pad = int(sample_rate * VAD_SPEECH_PAD_MS / 1000)
+    min_silence = int(sample_rate * VAD_MIN_SILENCE_MS / 1000)
+    min_speech = int(sample_rate * VAD_MIN_SPEECH_MS / 1000)
+    merged = []
+    for start, end in regions:
+        if end - start < min_speech:
+            continue
+        start, end = max(start - pad, 0), min(end + pad, total_length)
+        if merged and start - merged[-1][1] < min_silence:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def compact_to_speech(audio, task_id="N/A"):
+    """
+    Оставляет в записи только речевые участки. Возвращает (audio, speech_map), где speech_map -
+    список (начало в сжатой записи, начало в исходной, длительность) в секундах для обратного
+    пересчёта таймкодов; speech_map = None, если запись распознаётся целиком.
+    """
+    if WHISPER_VAD == "off" or len(audio) == 0:
+        return audio, None
+    vad_started = time.monotonic()
+    regions = detect_speech_silero(audio) if WHISPER_VAD == "silero" else detect_speech_energy(audio)
+    if regions is None:
+        logger.info(f"Задача {task_id}: VAD ({WHISPER_VAD}): разброс громкости меньше {VAD_ENERGY_MARGIN_DB:.0f} дБ, запись распознаётся целиком")
+        return audio, None
+    regions = merge_speech_regions(regions, len(audio))
+    speech_length = sum(end - start for start, end in regions)
+    logger.info(f"Задача {task_id}: VAD ({WHISPER_VAD}) за {time.monotonic() - vad_started:.2f} с: речевых участков {len(regions)}, "
+                f"речь {speech_length / WHISPER_SAMPLE_RATE:.1f} из {len(audio) / WHISPER_SAMPLE_RATE:.1f} с")
+    # Речь не найдена: VAD мог ошибиться (тихий вокал поверх музыки), пустой результат без модели не возвращаем
+    if not regions or speech_length > VAD_MAX_SPEECH_RATIO * len(audio):
+        return audio, None
+
+    speech_map, position = [], 0
+    for start, end in regions:
+        speech_map.append((position / WHISPER_SAMPLE_RATE, start / WHISPER_SAMPLE_RATE, (end - start) / WHISPER_SAMPLE_RATE))
+        position += end - start
+    compact = np.concatenate([audio[start:end] for start, end in regions])
+    return compact, speech_map
+
+def get_timeline_mapper(speech_map):
+    """Функция to_original(timestamp, is_end): переводит отметку сжатой записи на шкалу исходного файла."""
+    compact_starts = [item[0] for item in speech_map]
+
+    def to_original(timestamp, is_end):
+        # Конец сегмента, попавший ровно на стык, относится к предыдущему участку
+        index = (bisect.bisect_left if is_end else bisect.bisect_right)(compact_starts, timestamp) - 1
+        compact_start, original_start, duration = speech_map[max(index, 0)]
+        return round(original_start + min(max(timestamp - compact_start, 0.0), duration), 3)
+
+    return to_original
+
+def restore_original_timeline(result, speech_map):
+    """Пересчитывает таймкоды сегментов из сжатой записи обратно на шкалу исходного файла."""
+    to_original = get_timeline_mapper(speech_map)
+    for segment in result["segments"]:
+        segment["start"] = to_original(segment["start"], False)
+        segment["end"] = to_original(segment["end"], True)
+    return result
+
+def report_original_segments(on_segments, to_original, segments, offset):
+    """Передаёт готовые сегменты в on_segments, переведя таймкоды на шкалу исходного файла."""
+    # Копии: итоговый результат пересчитывается на исходную шкалу отдельно
+    segments = [dict(segment) for segment in segments]
+    if to_original is not None:
+        for segment in segments:
+            segment["start"] = to_original(segment["start"], False)
+            segment["end"] = to_original(segment["end"], True)
+        offset = to_original(offset, True)
+    on_segments(segments, offset)
+
+def transcribe_audio_russian(audio, model_name=WHISPER_MODEL_NAME, cache_dir=WHISPER_CACHE_DIR, task_id="N/A", on_segments=None):
+    """
+    audio - моно-сигнал float32 с частотой WHISPER_SAMPLE_RATE. Если передан on_segments(segments, offset),
+    готовые сегменты сообщаются по ходу распознавания, уже на шкале исходного файла.
+    """
+    try:
+        with measure_stage("vad"):
+            audio, speech_map = compact_to_speech(audio, task_id)
+        duration = len(audio) / WHISPER_SAMPLE_RATE
+        chunked = 0 < WHISPER_CHUNKED_MIN_SECONDS <= duration
+        if on_segments is not None and not chunked and not get_whisper_backend().streams_segments:
+            # Движок не отдаёт сегменты по ходу: промежуточные результаты получаются из готовых частей записи
+            chunked = True
+
+        report_segments = None
+        if on_segments is not None:
+            to_original = get_timeline_mapper(speech_map) if speech_map is not None else None
+            report_segments = functools.partial(report_original_segments, on_segments, to_original)
+
+        if chunked:
+            logger.info(f"Задача {task_id}: Транскрибация по частям ({duration:.1f} с аудио)...")
+            with INFERENCE_SLOTS, measure_stage("inference"):
+                result = transcribe_chunked(audio, model_name, "ru", task_id, on_segments=report_segments)
+        elif WHISPER_BATCH_SIZE > 1 and duration <= WHISPER_WINDOW_SECONDS and on_segments is None:
+            logger.info(f"Задача {task_id}: Запись ({duration:.1f} с аудио) передана в батч для модели {model_name}")
+            result = get_whisper_batcher().transcribe(model_name, audio, "ru")
+        else:
+            model = get_whisper_model(model_name, cache_dir, task_id)
+            logger.info(f"Задача {task_id}: Модель Whisper {model_name} готова. Начало транскрибации ({duration:.1f} с аудио)...")
+            on_segment = (lambda segment: report_segments([segment], segment["end"])) if report_segments else None
+            with INFERENCE_SLOTS, measure_stage("inference"):
+                result = get_whisper_backend().transcribe(model, audio, "ru", on_segment=on_segment)
+        if speech_map is not None:
+            result = restore_original_timeline(result, speech_map)
         logger.info(f"Задача {task_id}: Транскрибация успешна. Обнаруженный моделью язык: {result.get('language')}")
         return result
     except Exception as e:
@@ -134,13 +1256,15 @@ def transcribe_audio_russian(audio_file_path, model_name=WHISPER_MODEL_NAME, cac
         return None
 
 # ИСПРАВЛЕНО: функция publish_result стала универсальной
-def publish_result(channel, result_message, task_id_for_correlation):
+def publish_result(channel, result_message, task_id_for_correlation, immediate=False):
+    """immediate: опубликовать сразу, не дожидаясь подтверждения задачи (предварительный результат перед полным проходом)."""
     try:
         if isinstance(result_message, dict) and 'task_id' not in result_message:
             result_message['task_id'] = task_id_for_correlation
 
         message_body = json.dumps(result_message, ensure_ascii=False)
-        channel.basic_publish(
+        publish = getattr(channel, "publish_now", channel.basic_publish) if immediate else channel.basic_publish
+        publish(
             exchange=PUBLISH_EXCHANGE,
             routing_key=PUBLISH_ROUTING_KEY,
             body=message_body,
@@ -150,14 +1274,344 @@ def publish_result(channel, result_message, task_id_for_correlation):
                 correlation_id=task_id_for_correlation
             )
         )
+        count_task(result_message.get("status", "unknown"))
         logger.info(f"Задача {task_id_for_correlation}: Результат опубликован в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
     except Exception as e:
         logger.error(f"Задача {task_id_for_correlation}: Не удалось опубликовать результат: {e}")
         logger.error(traceback.format_exc())
 
+def publish_partial_result(channel, partial_message, task_id_for_correlation):
+    """Промежуточный результат уходит сразу, не дожидаясь подтверждения задачи; потеря пачки не критична."""
+    try:
+        publish = getattr(channel, "publish_now", channel.basic_publish)
+        publish(
+            exchange=PUBLISH_EXCHANGE,
+            routing_key=PARTIAL_ROUTING_KEY,
+            body=json.dumps(partial_message, ensure_ascii=False),
+            properties=pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                content_type='application/json',
+                correlation_id=task_id_for_correlation
+            )
+        )
+    except Exception as e:
+        logger.warning(f"Задача {task_id_for_correlation}: Не удалось опубликовать промежуточный результат: {e}")
+
+class PartialResultPublisher:
+    """
+    Копит готовые сегменты длинной транскрипции и публикует их пачками с ключом PARTIAL_ROUTING_KEY.
+    У каждой пачки номер sequence (с 1) и audio_offset_seconds - до какого места исходной записи
+    распознавание дошло; финальное сообщение сообщает, сколько пачек было отправлено.
+    """
+
+    def __init__(self, channel, base_payload, audio_seconds):
+        self.channel = channel
+        self.base_payload = base_payload
+        self.audio_seconds = audio_seconds
+        self.sequence = 0
+        self._segments = []
+        self._offset = 0.0
+        self._last_sent = time.monotonic()
+
+    def add(self, segments, offset):
+        self._segments.extend(segments)
+        self._offset = max(self._offset, offset)
+        if len(self._segments) >= WHISPER_PARTIAL_MAX_SEGMENTS or time.monotonic() - self._last_sent >= WHISPER_PARTIAL_INTERVAL_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if not self._segments:
+            return
+        segments, self._segments = self._segments, []
+        self.sequence += 1
+        self._last_sent = time.monotonic()
+        task_id = self.base_payload["task_id"]
+        publish_partial_result(self.channel, {
+            **self.base_payload, "status": "partial", "sequence": self.sequence,
+            "audio_offset_seconds": round(self._offset, 3), "audio_duration_seconds": round(self.audio_seconds, 3),
+            "text": "".join(segment["text"] for segment in segments), "segments": segments,
+        }, task_id)
+        logger.info(f"Задача {task_id}: Промежуточный результат #{self.sequence} ({len(segments)} сегм., "
+                    f"до {self._offset:.1f} из {self.audio_seconds:.1f} с) опубликован с ключом '{PARTIAL_ROUTING_KEY}'")
+
+def get_cache_params(model_name, language, max_audio_seconds=0, partials=False):
+    """
+    Параметры, от которых зависит транскрипция: входят в ключ кэша. Сюда входят и настройки, которые
+    выбирают путь распознавания (по частям, батчем, через VAD): разные пути дают разный текст и таймкоды.
+    partials - публикуются ли промежуточные результаты: они отключают батч, а без потоковых сегментов включают распознавание по частям.
+    """
+    backend = get_whisper_backend()
+    params = {"service": "whisper", "backend": backend.name, "model": model_name, "language": language,
+            "compute_type": getattr(backend, "compute_type", None), "beam_size": WHISPER_BEAM_SIZE if backend.name == "faster_whisper" else None,
+            "vad": {"mode": WHISPER_VAD, "min_speech_ms": VAD_MIN_SPEECH_MS, "min_silence_ms": VAD_MIN_SILENCE_MS, "pad_ms": VAD_SPEECH_PAD_MS,
+                    "energy_margin_db": VAD_ENERGY_MARGIN_DB, "energy_min_dbfs": VAD_ENERGY_MIN_DBFS, "max_speech_ratio": VAD_MAX_SPEECH_RATIO,
+                    "no_speech": "full"},
+            "chunked": {"min_seconds": WHISPER_CHUNKED_MIN_SECONDS, "chunk_seconds": WHISPER_CHUNK_SECONDS,
+                        "overlap_seconds": WHISPER_CHUNK_OVERLAP_SECONDS, "search_seconds": WHISPER_CHUNK_SEARCH_SECONDS},
+            "batched": WHISPER_BATCH_SIZE > 1, "partials_min_seconds": WHISPER_PARTIAL_MIN_SECONDS if partials else None}
+    if max_audio_seconds:
+        # Только для усечённого предварительного прохода: ключи полных результатов не меняются
+        params["max_audio_seconds"] = max_audio_seconds
+    return params
+
+def build_detailed_transcription(transcription_result):
+    detailed_transcription_data = {
+        "full_text": transcription_result.get("text", ""),
+        "segments": []
+    }
+    for segment in transcription_result.get("segments", []):
+        detailed_transcription_data["segments"].append({
+            "start": segment.get("start"),
+            "end": segment.get("end"),
+            "text": segment.get("text"),
+        })
+    return detailed_transcription_data
+
+def serialize_transcription_json(detailed_transcription_data):
+    """Байты transcription_detailed.json с учётом TRANSCRIPTION_JSON_COMPRESSION: (данные, суффикс имени, Content-Encoding)."""
+    if TRANSCRIPTION_JSON_COMPRESSION == "gzip":
+        data = json.dumps(detailed_transcription_data, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+        # mtime=0: одна и та же транскрипция даёт одинаковые байты и одинаковую контрольную сумму
+        return gzip.compress(data, compresslevel=6, mtime=0), ".gz", "gzip"
+    return json.dumps(detailed_transcription_data, ensure_ascii=False, indent=2).encode('utf-8'), "", None
+
+def upload_transcription_json(minio_client_instance, bucket_name, output_minio_folder, file_stem, detailed_transcription_data, task_id):
+    """Выгружает транскрипцию в MinIO. Возвращает описание объекта: имя, sha256 и размер байтов объекта, кодировку, выгружен ли он."""
+    data, suffix, content_encoding = serialize_transcription_json(detailed_transcription_data)
+    output_json_minio_object_name = f"{output_minio_folder}/{file_stem}_transcription_detailed.json{suffix}"
+    artifact = {"object_name": output_json_minio_object_name, "sha256": hashlib.sha256(data).hexdigest(),
+                "size_bytes": len(data), "content_encoding": content_encoding, "uploaded": False}
+    try:
+        minio_client_instance.put_object(bucket_name, output_json_minio_object_name, io.BytesIO(data), len(data), content_type='application/json',
+                                         metadata={"Content-Encoding": content_encoding} if content_encoding else None)
+        artifact["uploaded"] = True
+        logger.info(f"Задача {task_id}: Транскрипция загружена в MinIO как {output_json_minio_object_name} в бакет {bucket_name}")
+    except S3Error as e:
+        logger.error(f"Задача {task_id}: Ошибка MinIO S3 при загрузке: {e}. Бакет: {bucket_name}, Объект: {output_json_minio_object_name}")
+    except Exception as e:
+        logger.error(f"Задача {task_id}: Не удалось загрузить транскрипцию {output_json_minio_object_name} в MinIO: {e}")
+    return artifact
+
+def should_inline_transcription(detailed_transcription_data, artifact, task_id):
+    """Класть ли текст и сегменты в сообщение (см. RESULT_PAYLOAD_MODE). Без выгруженного JSON ссылаться не на что."""
+    if RESULT_PAYLOAD_MODE == "inline":
+        return True
+    if not artifact["uploaded"]:
+        logger.warning(f"Задача {task_id}: JSON транскрипции не выгружен, текст передаётся прямо в сообщении")
+        return True
+    if RESULT_PAYLOAD_MODE == "reference":
+        return False
+    size = len(json.dumps(detailed_transcription_data, ensure_ascii=False, separators=(",", ":")).encode('utf-8'))
+    return size <= RESULT_INLINE_MAX_BYTES
+
+class QualityGovernor:
+    """
+    Выбирает уровень качества по оценке очереди: переходит на 'fast', когда очередь разбиралась бы дольше
+    ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS, и возвращается на 'high' только ниже
+    ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS, не раньше чем через ADAPTIVE_QUALITY_MIN_HOLD_SECONDS.
+    Очередь оценивается в секундах работы на уровне high, поэтому ускорение на 'fast' само по себе не возвращает 'high'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tier = "high"
+        self.changed_at = time.monotonic()
+        self.task_seconds = ADAPTIVE_QUALITY_DEFAULT_TASK_SECONDS
+        self.task_samples = 0
+        self.backlog_seconds = 0.0
+
+    def observe_task(self, tier_name, seconds):
+        """Среднее время задачи (скользящее) по задачам уровня high, выполненным без кэша."""
+        if tier_name != "high":
+            return
+        with self.lock:
+            self.task_samples += 1
+            weight = max(0.2, 1.0 / self.task_samples)
+            self.task_seconds += weight * (seconds - self.task_seconds)
+
+    def update(self, queue_stats):
+        """queue_stats - пары (сообщений в очереди, потребителей очереди) по всем очередям задач воркера."""
+        with self.lock:
+            backlog = sum(messages * self.task_seconds / (max(consumers, 1) * WORKER_CONCURRENCY) for messages, consumers in queue_stats)
+            self.backlog_seconds = backlog
+            previous = self.tier
+            if time.monotonic() - self.changed_at >= ADAPTIVE_QUALITY_MIN_HOLD_SECONDS:
+                if previous == "high" and backlog >= ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:
+                    self.tier = "fast"
+                elif previous == "fast" and backlog <= ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS:
+                    self.tier = "high"
+            if self.tier != previous:
+                self.changed_at = time.monotonic()
+                logger.warning(f"Уровень качества: {previous} -> {self.tier} (очередь ~{backlog:.0f} с, "
+                               f"сообщений: {sum(messages for messages, _ in queue_stats)}, задача ~{self.task_seconds:.0f} с)")
+            if prometheus_client is not None:
+                BACKLOG_SECONDS.labels(METRICS_SERVICE).set(backlog)
+                QUALITY_DEGRADED.labels(METRICS_SERVICE).set(1 if self.tier != "high" else 0)
+
+QUALITY_GOVERNOR = QualityGovernor()
+
+def resolve_quality_tier(requested, task_id="N/A"):
+    """Уровень задачи: явно запрошенный в сообщении (повторный прогон в высоком качестве) или выбранный по очереди."""
+    if requested in QUALITY_TIERS:
+        return QUALITY_TIERS[requested]
+    if requested:
+        logger.warning(f"Задача {task_id}: Неизвестный quality_tier '{requested}', уровень выбирается по очереди")
+    return QUALITY_TIERS[QUALITY_GOVERNOR.tier] if ADAPTIVE_QUALITY else QUALITY_TIERS["high"]
+
+def schedule_backlog_checks(connection):
+    """
+    Раз в ADAPTIVE_QUALITY_CHECK_SECONDS опрашивает глубину очередей задач пассивным queue_declare.
+    Опрос идёт в потоке соединения на отдельном канале: ошибка 404 закрывает только его.
+    """
+    queues = [CONSUME_QUEUE] + [get_lane_queue(lane) for lane in TASK_LANES]
+    state = {"channel": None}
+
+    def check():
+        try:
+            if state["channel"] is None or not state["channel"].is_open:
+                state["channel"] = connection.channel()
+            queue_stats = []
+            for queue_name in queues:
+                frame = state["channel"].queue_declare(queue=queue_name, passive=True)
+                queue_stats.append((frame.method.message_count, frame.method.consumer_count))
+            QUALITY_GOVERNOR.update(queue_stats)
+        except pika.exceptions.ChannelClosed as e:
+            logger.warning(f"Не удалось получить глубину очередей {queues}: {e}")
+            state["channel"] = None
+        connection.call_later(ADAPTIVE_QUALITY_CHECK_SECONDS, check)
+
+    connection.call_later(0, check)
+
+def process_transcription_task(task_id, current_bucket_name, input_object_name, original_input_object, output_minio_folder, model_name,
+                               partial_channel=None, quality_tier="high", result_kind="final", revision=1, max_audio_seconds=0):
+    """
+    Полный цикл обработки одной задачи: кэш, скачивание, транскрибация, выгрузка. Возвращает сообщение с результатом.
+    Если передан partial_channel, для длинных записей по нему публикуются промежуточные результаты.
+    quality_tier записывается в результат: задачи уровня fast SoundService может позже повторить в высоком качестве,
+    у предварительного прохода свой уровень preview - его заменит окончательный результат той же задачи.
+    result_kind и revision связывают предварительный и окончательный результаты одной задачи; max_audio_seconds
+    ограничивает распознавание началом записи (для предварительного прохода).
+    """
+    task_started = time.monotonic()
+    minio_client_instance = get_minio_client()
+    language = "ru"
+    file_stem = Path(input_object_name).stem
+    if result_kind == "preview":
+        file_stem = f"{file_stem}.preview" # не перезаписывает JSON окончательного результата
+    base_payload = {
+        "task_id": task_id, "service": "whisper",
+        "input_bucket": current_bucket_name, "input_object": original_input_object,
+        "processed_object": input_object_name, "result_kind": result_kind, "revision": revision,
+    }
+
+    def success_payload(detailed_transcription_data, language_detected, cache_hit):
+        with measure_stage("upload"):
+            artifact = upload_transcription_json(
+                minio_client_instance, current_bucket_name, output_minio_folder, file_stem, detailed_transcription_data, task_id)
+        payload = {
+            **base_payload, "status": "success",
+            "tool_version": get_whisper_backend().version, "backend": get_whisper_backend().name,
+            "model_used": model_name, "quality_tier": quality_tier, "cache_hit": cache_hit,
+            "transcription_detailed_json_object_path": f"s3://{current_bucket_name}/{artifact['object_name']}",
+            "transcription_sha256": artifact["sha256"], "transcription_size_bytes": artifact["size_bytes"],
+            "transcription_content_encoding": artifact["content_encoding"],
+            "segments_count": len(detailed_transcription_data["segments"]),
+            "full_text_length": len(detailed_transcription_data["full_text"]),
+            "language_requested": language, "language_detected_by_model": language_detected,
+        }
+        # В режиме reference SoundService читает текст и сегменты из JSON по ссылке и сверяет sha256
+        if should_inline_transcription(detailed_transcription_data, artifact, task_id):
+            payload.update(result_payload="inline", full_text=detailed_transcription_data["full_text"],
+                           segments=detailed_transcription_data["segments"])
+        else:
+            payload["result_payload"] = "reference"
+        return payload
+
+    # Проверка кэша по ETag: при попадании файл даже не скачивается
+    cache_params = get_cache_params(model_name, language, max_audio_seconds,
+                                    partials=WHISPER_PARTIAL_RESULTS and partial_channel is not None)
+    etag_cache_key = get_etag_cache_key(minio_client_instance, current_bucket_name, input_object_name, cache_params, task_id)
+    manifest = lookup_cached_result(minio_client_instance, current_bucket_name, "whisper", etag_cache_key, task_id)
+    if manifest:
+        return success_payload(manifest["result"]["transcription"], manifest["result"].get("language"), True)
+
+    # Декодирование прямо из потока MinIO, без временного файла
+    logger.info(f"Задача {task_id}: Чтение {input_object_name} из бакета {current_bucket_name}")
+    try:
+        audio, content_sha256 = decode_object_audio_shared(minio_client_instance, current_bucket_name, input_object_name,
+                                                    WHISPER_SAMPLE_RATE, 1, task_id)
+    except Exception as e:
+        logger.error(f"Задача {task_id}: Не удалось получить аудио s3://{current_bucket_name}/{input_object_name}: {e}")
+        return {**base_payload, "status": "error", "original_input_object": input_object_name,
+                "error_message": f"Failed to download file from MinIO: s3://{current_bucket_name}/{input_object_name}: {e}"}
+
+    # Проверка кэша по содержимому: тот же файл мог быть загружен под другим именем
+    content_cache_key = get_content_cache_key(content_sha256, cache_params)
+    manifest = lookup_cached_result(minio_client_instance, current_bucket_name, "whisper", content_cache_key, task_id)
+    if manifest:
+        link_cached_result(minio_client_instance, current_bucket_name, "whisper", manifest, etag_cache_key, task_id)
+        return success_payload(manifest["result"]["transcription"], manifest["result"].get("language"), True)
+
+    if max_audio_seconds and audio.shape[-1] > max_audio_seconds * WHISPER_SAMPLE_RATE:
+        audio = audio[:, :int(max_audio_seconds * WHISPER_SAMPLE_RATE)]
+        base_payload["audio_truncated_at_seconds"] = max_audio_seconds
+    logger.info(f"Задача {task_id}: Начало транскрибации для {input_object_name} (только русский язык, {result_kind}, модель {model_name})")
+    audio_seconds = audio.shape[-1] / WHISPER_SAMPLE_RATE
+    partials = None
+    if WHISPER_PARTIAL_RESULTS and partial_channel is not None and audio_seconds >= WHISPER_PARTIAL_MIN_SECONDS:
+        partials = PartialResultPublisher(partial_channel, base_payload, audio_seconds)
+    transcription_result = transcribe_audio_russian(audio[0], model_name=model_name, task_id=task_id,
+                                                    on_segments=partials.add if partials else None)
+    del audio
+
+    if not transcription_result:
+        return {**base_payload, "status": "error", "error_message": "Transcription failed in whisper_worker."}
+
+    if partials:
+        partials.flush()
+    detailed_transcription_data = build_detailed_transcription(transcription_result)
+    result_message = success_payload(detailed_transcription_data, transcription_result.get("language"), False)
+    if partials:
+        result_message["partials_published"] = partials.sequence
+    observe_realtime_factor(model_name, time.monotonic() - task_started, audio_seconds)
+    store_cached_result(minio_client_instance, current_bucket_name, "whisper", [etag_cache_key, content_cache_key],
+                        {"transcription": detailed_transcription_data, "language": transcription_result.get("language")},
+                        task_id=task_id)
+    return result_message
+
+def get_refine_routing_key():
+    if REFINE_ROUTING_KEY:
+        return REFINE_ROUTING_KEY
+    # Очередь полосы bulk объявляют все воркеры с полосами, даже если сами её не разбирают
+    return get_lane_routing_key("bulk") if TASK_LANES else CONSUME_ROUTING_KEY
+
+def enqueue_refine_task(channel, message_data, task_id, revision):
+    """Ставит полный проход отдельной задачей с тем же task_id: она не задерживает предварительные результаты новых записей."""
+    refine_message = {**message_data, "task_id": task_id, "transcription_pass": "refine", "revision": revision, "quality_tier": "high"}
+    routing_key = get_refine_routing_key()
+    channel.basic_publish(
+        exchange=CONSUME_EXCHANGE,
+        routing_key=routing_key,
+        body=json.dumps(refine_message, ensure_ascii=False),
+        properties=pika.BasicProperties(
+            delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+            content_type='application/json',
+            correlation_id=task_id,
+            headers={"x-published-at-ms": int(time.time() * 1000)}
+        )
+    )
+    logger.info(f"Задача {task_id}: Полный проход (revision {revision}) поставлен в очередь с ключом '{routing_key}'")
+
+def should_run_preview(transcription_pass, model_name, current_bucket_name, input_object_name, task_id):
+    """Предварительный проход не нужен для задачи полного прохода, для той же модели и если полный результат уже в кэше."""
+    if not WHISPER_PREVIEW or transcription_pass == "refine" or model_name == WHISPER_PREVIEW_MODEL_NAME:
+        return False
+    minio_client_instance = get_minio_client()
+    cache_key = get_etag_cache_key(minio_client_instance, current_bucket_name, input_object_name, get_cache_params(model_name, "ru"), task_id)
+    return lookup_cached_result(minio_client_instance, current_bucket_name, "whisper", cache_key, task_id) is None
+
 # ИСПРАВЛЕНО: callback теперь использует универсальную функцию publish_result
 def callback(ch, method, properties, body):
-    # ... (код почти без изменений, только вызовы publish_result)
     task_id = "unknown_task"
     message_data = None
     try:
@@ -179,6 +1633,12 @@ def callback(ch, method, properties, body):
         output_minio_folder = message_data.get("output_minio_folder", "whisper_output").strip('/')
         original_input_object = message_data.get("original_input_object") or input_object_name
         current_bucket_name = message_data.get("input_bucket_name", MINIO_BUCKET_NAME)
+        explicit_model_name = message_data.get("model_name") or message_data.get("whisper_model_name")
+        # Модель, указанная в задаче явно, не подменяется: адаптивное качество выбирает только модель по умолчанию
+        tier = QUALITY_TIERS["high"] if explicit_model_name else resolve_quality_tier(message_data.get("quality_tier"), task_id)
+        requested_model_name = explicit_model_name or tier["model"]
+        transcription_pass = message_data.get("transcription_pass")
+        revision = int(message_data.get("revision") or 1)
 
         if not input_object_name:
             logger.error(f"Задача {task_id}: Отсутствует 'input_object_name' в сообщении.")
@@ -187,112 +1647,576 @@ def callback(ch, method, properties, body):
             ch.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-        minio_client_instance = get_minio_client()
-        if not minio_client_instance: 
+        if not get_whisper_backend().is_known_model(requested_model_name):
+            logger.error(f"Задача {task_id}: Запрошена неизвестная модель Whisper '{requested_model_name}'.")
+            error_payload = {"task_id": task_id, "status": "error", "service": "whisper", "original_input_object": input_object_name, "error_message": f"Unknown Whisper model requested: '{requested_model_name}'."}
+            publish_result(ch, error_payload, task_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        if not get_minio_client():
             error_payload = {"task_id": task_id, "status": "error", "service": "whisper", "original_input_object": input_object_name, "error_message": "MinIO client not available during task processing."}
             publish_result(ch, error_payload, task_id)
             ch.basic_ack(delivery_tag=method.delivery_tag) # Подтверждаем, т.к. отправили ошибку
             return
 
-        with tempfile.TemporaryDirectory(prefix=f"whisper_{task_id}_") as tmpdir:
-            original_filename = Path(input_object_name).name
-            local_audio_file = Path(tmpdir) / original_filename
-            
-            logger.info(f"Задача {task_id}: Скачивание {input_object_name} из бакета {current_bucket_name} в {local_audio_file}")
-            if not download_file_from_minio(minio_client_instance, current_bucket_name, input_object_name, str(local_audio_file), task_id):
-                error_payload = {"task_id": task_id, "status": "error", "service": "whisper", "original_input_object": input_object_name, "error_message": f"Failed to download file from MinIO: s3://{current_bucket_name}/{input_object_name}"}
-                publish_result(ch, error_payload, task_id)
+        preview_published = False
+        if should_run_preview(transcription_pass, requested_model_name, current_bucket_name, input_object_name, task_id):
+            preview_message = process_transcription_task(task_id, current_bucket_name, input_object_name, original_input_object,
+                                                         output_minio_folder, WHISPER_PREVIEW_MODEL_NAME, quality_tier="preview",
+                                                         result_kind="preview", revision=revision,
+                                                         max_audio_seconds=WHISPER_PREVIEW_MAX_SECONDS)
+            if preview_message["status"] == "success":
+                publish_result(ch, preview_message, task_id, immediate=WHISPER_PREVIEW_REFINE == "inline")
+                preview_published = True
+            else:
+                logger.warning(f"Задача {task_id}: Предварительный проход не удался: {preview_message.get('error_message')}")
+            if WHISPER_PREVIEW_REFINE == "enqueue":
+                enqueue_refine_task(ch, message_data, task_id, revision + 1)
                 ch.basic_ack(delivery_tag=method.delivery_tag)
                 return
+            revision += 1
 
-            logger.info(f"Задача {task_id}: Начало транскрибации для {local_audio_file} (только русский язык)")
-            transcription_result = transcribe_audio_russian(str(local_audio_file), task_id=task_id)
-
-            if transcription_result:
-                # ... (код для создания JSON без изменений)
-                file_stem = Path(original_filename).stem
-                detailed_transcription_data = {
-                    "full_text": transcription_result.get("text", ""),
-                    "segments": []
-                }
-                for segment in transcription_result.get("segments", []):
-                    detailed_transcription_data["segments"].append({
-                        "start": segment.get("start"),
-                        "end": segment.get("end"),
-                        "text": segment.get("text"),
-                    })
-                output_json_filename_local = f"{file_stem}_transcription_detailed.json"
-                output_json_path_local = Path(tmpdir) / output_json_filename_local
-                with open(output_json_path_local, 'w', encoding='utf-8') as f:
-                    json.dump(detailed_transcription_data, f, ensure_ascii=False, indent=2)
-                
-                output_json_minio_object_name = f"{output_minio_folder}/{output_json_filename_local}"
-                upload_file_to_minio(minio_client_instance, current_bucket_name, str(output_json_path_local), output_json_minio_object_name, task_id, content_type='application/json')
-                
-                result_for_rabbitmq = {
-                    "task_id": task_id, "status": "success", "service": "whisper",
-                    "tool_version": whisper.__version__, "model_used": WHISPER_MODEL_NAME,
-                    "input_bucket": current_bucket_name, "input_object": original_input_object,
-                    "processed_object": input_object_name, 
-                    "transcription_detailed_json_object_path": f"s3://{current_bucket_name}/{output_json_minio_object_name}",
-                    "language_requested": "ru", "language_detected_by_model": transcription_result.get("language"),
-                    "full_text": detailed_transcription_data["full_text"], "segments": detailed_transcription_data["segments"]
-                }
-                publish_result(ch, result_for_rabbitmq, task_id)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                logger.info(f"Задача {task_id}: Успешно обработана, результаты опубликованы.")
-            else:
-                # ... (обработка ошибки транскрибации без изменений) ...
-                # Добавим original_input_object в сообщение об ошибке для полноты картины
-                error_payload = {"task_id": task_id, "status": "error", "service": "whisper", 
-                                 "input_bucket": current_bucket_name, 
-                                 "input_object": original_input_object,
-                                 "processed_object": input_object_name,
-                                 "error_message": "Transcription failed in whisper_worker."}
-                publish_result(ch, error_payload, task_id)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+        # После предварительного результата промежуточные пачки не публикуются: они дописывались бы к его тексту
+        partial_channel = None if preview_published or transcription_pass == "refine" else ch
+        task_started = time.monotonic()
+        result_message = process_transcription_task(task_id, current_bucket_name, input_object_name, original_input_object,
+                                                    output_minio_folder, requested_model_name, partial_channel=partial_channel,
+                                                    quality_tier=tier["name"], revision=revision)
+        if result_message["status"] == "success" and not result_message.get("cache_hit") and not explicit_model_name:
+            QUALITY_GOVERNOR.observe_task(tier["name"], time.monotonic() - task_started)
+        publish_result(ch, result_message, task_id)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if result_message["status"] == "success":
+            logger.info(f"Задача {task_id}: Успешно обработана, результаты опубликованы.")
     
     except json.JSONDecodeError as e:
         logger.error(f"Задача {task_id}: Не удалось декодировать JSON сообщение: {e}. Тело: {body[:200]}")
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False) 
-    except pika.exceptions.AMQPConnectionError as e:
-        logger.error(f"Задача {task_id}: Ошибка соединения RabbitMQ во время обработки: {e}")
-        # Не делаем ack/nack, позволяем ошибке всплыть, чтобы главный цикл переподключился
-        raise
     except Exception as e:
         logger.error(f"Задача {task_id}: Необработанное исключение в callback: {e}")
         logger.error(traceback.format_exc())
         error_payload = {"task_id": task_id, "status": "critical_error", "service": "whisper", "error_message": f"Unhandled exception in callback: {str(e)}"}
         try:
-            if ch.is_open: publish_result(ch, error_payload, task_id)
+            publish_result(ch, error_payload, task_id)
         except Exception as pub_e:
             logger.error(f"Задача {task_id}: Не удалось опубликовать сообщение о критической ошибке: {pub_e}")
         finally:
-            if ch.is_open: ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
 
-# ИСПРАВЛЕНО: main() теперь проще и надежнее
-def main():
-    logger.info(f"Запуск whisper_worker с моделью: {WHISPER_MODEL_NAME}")
-    logger.info(f"Слушает очередь '{CONSUME_QUEUE}'")
-    logger.info(f"Публикует результаты в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
+class TaskDelivery:
+    """
+    Доставка задачи, которую обрабатывает рабочий поток. Канал BlockingConnection нельзя
+    трогать вне потока соединения, поэтому publish/ack/nack копятся и по завершении задачи
+    одним пакетом передаются в поток соединения через add_callback_threadsafe.
+
+    Если соединение оборвалось во время инференса, брокер доставит сообщение повторно
+    (redelivered=True): доставка перепривязывается к новому каналу и результат уходит
+    уже по нему, а задача не выполняется второй раз.
+    """
+
+    def __init__(self, task_key, connection, channel, delivery_tag):
+        self.task_key = task_key
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
+        self._operations = []
+
+    @property
+    def is_open(self):
+        # Операции копятся и отправляются по актуальной привязке, поэтому доставка всегда их принимает
+        return True
+
+    def rebind(self, connection, channel, delivery_tag):
+        self._connection = connection
+        self._channel = channel
+        self._delivery_tag = delivery_tag
 
+    def basic_publish(self, **kwargs):
+        self._operations.append(("basic_publish", kwargs))
+
+    def publish_now(self, **kwargs):
+        """Публикует сразу, не дожидаясь завершения задачи (промежуточные результаты). При обрыве соединения сообщение теряется."""
+        with DELIVERY_LOCK:
+            if not self._connection.is_open:
+                raise ConnectionError("соединение закрыто")
+            self._connection.add_callback_threadsafe(functools.partial(self._channel.basic_publish, **kwargs))
+
+    def basic_ack(self, **kwargs):
+        self._operations.append(("basic_ack", kwargs))
+        self._flush()
+
+    def basic_nack(self, **kwargs):
+        self._operations.append(("basic_nack", kwargs))
+        self._flush()
+
+    def _flush(self):
+        operations, self._operations = self._operations, []
+        with DELIVERY_LOCK:
+            INFLIGHT_TASKS.pop(self.task_key, None)
+            # Результат запоминается до передачи в поток соединения: если соединение оборвётся раньше,
+            # чем callback выполнится, он будет отброшен, а повторная доставка должна найти готовый результат
+            remember_completed_task(self.task_key, operations)
+            if SHARED_TASKS is not None:
+                # Сначала результат, потом снятие отметки: соседний процесс не увидит задачу ни выполняемой, ни готовой
+                SHARED_TASKS.store_completed(self.task_key, operations)
+                SHARED_TASKS.release(self.task_key)
+            try:
+                if not self._connection.is_open:
+                    raise ConnectionError("соединение закрыто")
+                self._connection.add_callback_threadsafe(
+                    functools.partial(replay_operations, self.task_key, self._channel, self._delivery_tag, operations))
+            except Exception as e:
+                logger.warning(f"Задача {self.task_key}: результат сохранён до повторной доставки сообщения ({e}).")
+
+def remember_completed_task(task_key, operations):
+    COMPLETED_TASKS[task_key] = operations
+    while len(COMPLETED_TASKS) > COMPLETED_TASKS_MAX:
+        COMPLETED_TASKS.popitem(last=False)
+
+def replay_operations(task_key, channel, delivery_tag, operations):
+    """
+    Выполняется в потоке соединения: публикует результаты задачи и подтверждает доставку.
+    Сохранённый результат удаляется из COMPLETED_TASKS только после успешного подтверждения,
+    до этого его найдёт повторная доставка.
+    """
     try:
-        get_minio_client()
+        for method_name, kwargs in operations:
+            if method_name != "basic_publish":
+                kwargs = {**kwargs, "delivery_tag": delivery_tag}
+            getattr(channel, method_name)(**kwargs)
     except Exception as e:
-        logger.critical(f"Критическая ошибка: Не удалось подключиться к MinIO при старте: {e}. Воркер не будет запущен.")
+        logger.warning(f"Задача {task_key}: не удалось отправить результат ({e}), он будет отправлен при повторной доставке.")
+        return
+    with DELIVERY_LOCK:
+        if COMPLETED_TASKS.get(task_key) is operations:
+            del COMPLETED_TASKS[task_key]
+        if SHARED_TASKS is not None:
+            SHARED_TASKS.discard_completed(task_key)
+
+def get_task_key(properties, body):
+    return (properties and properties.message_id) or hashlib.sha256(body).hexdigest()
+
+def get_consumer_arguments():
+    # Подтверждение приходит только после выгрузки результата, поэтому для часовых записей
+    # тайм-аут брокера на ack (по умолчанию 30 минут) может понадобиться увеличить
+    return {"x-consumer-timeout": RABBITMQ_CONSUMER_TIMEOUT_MS} if RABBITMQ_CONSUMER_TIMEOUT_MS > 0 else None
+
+def get_task_executor():
+    global TASK_EXECUTOR
+    if TASK_EXECUTOR is None:
+        # В режиме полос каждая получает свои слоты, чтобы короткая задача не ждала в пуле за длинными
+        max_workers = sum(get_lane_slots().values()) if TASK_LANES else WORKER_CONCURRENCY
+        TASK_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task")
+    return TASK_EXECUTOR
+
+def get_router_executor():
+    global ROUTER_EXECUTOR
+    if ROUTER_EXECUTOR is None:
+        # Отдельный пул: классификация не ждёт в пуле задач за инференсом
+        ROUTER_EXECUTOR = ThreadPoolExecutor(max_workers=LANE_ROUTER_WORKERS, thread_name_prefix="router")
+    return ROUTER_EXECUTOR
+
+def get_lane_slots():
+    """
+    Слоты полос (prefetch их каналов): WORKER_CONCURRENCY делится по весам так, что в сумме слотов ровно
+    WORKER_CONCURRENCY и у каждой полосы хотя бы один слот (число полос проверяется при старте).
+    """
+    total_weight = sum(TASK_LANES.values())
+    spare = WORKER_CONCURRENCY - len(TASK_LANES)
+    shares = {lane: spare * weight / total_weight for lane, weight in TASK_LANES.items()}
+    slots = {lane: 1 + int(share) for lane, share in shares.items()}
+    # Оставшиеся слоты - полосам с наибольшей дробной частью доли
+    by_remainder = sorted(shares, key=lambda lane: shares[lane] - int(shares[lane]), reverse=True)
+    for lane in by_remainder[:WORKER_CONCURRENCY - sum(slots.values())]:
+        slots[lane] += 1
+    return slots
+
+def get_lane_queue(lane):
+    return f"{CONSUME_QUEUE}.{lane}"
+
+def get_lane_routing_key(lane):
+    return f"{CONSUME_ROUTING_KEY}.{lane}"
+
+def probe_object_duration(minio_client, bucket_name, object_name):
+    """Длительность записи по заголовку файла: ffprobe читает по presigned URL только начало объекта."""
+    url = minio_client.presigned_get_object(bucket_name, object_name, expires=timedelta(minutes=10))
+    try:
+        completed = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", url],
+                                   capture_output=True, text=True, timeout=LANE_PROBE_TIMEOUT_SECONDS, check=True)
+        return float(completed.stdout.strip())
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+def classify_task_lane(task_data):
+    """Полоса задачи по длительности записи, а если её не узнать - по размеру объекта. Возвращает (полоса, причина)."""
+    input_bucket = task_data.get("input_bucket_name", MINIO_BUCKET_NAME)
+    input_object = task_data.get("input_object_name")
+    minio_client_instance = get_minio_client()
+    object_size = minio_client_instance.stat_object(input_bucket, input_object).size
+    if LANE_PROBE_DURATION:
+        duration = probe_object_duration(minio_client_instance, input_bucket, input_object)
+        if duration is not None:
+            return ("fast" if duration <= LANE_FAST_MAX_SECONDS else "bulk"), f"длительность {duration:.0f} с"
+    return ("fast" if object_size <= LANE_FAST_MAX_BYTES else "bulk"), f"размер {object_size} байт"
+
+def route_message(channel, method_frame, properties, body, connection):
+    """
+    Выполняется в потоке соединения: задача из общей очереди перекладывается в очередь своей полосы.
+    stat_object и ffprobe могут занять до LANE_PROBE_TIMEOUT_SECONDS, поэтому классификация идёт
+    в отдельном пуле, а в поток соединения возвращаются только публикация и подтверждение.
+    """
+    get_router_executor().submit(_classify_in_pool, connection, channel, method_frame, properties, body)
+
+def _classify_in_pool(connection, channel, method_frame, properties, body):
+    task_id = properties.correlation_id or properties.message_id or "unknown_task"
+    try:
+        task_data = json.loads(body.decode('utf-8'))
+        task_id = task_data.get("task_id") or task_data.get("TaskId") or task_id
+        lane, reason = classify_task_lane(task_data)
+    except Exception as e:
+        # Битое сообщение или отсутствующий файл: ошибку быстрее сообщит воркер быстрой полосы
+        lane, reason = "fast", f"полоса не определена: {e}"
+    try:
+        connection.add_callback_threadsafe(functools.partial(publish_to_lane, connection, channel, method_frame.delivery_tag,
+                                                             properties, body, task_id, lane, reason))
+    except Exception as e:
+        # Соединение закрыто: неподтверждённое сообщение брокер доставит повторно
+        logger.warning(f"Задача {task_id}: не удалось направить в полосу '{lane}' ({e}), задача будет доставлена повторно")
+
+def publish_to_lane(connection, channel, delivery_tag, properties, body, task_id, lane, reason):
+    """
+    Выполняется в потоке соединения. Канал работает с подтверждениями публикации, поэтому исходное сообщение
+    подтверждается только после того, как брокер принял копию. Непринятая задача возвращается в общую очередь
+    через LANE_ROUTE_RETRY_SECONDS, а не сразу, чтобы не крутиться в цикле повторных доставок.
+    """
+    if not channel.is_open:
+        return
+    lane_properties = copy.copy(properties)
+    lane_properties.headers = {**(properties.headers or {}), "x-task-lane": lane}
+    try:
+        channel.basic_publish(exchange=CONSUME_EXCHANGE, routing_key=get_lane_routing_key(lane), body=body,
+                              properties=lane_properties, mandatory=True)
+    except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+        logger.error(f"Задача {task_id}: брокер не принял задачу в полосу '{lane}' ({e}), "
+                     f"она вернётся в общую очередь через {LANE_ROUTE_RETRY_SECONDS:.0f} с")
+
+        def requeue():
+            # Если канал успел закрыться, брокер уже вернул сообщение в очередь сам
+            if channel.is_open:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+        connection.call_later(LANE_ROUTE_RETRY_SECONDS, requeue)
         return
+    channel.basic_ack(delivery_tag=delivery_tag)
+    logger.info(f"Задача {task_id}: направлена в полосу '{lane}' ({reason})")
+
+def consume_task_lanes(connection, channel):
+    """
+    Объявляет очереди всех полос и подписывается на свои. У каждой полосы отдельный канал с prefetch,
+    равным числу её слотов: длинные записи занимают только слоты bulk, и для короткой задачи
+    всегда остаётся свободный слот. Общую очередь при TASK_LANE_ROUTER разбирает route_message.
+    """
+    for lane in SUPPORTED_TASK_LANES:
+        channel.queue_declare(queue=get_lane_queue(lane), durable=True)
+        channel.queue_bind(exchange=CONSUME_EXCHANGE, queue=get_lane_queue(lane), routing_key=get_lane_routing_key(lane))
+
+    lane_channels = []
+    for lane, slots in get_lane_slots().items():
+        lane_channel = connection.channel()
+        lane_channels.append(lane_channel)
+        lane_channel.basic_qos(prefetch_count=slots)
+        lane_channel.basic_consume(
+            queue=get_lane_queue(lane),
+            on_message_callback=functools.partial(dispatch_message, connection=connection),
+            arguments=get_consumer_arguments()
+        )
+        logger.info(f"[*] Полоса '{lane}': очередь '{get_lane_queue(lane)}', слотов: {slots}")
+
+    if TASK_LANE_ROUTER:
+        channel.confirm_delivery()
+        channel.basic_qos(prefetch_count=LANE_ROUTER_WORKERS)
+        channel.basic_consume(queue=CONSUME_QUEUE, on_message_callback=functools.partial(route_message, connection=connection))
+        logger.info(f"[*] Задачи из общей очереди '{CONSUME_QUEUE}' распределяются по полосам "
+                    f"(fast: до {LANE_FAST_MAX_SECONDS:.0f} с или до {LANE_FAST_MAX_BYTES} байт)")
+    return lane_channels + [channel]
+
+def _run_task_in_pool(delivery, method_frame, properties, body):
+    observe_queue_wait(properties)
+    try:
+        callback(delivery, method_frame, properties, body)
+    except Exception as e:
+        logger.exception(f"Необработанное исключение в рабочем потоке (delivery_tag={method_frame.delivery_tag}): {e}")
+        delivery.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=False)
+
+def dispatch_message(channel, method_frame, properties, body, connection):
+    """Выполняется в потоке соединения: передаёт задачу в пул, не блокируя ввод-вывод и heartbeat RabbitMQ."""
+    task_key = get_task_key(properties, body)
+    with DELIVERY_LOCK:
+        if method_frame.redelivered:
+            # Не извлекается: replay_operations удалит результат сам, когда подтверждение пройдёт
+            completed_operations = COMPLETED_TASKS.get(task_key)
+            if completed_operations is not None:
+                logger.info(f"Задача {task_key}: повторная доставка уже обработанной задачи, отправляется сохранённый результат.")
+                replay_operations(task_key, channel, method_frame.delivery_tag, completed_operations)
+                return
+            inflight = INFLIGHT_TASKS.get(task_key)
+            if inflight is not None:
+                logger.info(f"Задача {task_key}: повторная доставка задачи, которая ещё выполняется. Результат будет отправлен по новой доставке.")
+                inflight.rebind(connection, channel, method_frame.delivery_tag)
+                return
+            if SHARED_TASKS is not None and dispatch_to_sibling(task_key, channel, method_frame, properties, body, connection):
+                return
+        if task_key in INFLIGHT_TASKS:
+            task_key = f"{task_key}:{uuid.uuid4()}"
+        if SHARED_TASKS is not None and not SHARED_TASKS.claim(task_key):
+            # Повторная публикация задачи, которую выполняет соседний процесс: как и внутри процесса, выполняется отдельно
+            task_key = f"{task_key}:{uuid.uuid4()}"
+            SHARED_TASKS.claim(task_key)
+        delivery = TaskDelivery(task_key, connection, channel, method_frame.delivery_tag)
+        INFLIGHT_TASKS[task_key] = delivery
+    get_task_executor().submit(_run_task_in_pool, delivery, method_frame, properties, body)
+
+def dispatch_to_sibling(task_key, channel, method_frame, properties, body, connection, polling=False):
+    """
+    Выполняется в потоке соединения для повторной доставки в режиме pre-fork. Если задачу уже завершил соседний
+    процесс, отправляет его результат; если он ещё выполняет её, ждёт результата, проверяя реестр каждые
+    PREFORK_SIBLING_POLL_SECONDS. Возвращает False, если задачей никто не занят и её нужно выполнить здесь.
+    """
+    # Отметка читается раньше результата: сосед сохраняет результат до снятия отметки, поэтому хотя бы одно из двух видно
+    claimed_by_sibling = SHARED_TASKS.is_claimed_by_sibling(task_key)
+    completed_operations = SHARED_TASKS.load_completed(task_key)
+    if completed_operations is not None:
+        logger.info(f"Задача {task_key}: повторная доставка задачи, завершённой соседним процессом, отправляется её результат.")
+        replay_operations(task_key, channel, method_frame.delivery_tag, completed_operations)
+        return True
+    if not claimed_by_sibling:
+        return False
+    if not polling:
+        logger.info(f"Задача {task_key}: повторная доставка задачи, которую ещё выполняет соседний процесс. Ожидание её результата.")
+
+    def check():
+        if not channel.is_open:
+            return # доставка вернётся в очередь вместе с каналом
+        with DELIVERY_LOCK:
+            if not dispatch_to_sibling(task_key, channel, method_frame, properties, body, connection, polling=True):
+                logger.warning(f"Задача {task_key}: соседний процесс завершился без результата, задача выполняется здесь.")
+                dispatch_message(channel, method_frame, properties, body, connection)
+
+    connection.call_later(PREFORK_SIBLING_POLL_SECONDS, check)
+    return True
+
+def init_forked_child(slot):
+    """Выполняется в дочернем процессе сразу после fork: всё, что нельзя делить с родителем, создаётся заново."""
+    global MINIO_CLIENT, METRICS_PORT
+    # Обработчики супервизора не наследуются: SIGTERM завершает процесс, CTRL+C даёт KeyboardInterrupt
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Пул HTTP-соединений urllib3 не должен быть общим с другими процессами
+    MINIO_CLIENT = None
+    # У каждого процесса свой реестр метрик: процесс слота N отдаёт /metrics на METRICS_PORT + N
+    if METRICS_PORT > 0:
+        METRICS_PORT += slot
+    start_metrics_server()
+    # Прогрев идёт уже в дочернем процессе: инференс в родителе до fork создал бы пулы потоков torch
+    warmup_whisper_model(WHISPER_MODEL_NAME)
+    if ADAPTIVE_QUALITY:
+        warmup_whisper_model(WHISPER_FAST_MODEL_NAME)
+    if WHISPER_PREVIEW:
+        warmup_whisper_model(WHISPER_PREVIEW_MODEL_NAME)
+
+class SharedTaskRegistry:
+    """
+    Общий для дочерних процессов pre-fork реестр задач - каталог, который создаёт супервизор. Повторная доставка
+    после обрыва соединения может прийти в другой процесс: по реестру он находит результат задачи или видит, что её ещё
+    выполняет сосед, и не запускает её второй раз. <ключ>.inflight хранит pid выполняющего процесса,
+    <ключ>.done - операции завершённой задачи, ещё не подтверждённой брокеру (pickle).
+    Файлы создаются атомарно (O_EXCL или os.replace), поэтому отдельная межпроцессная блокировка не нужна.
+    """
+
+    def __init__(self, root, max_completed):
+        self.root = root
+        self.max_completed = max_completed
+
+    def _path(self, task_key, suffix):
+        return os.path.join(self.root, hashlib.sha256(task_key.encode('utf-8')).hexdigest() + suffix)
+
+    def _owner(self, task_key):
+        try:
+            with open(self._path(task_key, ".inflight"), encoding='utf-8') as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def claim(self, task_key):
+        """Отмечает задачу выполняемой этим процессом. False, если её уже выполняет живой соседний процесс."""
+        path = self._path(task_key, ".inflight")
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            owner = self._owner(task_key)
+            if owner not in (None, os.getpid()) and self._is_alive(owner):
+                return False
+            # Отметка процесса, который упал, не успев её снять
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                f.write(str(os.getpid()))
+            os.replace(tmp_path, path)
+            return True
+        with os.fdopen(fd, "w", encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def is_claimed_by_sibling(self, task_key):
+        owner = self._owner(task_key)
+        return owner is not None and owner != os.getpid() and self._is_alive(owner)
+
+    def release(self, task_key):
+        if self._owner(task_key) == os.getpid():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(task_key, ".inflight"))
+
+    def release_owner(self, pid):
+        """Снимает отметки завершившегося процесса (вызывает супервизор)."""
+        for name in os.listdir(self.root):
+            if not name.endswith(".inflight"):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    owner = int(f.read() or 0)
+            except (FileNotFoundError, ValueError):
+                continue
+            if owner == pid:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
 
+    def store_completed(self, task_key, operations):
+        path = self._path(task_key, ".done")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(operations, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Задача {task_key}: не удалось сохранить результат в общий реестр pre-fork: {e}")
+            return
+        done = sorted((entry for entry in os.scandir(self.root) if entry.name.endswith(".done")), key=lambda entry: entry.stat().st_mtime)
+        for entry in done[:max(len(done) - self.max_completed, 0)]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+    def load_completed(self, task_key):
+        try:
+            with open(self._path(task_key, ".done"), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def discard_completed(self, task_key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(task_key, ".done"))
+
+def describe_exit_status(status):
+    if os.WIFSIGNALED(status):
+        return f"по сигналу {signal.Signals(os.WTERMSIG(status)).name}"
+    return f"с кодом {os.WEXITSTATUS(status)}"
+
+def run_prefork_supervisor():
+    """
+    Порождает WORKER_PROCESSES потребителей через fork и перезапускает упавшие.
+    Модель к этому моменту загружена в родителе, инференс в нём не запускался (пулы потоков torch
+    не созданы), поэтому дочерние процессы делят страницы весов copy-on-write, пока не пишут в них.
+    """
+    global SHARED_TASKS
+    children = {} # pid -> (слот, время запуска)
+    restart_delays = {}
+    stopping = False
+    # Реестр создаётся до fork: дочерние процессы наследуют его и видят задачи друг друга
+    SHARED_TASKS = SharedTaskRegistry(tempfile.mkdtemp(prefix="whisper-prefork-"), COMPLETED_TASKS_MAX * WORKER_PROCESSES)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info(f"Получен сигнал {signal.Signals(signum).name}: остановка {len(children)} дочерних процессов...")
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                init_forked_child(slot)
+                run_consumer()
+            except BaseException as e:
+                logger.exception(f"Дочерний процесс слота {slot} завершился с ошибкой: {e}")
+                exit_code = 1
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+        children[pid] = (slot, time.monotonic())
+        logger.info(f"Запущен дочерний процесс {pid} (слот {slot})")
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # Объекты родителя переносятся в постоянное поколение: сборщик мусора в дочерних процессах
+    # не обходит их и не копирует страницы, записывая счётчики поколений
+    gc.collect()
+    gc.freeze()
+    for slot in range(WORKER_PROCESSES):
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot, started = children.pop(pid, (None, None))
+        SHARED_TASKS.release_owner(pid)
+        if slot is None or stopping:
+            continue
+        uptime = time.monotonic() - started
+        delay = PREFORK_RESTART_DELAY_SECONDS
+        if uptime < PREFORK_STABLE_SECONDS:
+            delay = min(restart_delays.get(slot, PREFORK_RESTART_DELAY_SECONDS / 2) * 2, PREFORK_RESTART_MAX_DELAY_SECONDS)
+        restart_delays[slot] = delay
+        logger.error(f"Дочерний процесс {pid} (слот {slot}) завершился {describe_exit_status(status)} через {uptime:.0f} с, "
+                     f"перезапуск через {delay:.0f} с")
+        time.sleep(delay)
+        if not stopping:
+            spawn(slot)
+    shutil.rmtree(SHARED_TASKS.root, ignore_errors=True)
+
+def run_consumer():
     connection = None
+    channel = None
+    consuming_channels = []
     while True:
         try:
             logger.info(f"Попытка подключения к RabbitMQ: {RABBITMQ_HOST}:{RABBITMQ_PORT}...")
             credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
             parameters = pika.ConnectionParameters(
                 RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_VHOST, credentials,
-                heartbeat=600, blocked_connection_timeout=300
+                heartbeat=RABBITMQ_HEARTBEAT, blocked_connection_timeout=300
             )
             connection = pika.BlockingConnection(parameters)
             channel = connection.channel()
+            consuming_channels = [channel]
             logger.info("Успешное подключение к RabbitMQ.")
 
             # Воркер НЕ должен объявлять инфраструктуру, кроме той, что ему нужна для работы.
@@ -306,9 +2230,24 @@ def main():
             # Воркер объявляет только СВОЮ очередь задач.
             channel.queue_declare(queue=CONSUME_QUEUE, durable=True)
             channel.queue_bind(exchange=CONSUME_EXCHANGE, queue=CONSUME_QUEUE, routing_key=CONSUME_ROUTING_KEY)
+            if ADAPTIVE_QUALITY:
+                schedule_backlog_checks(connection)
             
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=CONSUME_QUEUE, on_message_callback=callback)
+            if TASK_LANES:
+                consuming_channels = consume_task_lanes(connection, channel)
+                logger.info("[*] Ожидание сообщений в полосах. Для выхода нажмите CTRL+C")
+                # Каналы полос обслуживаются одним циклом соединения; как и start_consuming, цикл
+                # работает, пока у каналов есть подписки, а после их отмены соединение переоткрывается
+                while any(ch.is_open and ch.consumer_tags for ch in consuming_channels):
+                    connection.process_data_events(time_limit=None)
+                continue
+
+            channel.basic_qos(prefetch_count=WORKER_PREFETCH)
+            channel.basic_consume(
+                queue=CONSUME_QUEUE,
+                on_message_callback=functools.partial(dispatch_message, connection=connection),
+                arguments=get_consumer_arguments()
+            )
             
             logger.info(f"[*] Ожидание сообщений в очереди '{CONSUME_QUEUE}'. Для выхода нажмите CTRL+C")
             channel.start_consuming()
@@ -317,8 +2256,9 @@ def main():
             logger.warning(f"Потеряно соединение с RabbitMQ: {e}")
         except KeyboardInterrupt:
             logger.info("Получен сигнал KeyboardInterrupt. Завершение работы...")
-            if channel and channel.is_open:
-                channel.stop_consuming()
+            for consuming_channel in consuming_channels:
+                if consuming_channel and consuming_channel.is_open:
+                    consuming_channel.stop_consuming()
             break
         except Exception as e:
             logger.error(f"Произошла непредвиденная ошибка в главном цикле: {e}")
@@ -330,6 +2270,70 @@ def main():
             logger.info(f"Повторная попытка через {RECONNECT_DELAY_SECONDS} секунд...")
             time.sleep(RECONNECT_DELAY_SECONDS)
 
+# ИСПРАВЛЕНО: main() теперь проще и надежнее
+def main():
+    logger.info(f"Запуск whisper_worker с моделью: {WHISPER_MODEL_NAME}, движок: {WHISPER_BACKEND}")
+    logger.info(f"Слушает очередь '{CONSUME_QUEUE}' (задач одновременно: {WORKER_CONCURRENCY}, инференсов: {INFERENCE_CONCURRENCY}, prefetch: {WORKER_PREFETCH})")
+    if TASK_LANES:
+        logger.info(f"Полосы задач: {', '.join(f'{lane} (вес {weight})' for lane, weight in TASK_LANES.items())}")
+    logger.info(f"Публикует результаты в '{PUBLISH_EXCHANGE}' с ключом '{PUBLISH_ROUTING_KEY}'")
+    if ADAPTIVE_QUALITY:
+        logger.info(f"Адаптивное качество: при очереди от {ADAPTIVE_QUALITY_DEGRADE_BACKLOG_SECONDS:.0f} с - модель {WHISPER_FAST_MODEL_NAME}, "
+                    f"возврат к {WHISPER_MODEL_NAME} ниже {ADAPTIVE_QUALITY_RESTORE_BACKLOG_SECONDS:.0f} с")
+    if WHISPER_PREVIEW:
+        logger.info(f"Предварительный проход: модель {WHISPER_PREVIEW_MODEL_NAME}"
+                    f"{f', первые {WHISPER_PREVIEW_MAX_SECONDS:.0f} с' if WHISPER_PREVIEW_MAX_SECONDS else ''}, полный проход: {WHISPER_PREVIEW_REFINE}")
+    if WHISPER_PARTIAL_RESULTS:
+        logger.info(f"Промежуточные результаты записей от {WHISPER_PARTIAL_MIN_SECONDS:.0f} с публикуются с ключом '{PARTIAL_ROUTING_KEY}'")
+        if WHISPER_BACKEND != "faster_whisper":
+            logger.info(f"Движок {WHISPER_BACKEND} не отдаёт сегменты по ходу распознавания: такие записи распознаются "
+                        f"по частям (WHISPER_CHUNK_SECONDS={WHISPER_CHUNK_SECONDS:.0f} с), пачка публикуется после каждой части")
+
+    try:
+        get_minio_client()
+    except Exception as e:
+        logger.critical(f"Критическая ошибка: Не удалось подключиться к MinIO при старте: {e}. Воркер не будет запущен.")
+        return
+
+    if WORKER_PROCESSES > 1:
+        try:
+            if get_whisper_backend().device != "cpu":
+                # CUDA-контекст нельзя унаследовать через fork
+                logger.critical(f"Критическая ошибка: WORKER_PROCESSES={WORKER_PROCESSES} поддерживается только на CPU. Воркер не будет запущен.")
+                return
+            if WHISPER_BACKEND == "faster_whisper":
+                # Веса CTranslate2 не делятся через fork: память на модель умножается на число процессов
+                logger.warning(f"Режим pre-fork с faster_whisper: модель загружается в каждом из {WORKER_PROCESSES} процессов, "
+                               f"общих весов нет. Для параллельного инференса одной копии модели используйте WHISPER_NUM_WORKERS")
+            else:
+                logger.info(f"Режим pre-fork: {WORKER_PROCESSES} дочерних процессов с общими весами модели")
+            if WHISPER_BACKEND != "faster_whisper":
+                get_whisper_model(WHISPER_MODEL_NAME, task_id="prefork")
+                if ADAPTIVE_QUALITY:
+                    get_whisper_model(WHISPER_FAST_MODEL_NAME, task_id="prefork")
+                if WHISPER_PREVIEW:
+                    get_whisper_model(WHISPER_PREVIEW_MODEL_NAME, task_id="prefork")
+        except Exception as e:
+            logger.critical(f"Критическая ошибка: Не удалось загрузить модель Whisper {WHISPER_MODEL_NAME} при старте: {e}. Воркер не будет запущен.")
+            return
+        run_prefork_supervisor()
+        logger.info("Воркер whisper_worker остановлен.")
+        return
+
+    start_metrics_server()
+
+    try:
+        warmup_whisper_model(WHISPER_MODEL_NAME)
+        if ADAPTIVE_QUALITY:
+            warmup_whisper_model(WHISPER_FAST_MODEL_NAME)
+        if WHISPER_PREVIEW:
+            warmup_whisper_model(WHISPER_PREVIEW_MODEL_NAME)
+    except Exception as e:
+        logger.critical(f"Критическая ошибка: Не удалось загрузить модель Whisper при старте: {e}. Воркер не будет запущен.")
+        return
+
+    run_consumer()
+
     logger.info("Воркер whisper_worker остановлен.")
 
 if __name__ == "__main__":